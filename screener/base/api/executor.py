@@ -0,0 +1,33 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+"""
+Blocking work of the async views (sqlite reads, snapshot recomputes, compression) runs on a small thread pool
+instead of the event loop. Concurrent calls for the same key share one run, a burst of polls for the same snapshot
+costs a single database read.
+"""
+
+MAX_WORKERS = 4
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="market-data")
+
+_inflight: Dict[Tuple[asyncio.AbstractEventLoop, Hashable], asyncio.Future] = {}
+
+
+async def run_coalesced(key: Hashable, function: Callable, *args) -> Any:
+    """
+    Result of `function(*args)` run on `executor`, a call made while another one with the same `key` is running
+    waits for its result instead of running `function` again
+    """
+    loop = asyncio.get_running_loop()
+    # futures belong to the loop they were created on
+    key = (loop, key)
+    future = _inflight.get(key)
+    if future is None:
+        # the context is copied so that the profiling spans of the call land in the request that started it
+        future = _inflight[key] = loop.run_in_executor(executor, copy_context().run, function, *args)
+        future.add_done_callback(lambda _: _inflight.pop(key, None))
+    # a waiter going away (client disconnect) doesn't cancel the run the others wait for
+    return await asyncio.shield(future)
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import traceback
+from dataclasses import dataclass, field
+from typing import Callable, Optional, Set, Tuple
+from base.api.executor import run_coalesced
+from base.api.market_data.api_requests import general_market_data_snapshot
+from base.api.market_data.classes.analysis import IndexDataUnavailable
+from base.api.market_data.classes.snapshots import EncodedSnapshot
+
+"""
+Server-Sent Events channel of the market data snapshots (`LIVE_PATH`), served by the ASGI application next to Django.
+
+A single task per process watches `api_data` for the snapshots published by the refresher. Clients get the whole
+snapshot when they connect (unless Last-Event-ID says they hold it already), then a `diff` event per new snapshot
+with only what changed.
+"""
+
+LIVE_PATH = "/api/market-data/live"
+
+
+def dumps(value) -> str:
+    return json.dumps(value, sort_keys=True)
+
+
+def snapshot_diff(previous: dict, current: dict) -> dict:
+    """
+    Changes from the `previous` to the `current` snapshot: entries added or changed by ticker and the removed
+    tickers, the other top level fields (market_breadth, plotting) when they differ. Values are compared as JSON,
+    NaN equals NaN
+    """
+    diff = {}
+    for key, value in current.items():
+        if key != "entries" and dumps(value) != dumps(previous.get(key)):
+            diff[key] = value
+    # a snapshot without entries holds False
+    before, after = previous.get("entries") or {}, current.get("entries") or {}
+    changed = {ticker: entry for ticker, entry in after.items()
+               if ticker not in before or dumps(entry) != dumps(before[ticker])}
+    removed = [ticker for ticker in before if ticker not in after]
+    if changed or removed:
+        diff["entries"] = {"changed": changed, "removed": removed}
+    return diff
+
+
+def sse_event(event: str, data: str, event_id: int = None) -> bytes:
+    lines = [f"event: {event}"] + ([f"id: {event_id}"] if event_id is not None else [])
+    lines += [f"data: {line}" for line in data.split("\n")]
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+@dataclass
+class SnapshotBroadcaster:
+    """
+    Polls the last published snapshot every `interval` seconds while clients are connected and sends every
+    subscriber the diff of each new one. A subscriber too slow to keep `queue_size` events gets the whole snapshot
+    instead of its backlog
+    :param latest: last published snapshot, called on the executor
+    """
+    interval: float = 5.
+    queue_size: int = 8
+    latest: Callable[[], EncodedSnapshot] = general_market_data_snapshot
+    snapshot: EncodedSnapshot = None
+    data: dict = None
+    _subscribers: Set[asyncio.Queue] = field(default_factory=set)
+    _task: Optional[asyncio.Task] = None
+
+    def fetch(self, previous: EncodedSnapshot = None) -> Optional[Tuple[EncodedSnapshot, dict, Optional[dict]]]:
+        """New snapshot, decoded, and its diff from the previous one. None if nothing was published since `previous`"""
+        snapshot = self.latest()
+        if previous is not None and snapshot.snapshot_id == previous.snapshot_id:
+            return None
+        data = json.loads(snapshot.data)
+        return snapshot, data, snapshot_diff(self.data, data) if self.data is not None else None
+
+    async def poll(self) -> None:
+        fetched = await run_coalesced(("live", id(self)), self.fetch, self.snapshot)
+        if fetched is None:
+            return
+        snapshot, data, diff = fetched
+        if self.snapshot is not None and snapshot.snapshot_id == self.snapshot.snapshot_id:
+            return
+        self.snapshot, self.data = snapshot, data
+        if diff is None:
+            return
+        event = sse_event("diff", dumps(diff), snapshot.snapshot_id)
+        for queue in self._subscribers:
+            self.put(queue, event)
+
+    def put(self, queue: asyncio.Queue, event: bytes) -> None:
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(self.snapshot_event())
+
+    def snapshot_event(self) -> bytes:
+        return sse_event("snapshot", self.snapshot.data.decode(), self.snapshot.snapshot_id)
+
+    async def current(self) -> EncodedSnapshot:
+        if self.snapshot is None:
+            await self.poll()
+        return self.snapshot
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.poll()
+            except Exception:
+                # a failed read is retried on the next tick, the clients stay connected
+                traceback.print_exc()
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.add(queue)
+        if self._task is None or self._task.done() or self._task.get_loop() is not asyncio.get_running_loop():
+            self._task = asyncio.ensure_future(self.run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._subscribers.discard(queue)
+        if not self._subscribers and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+broadcaster = SnapshotBroadcaster()
+
+
+async def live_updates(scope, receive, send, broadcaster: SnapshotBroadcaster = broadcaster,
+                       heartbeat: float = 15.) -> None:
+    """
+    ASGI application of the event stream
+    :param heartbeat: seconds between keep-alive comments, proxies close idle connections
+    """
+    headers = dict(scope.get("headers", []))
+    last_event_id = headers.get(b"last-event-id", b"").decode()
+    queue = broadcaster.subscribe()
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        try:
+            snapshot = await broadcaster.current()
+        except IndexDataUnavailable:
+            # nothing was published yet, the client retries (EventSource reconnects on its own)
+            await send({"type": "http.response.start", "status": 503,
+                        "headers": [(b"content-type", b"text/plain"), (b"retry-after", b"60")]})
+            await send({"type": "http.response.body", "body": b"No market data snapshot was published yet"})
+            return
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache"),
+                                (b"x-accel-buffering", b"no")]})
+        if last_event_id != str(snapshot.snapshot_id):
+            await send({"type": "http.response.body", "body": broadcaster.snapshot_event(), "more_body": True})
+        while True:
+            event = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({event, disconnected}, timeout=heartbeat,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                event.cancel()
+                break
+            body = event.result() if event in done else b": keep-alive\n\n"
+            if event not in done:
+                event.cancel()
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+    finally:
+        broadcaster.unsubscribe(queue)
+        disconnected.cancel()
+
+
+async def wait_disconnect(receive) -> None:
+    while (await receive())["type"] != "http.disconnect":
+        pass
@@ -1,12 +1,24 @@
 import json
-from datetime import datetime
 from pandas import DataFrame
-from numpy import vectorize
+from numpy import logical_or, arange, flatnonzero
 from base.api.market_data.config import db_path
-from base.api.market_data.classes.databases import SP500Database
+from base.api.market_data.classes.databases import ConnectionPool, SP500Database
 from base.api.market_data.classes.analysis import SP500Analysis
-from base.api.market_data.classes.strategies import TickerStrategy
-from base.api.market_data.database_functions import populate_sp500
+from base.api.market_data.classes.indicators import CVI
+from base.api.market_data.classes.strategies import evaluate_strategies, ENTRY_STRATEGIES, MARKET_STRATEGIES
+from base.api.market_data.classes.snapshots import snapshots, EncodedSnapshot
+from base.api.market_data.classes.columnar import ColumnarStore
+from base.api.market_data.classes.downsampling import lttb_indices
+from base.api.market_data.classes.fetchers import MarketDataProvider
+from base.api.market_data.classes.raw_bars import CachingProvider
+from base.api.market_data.classes.profiling import span
+
+
+def connect_sp500() -> SP500Database:
+    """`sp500.sqlite` read through the connection of the calling thread in the pool of the process"""
+    sp500_database = SP500Database()
+    sp500_database.connect_pool(ConnectionPool.shared(db_path / "sp500.sqlite"))
+    return sp500_database
 
 
 def get_market_breadth_status(market_analysis: SP500Analysis) -> bool:
@@ -17,13 +29,9 @@ def get_market_breadth_status(market_analysis: SP500Analysis) -> bool:
 
 def run_strategies_on_dataframe(df: DataFrame) -> None:
     """Apply all available strategies to `df`"""
-    df["Ichimoku_strategy"] = vectorize(TickerStrategy.ichimoku_entry)(df['senkou_span_a'], df['senkou_span_b'],
-                                                                       df['RSI'])
-    df["Signal_R_MA20_MA50"] = vectorize(TickerStrategy.r_ma20_ma50_signal)(df['RSI'], df['MA20'], df['MA50'])
-    df['Signal_MA_BOL_RSI'] = vectorize(TickerStrategy.ma_bol_rsi_signal)(df['Close'], df['MA50'],
-                                                                          df['BB_lower'], df["RSI"])
-    df["Signal_RSI_STOCH_MACD"] = vectorize(TickerStrategy.r_sd_m_signal)(df["RSI"], df["STOCH_D"],
-                                                                          df['MACD_histogram'])
+    signals = evaluate_strategies(df, ENTRY_STRATEGIES)
+    for strategy in ENTRY_STRATEGIES:
+        df[strategy.name] = signals[strategy.name]
 
 
 def get_entries_from_indicators(df: DataFrame) -> DataFrame:
@@ -32,69 +40,106 @@ def get_entries_from_indicators(df: DataFrame) -> DataFrame:
     is true
     """
     run_strategies_on_dataframe(df)
-    return df[(df["Signal_R_MA20_MA50"]) | (df["Signal_MA_BOL_RSI"])
-              | (df["Signal_RSI_STOCH_MACD"]) | df['Ichimoku_strategy']]
+    return df[logical_or.reduce([df[strategy.name].to_numpy() for strategy in ENTRY_STRATEGIES])]
 
 
-def parse_entries(entries: DataFrame) -> dict or bool:
+# payload of each entry strategy: (payload key, signal column, ((value key, column), ...))
+ENTRY_PAYLOAD = (
+    ("Ichimoku", "Ichimoku_strategy",
+     (("senkou_span_a", "senkou_span_a"), ("senkou_span_b", "senkou_span_b"), ("rsi", "RSI"))),
+    ("oversold_slow_over_fast", "Signal_R_MA20_MA50", (("rsi", "RSI"), ("ma20", "MA20"), ("ma50", "MA50"))),
+    ("oversold_stochastic", "Signal_MA_BOL_RSI",
+     (("close", "Close"), ("ma50", "MA50"), ("bollinger_lower", "BB_lower"), ("rsi", "RSI"))),
+    ("oversold_MACD", "Signal_RSI_STOCH_MACD",
+     (("rsi", "RSI"), ("stochastic_d", "STOCH_D"), ("macd", "MACD_histogram"))),
+)
+
+ENTRY_FORMATS = ("nested", "columnar")
+
+
+def entry_columns(entries: DataFrame) -> dict:
+    """
+    Compact columnar form of the entries, one array per field aligned to `tickers`. Values shared by several
+    strategies (rsi, ma50) are sent once
+    :param entries: return of `get_entries_from_indicators`
     """
+    value_columns = dict(value for _, _, values in ENTRY_PAYLOAD for value in values)
+    return {
+        "tickers": entries['Ticker'].to_numpy().tolist(),
+        "status": {key: entries[signal].to_numpy(dtype=bool).tolist() for key, signal, _ in ENTRY_PAYLOAD},
+        "values": {key: entries[column].to_numpy(dtype=float).tolist() for key, column in value_columns.items()},
+        "strategy_values": {key: [value for value, _ in values] for key, _, values in ENTRY_PAYLOAD},
+    }
+
 
-    :param entries: rturn of `parse_entries(get_entries_from_indicators())`
+def nest_entries(columns: dict) -> dict or bool:
+    """Nested form of `entry_columns`, one dictionary per ticker, False if there are no entries"""
+    if not columns["tickers"]:
+        return False
+    status, values = columns["status"], columns["values"]
+    data = {}
+    for i, ticker in enumerate(columns["tickers"]):
+        data[ticker] = {key: {"status": status[key][i], "values": {value: values[value][i] for value, _ in payload}}
+                        for key, _, payload in ENTRY_PAYLOAD}
+    return data
+
+
+def columnar_entries(entries: dict or bool) -> dict:
+    """`entry_columns` form of the nested entries of a stored snapshot"""
+    entries = entries or {}
+    columns = {
+        "tickers": list(entries),
+        "status": {key: [entry[key]["status"] for entry in entries.values()] for key, _, _ in ENTRY_PAYLOAD},
+        "values": {},
+        "strategy_values": {key: [value for value, _ in values] for key, _, values in ENTRY_PAYLOAD},
+    }
+    for key, _, values in ENTRY_PAYLOAD:
+        for value, _ in values:
+            if value not in columns["values"]:
+                columns["values"][value] = [entry[key]["values"][value] for entry in entries.values()]
+    return columns
+
+
+def parse_entries(entries: DataFrame) -> dict or bool:
+    """
+    Each column is extracted once with `to_numpy` and the dictionaries are built in a single pass over the tickers
+    :param entries: return of `get_entries_from_indicators`
     :return: entries dictionary
     """
-    data = {}
     if len(entries) == 0:
         return False
-    for i, row in enumerate(entries.index):
-        data[entries['Ticker'].loc[row]] = {
-            "Ichimoku": {
-                "status": bool(entries['Ichimoku_strategy'].loc[row]),
-                "values": {
-                    "senkou_span_a": entries['senkou_span_a'].loc[row],
-                    "senkou_span_b": entries['senkou_span_b'].loc[row],
-                    "rsi": entries['RSI'].loc[row],
-                }
-            },
-            "oversold_slow_over_fast": {
-                "status": bool(entries['Signal_R_MA20_MA50'].loc[row]),
-                "values": {
-                    "rsi": entries['RSI'].loc[row],
-                    "ma20": entries['MA20'].loc[row],
-                    "ma50": entries['MA50'].loc[row]
-                }
-            },
-            "oversold_stochastic": {
-                "status": bool(entries['Signal_MA_BOL_RSI'].loc[row]),
-                "values": {
-                    "close": entries['Close'].loc[row],
-                    "ma50": entries['MA50'].loc[row],
-                    "bollinger_lower": entries['BB_lower'].loc[row],
-                    "rsi": entries["RSI"].loc[row]
-                }
-            },
-            "oversold_MACD": {
-                "status": bool(entries['Signal_RSI_STOCH_MACD'].loc[row]),
-                "values": {
-                    "rsi": entries["RSI"].loc[row],
-                    "stochastic_d": entries["STOCH_D"].loc[row],
-                    "macd": entries['MACD_histogram'].loc[row]
-                }
-            },
-        }
-    return data
+    return nest_entries(entry_columns(entries))
 
 
-def plotting_data_entries(database: SP500Database, tickers: list) -> dict:
-    data = {}
-    for ticker in tickers:
-        df = database.query_ticker_data(ticker)
-        data[ticker] = {
-            "index": list(df['Date']),
-            "Closes": list(df['Close']),
-            "MA20": list(df['MA20']),
-            "MA50": list(df['MA50'])
+def plotting_data_entries(database: SP500Database, tickers: list, start: str = None, end: str = None,
+                          points: int = None) -> dict:
+    """
+    Close, MA20 and MA50 of `tickers`, all loaded with a single query
+    :param start: first date returned if set
+    :param end: date the series stop at (excluded) if set
+    :param points: number of points each series is downsampled to (LTTB on the closes), every point is kept if
+                   not set
+    """
+    df = database.query_tickers_columns(tickers, ["Close", "MA20", "MA50"], start=start, end=end)
+    ticker_column, dates = df['Ticker'].to_numpy(), df['Date'].to_numpy()
+    closes, ma20, ma50 = (df[col].to_numpy() for col in ("Close", "MA20", "MA50"))
+    # rows are ordered by ticker, each ticker is a contiguous slice
+    bounds = [0, *(flatnonzero(ticker_column[1:] != ticker_column[:-1]) + 1), len(df)]
+
+    series = {}
+    for start_row, stop_row in zip(bounds[:-1], bounds[1:]):
+        if start_row == stop_row:
+            continue
+        rows = arange(start_row, stop_row)
+        if points is not None:
+            rows = rows[lttb_indices(closes[start_row:stop_row], points)]
+        series[ticker_column[start_row]] = {
+            "index": dates[rows].tolist(),
+            "Closes": closes[rows].tolist(),
+            "MA20": ma20[rows].tolist(),
+            "MA50": ma50[rows].tolist()
         }
-    return data
+    return {ticker: series[ticker] for ticker in tickers if ticker in series}
 
 
 def plotting_data_breadth(database: SP500Database) -> dict:
@@ -110,18 +155,31 @@ def plotting_data_breadth(database: SP500Database) -> dict:
     }
 
 
-def market_status_to_dict() -> dict:
+def market_status_to_dict(sp500_database: SP500Database = None, provider: MarketDataProvider = None) -> dict:
     """
     Executes all utility functions for API data and puts them all together in a dictionary
+    :param sp500_database: database the data is read from, `sp500.sqlite` if not set
+    :param provider: source of the S&P 500 index bars, see `SP500Analysis`
     """
-    sp500_database = SP500Database()
-    sp500_database.connect_existing_database(db_path / "sp500.sqlite")
-    market_analysis = SP500Analysis(sp500_database)
-    market_analysis.sefi()
-    market_analysis.adr_analysis()
-    dates = sp500_database.query_all_dates()
-    df = sp500_database.query_from_date_to_dataframe(dates[-1])
-    entries = parse_entries(get_entries_from_indicators(df))
+    if sp500_database is None:
+        sp500_database = connect_sp500()
+    with span("cvi_stored"):
+        # brought up to date by `populate_sp500`, only read here
+        cvi = CVI(sp500_database).stored()
+    # the memory-mapped copy serves the read queries when it holds the same data, sqlite otherwise
+    with span("columnar_open"):
+        sp500_database = ColumnarStore.open(sp500_database) or sp500_database
+    market_analysis = SP500Analysis(sp500_database, provider=provider)
+    with span("sefi"):
+        market_analysis.sefi()
+    with span("adr_analysis"):
+        market_analysis.adr_analysis()
+    with span("entries"):
+        dates = sp500_database.query_all_dates()
+        df = sp500_database.query_from_date_to_dataframe(dates[-1])
+        entries = parse_entries(get_entries_from_indicators(df))
+    with span("breadth_plotting"):
+        breadth = plotting_data_breadth(sp500_database)
 
     data = {"market_breadth": {
         'is_entry': bool(get_market_breadth_status(market_analysis)),
@@ -137,64 +195,69 @@ def market_status_to_dict() -> dict:
             "long": bool(market_analysis.sp500['ADR Signal Long'].iloc[-1]),
         },
 
+        "CVI": {
+            "value": int(cvi['CVI'].iloc[-1]) if len(cvi) else None
+        },
+
         "strategies": {
-            "good_SEFI_oversold": bool(vectorize(TickerStrategy.good_sefi_oversold)(market_analysis.sp500['SEFI'],
-                                                                                    market_analysis.sp500['RSI'],
-                                                                                    market_analysis.sp500['BB_lower'],
-                                                                                    market_analysis.sp500['Close'])[-1])
+            "good_SEFI_oversold": bool(evaluate_strategies(market_analysis.sp500,
+                                                           MARKET_STRATEGIES)['good_SEFI_oversold'].iloc[-1])
         }
 
     }, 'entries': entries,
 
         "plotting": {
             # "entries": plotting_data(sp500_database, [ticker for ticker in entries])
-            "breadth": plotting_data_breadth(sp500_database)
+            "breadth": breadth
         }
 
     }
     return data
 
 
-def parse_last_request(database: SP500Database, request_on_none: bool) -> tuple or None:
-    last_request = database.get_last_api_request()
-    if not last_request:
-        if request_on_none:
-            data = market_status_to_dict()
-            database.insert_api_data(str(datetime.now().strftime("%Y-%m-%d %H:%M:%S")), data)
-            parse_last_request(database, False)
-        else:
-            return
-    dtime = last_request['Datetime']
-    data = last_request['Data']
-    return dtime, data
+def request_market_status() -> dict:
+    """
+    `market_status_to_dict` of the request paths, the index bars are read from the cache only. Raises
+    `IndexDataUnavailable` until the refresher cached them
+    """
+    return market_status_to_dict(provider=CachingProvider(offline=True))
 
 
 def general_market_data_request():
     """
-    Checks if the market is open and if it is it will update the database with last minute data and store
-    the result, which will be reused for the next requests until market is open again. If the market is open
-    this will simply download last minute data and run the strategies as it normally would.
+    Returns the last snapshot published by the background refresher (`manage.py refresh_market_data`), decoded once
+    per trading session and snapshot version. A request never downloads nor recomputes data, a snapshot is only
+    built here from the database and the cached bars when none was ever published.
     """
-    sp500_database = SP500Database()
-    sp500_database.connect_existing_database(db_path / "sp500.sqlite")
-    current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    current_datetime = datetime.strptime(current_datetime, "%Y-%m-%d %H:%M:%S")
-    dtime, data = parse_last_request(sp500_database, True)
-    dtime = datetime.strptime(dtime, "%Y-%m-%d %H:%M:%S")
-    year, month, day, hour, minute, _, _, _, _ = current_datetime.timetuple()
-    req_year, req_month, req_day, req_hour, req_minute, _, _, _, _ = dtime.timetuple()
-    is_weekend = True if current_datetime.weekday() in [5, 6] else False
-    is_afterhours = True if hour >= 16 or (hour < 9) else False
-    if is_weekend or is_afterhours:
-        if [req_year, req_month, req_day] == [year, month, day] or 1 == 1:
-            _, data = parse_last_request(sp500_database, True)
-            return json.loads(data)
-        else:
-            data = market_status_to_dict()
-            sp500_database.insert_api_data(str(current_datetime), data)
-            return data
-    else:
-        populate_sp500(sp500_database, update=True)
-        return market_status_to_dict()
+    sp500_database = connect_sp500()
+    return snapshots.latest(sp500_database, request_market_status, recompute_stale=False)
+
+
+def chart_data_request(tickers: list, start: str = None, end: str = None, points: int = None) -> dict:
+    """Chart series of `tickers`, see `plotting_data_entries`"""
+    sp500_database = connect_sp500()
+    sp500_database = ColumnarStore.open(sp500_database) or sp500_database
+    with span("chart_data"):
+        return plotting_data_entries(sp500_database, tickers, start=start, end=end, points=points)
+
+
+def general_market_data_snapshot(entries_format: str = "nested") -> EncodedSnapshot:
+    """
+    Same snapshot as `general_market_data_request`, as the stored JSON bytes
+    :param entries_format: "columnar" sends the entries as arrays per field (`entry_columns`), that form is built
+                           once per snapshot
+    """
+    if entries_format not in ENTRY_FORMATS:
+        raise ValueError(f"Unknown entries format: {entries_format}")
+    sp500_database = connect_sp500()
+    with span("snapshot"):
+        snapshot = snapshots.latest_encoded(sp500_database, request_market_status, recompute_stale=False)
+    if entries_format == "nested":
+        return snapshot
 
+    def columnar() -> EncodedSnapshot:
+        data = json.loads(snapshot.data)
+        data['entries'] = columnar_entries(data['entries'])
+        return EncodedSnapshot(snapshot.snapshot_id, json.dumps(data).encode())
 
+    return snapshots.cache.get_or_compute((entries_format, snapshot.snapshot_id), columnar)
@@ -0,0 +1,180 @@
+import contextlib
+import io
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import zlib
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Dict, List, Union
+import numpy as np
+import pandas
+from pandas import DataFrame, DatetimeIndex
+from base.api.market_data.classes.analysis import SP500Analysis
+from base.api.market_data.classes.databases import SP500Database
+from base.api.market_data.classes.dataframe import EnhancedDataframe
+from base.api.market_data.classes.fetchers import FileProvider, GeneralMarketDataFetcher
+from base.api.market_data.classes.indicators import CVI, compute_adx
+from base.api.market_data.classes.market_calendar import MarketCalendar, NYSE
+from base.api.market_data.api_requests import market_status_to_dict
+from base.api.market_data.database_functions import populate_sp500
+
+"""
+Offline benchmarks of the market data pipeline on a synthetic universe with the tickers of `sp500.csv`.
+
+Bars are random walks seeded by the ticker name, a run on the same arguments always sees the same data. Results are
+written as JSON (timings and the commit they were measured on) to compare runs across commits.
+"""
+
+
+@dataclass
+class SyntheticProvider(FileProvider):
+    """
+    Deterministic daily bars for any ticker, `days` sessions of `calendar` up to `end`, served like csv files
+    :param seed: changes every series
+    """
+    directory: Union[str, Path] = None
+    days: int = 2520
+    end: date = date(2022, 12, 30)
+    seed: int = 0
+    calendar: MarketCalendar = NYSE
+
+    def __post_init__(self) -> None:
+        last = self.end if self.calendar.is_trading_day(self.end) else self.calendar.previous_trading_day(self.end)
+        sessions = [last]
+        while len(sessions) < self.days:
+            sessions.append(self.calendar.previous_trading_day(sessions[-1]))
+        self.sessions = DatetimeIndex(sessions[::-1], name="Date")
+        self.read = lru_cache(maxsize=None)(self.generate)
+
+    def exists(self, ticker: str) -> bool:
+        return True
+
+    def generate(self, ticker: str) -> DataFrame:
+        rng = np.random.default_rng([self.seed, zlib.crc32(ticker.encode())])
+        closes = rng.uniform(20, 500) * np.exp(np.cumsum(rng.normal(0.0003, 0.02, self.days)))
+        opens = closes * (1 + rng.normal(0, 0.005, self.days))
+        return DataFrame({
+            "Open": opens,
+            "High": np.maximum(opens, closes) * (1 + rng.uniform(0, 0.015, self.days)),
+            "Low": np.minimum(opens, closes) * (1 - rng.uniform(0, 0.015, self.days)),
+            "Close": closes,
+            "Adj Close": closes,
+            "Volume": rng.integers(100_000, 20_000_000, self.days).astype(float),
+        }, index=self.sessions)
+
+
+@dataclass
+class Benchmark:
+    """
+    :param run: the timed call, takes the value returned by `setup`
+    :param setup: untimed preparation before each run
+    """
+    name: str
+    run: Callable
+    setup: Callable = lambda: None
+
+    def measure(self, repeat: int) -> dict:
+        runs = []
+        for _ in range(repeat):
+            state = self.setup()
+            # the pipeline prints its progress, it is left out of the output
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                self.run(state)
+                runs.append(time.perf_counter() - start)
+        return {"min": min(runs), "median": statistics.median(runs), "runs": runs}
+
+
+@dataclass
+class BenchmarkSuite:
+    """
+    Runs the benchmarks in a temporary directory, `populate_sp500` builds the database the other benchmarks read
+    :param sample: number of tickers the single ticker benchmarks (populate_dataframe, compute_adx) loop over
+    """
+    days: int = 2520
+    sample: int = 20
+    repeat: int = 3
+    seed: int = 0
+    results: Dict[str, dict] = field(default_factory=dict)
+
+    def benchmarks(self, provider: SyntheticProvider, database: SP500Database) -> List[Benchmark]:
+        sample = GeneralMarketDataFetcher().tickers[:self.sample]
+
+        def analysis() -> SP500Analysis:
+            market_analysis = SP500Analysis(database, provider=provider)
+            market_analysis.sefi()
+            return market_analysis
+
+        return [
+            Benchmark("populate_sp500_rebuild", lambda _: populate_sp500(database, update=False, provider=provider)),
+            Benchmark("populate_sp500_update", lambda _: populate_sp500(database, update=True, provider=provider)),
+            Benchmark("populate_dataframe",
+                      lambda frames: [EnhancedDataframe.populate_dataframe(frame, ticker) for ticker, frame in frames],
+                      setup=lambda: [(ticker, provider.read(ticker).copy()) for ticker in sample]),
+            Benchmark("compute_adx", lambda frames: [compute_adx(frame) for frame in frames],
+                      setup=lambda: [provider.read(ticker).copy() for ticker in sample]),
+            Benchmark("sefi", lambda _: SP500Analysis(database, provider=provider).sefi()),
+            Benchmark("adr_analysis", lambda market_analysis: market_analysis.adr_analysis(), setup=analysis),
+            Benchmark("cvi", lambda _: CVI(database).data),
+            Benchmark("market_status_to_dict", lambda _: market_status_to_dict(database, provider=provider)),
+        ]
+
+    def run(self) -> dict:
+        provider = SyntheticProvider(days=self.days, seed=self.seed)
+        with tempfile.TemporaryDirectory() as directory:
+            database = SP500Database()
+            database.connect_existing_database(Path(directory) / "sp500.sqlite")
+            for create in (database.create_table_historical, database.create_table_api_data,
+                           database.create_table_cvi, database.create_table_indicator_state):
+                create()
+            for benchmark in self.benchmarks(provider, database):
+                self.results[benchmark.name] = benchmark.measure(self.repeat)
+                print(f"{benchmark.name:<24}{self.results[benchmark.name]['min']:>10.3f}s")
+            database.connection.close()
+        return self.report()
+
+    def report(self) -> dict:
+        return {
+            "meta": {
+                "commit": current_commit(),
+                "timestamp": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "pandas": pandas.__version__,
+                "tickers": len(GeneralMarketDataFetcher().tickers),
+                "days": self.days,
+                "seed": self.seed,
+                "repeat": self.repeat,
+            },
+            "results": self.results,
+        }
+
+
+def current_commit() -> str or None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: dict, current: dict) -> List[str]:
+    """One line per benchmark with the ratio of the current to the baseline best time, > 1 is slower"""
+    lines = [f"{'benchmark':<24}{baseline['meta']['commit'] or 'baseline':>12}"
+             f"{current['meta']['commit'] or 'current':>12}{'ratio':>8}"]
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before, after = baseline["results"][name]["min"], result["min"]
+        lines.append(f"{name:<24}{before:>11.3f}s{after:>11.3f}s{after / before:>8.2f}")
+    return lines
+
+
+def write_results(results: dict, path: Union[str, Path]) -> None:
+    Path(path).write_text(json.dumps(results, indent=2))
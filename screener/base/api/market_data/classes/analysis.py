@@ -1,12 +1,13 @@
-import numpy as np
-from numpy import array as np_array
 import datetime
+from bisect import bisect_left
 from typing import Union, List
 from pandas import DataFrame
 from abc import abstractmethod
 from base.api.market_data.classes.databases import SP500Database, Database
-from base.api.market_data.classes.indicators import Sefi
-from base.api.market_data.classes.fetchers import GeneralMarketDataFetcher
+from base.api.market_data.classes.breadth import BreadthPanel
+from base.api.market_data.classes.raw_bars import CachingProvider
+from base.api.market_data.classes.fetchers import MarketDataProvider
+from base.api.market_data.classes.profiling import span
 from base.api.market_data.classes.dataframe import EnhancedDataframe
 from base.api.market_data.classes.indicators import ADR, adr_signals_long, adr_signals_short
 
@@ -27,6 +28,10 @@ are acting overall.
 """
 
 
+class IndexDataUnavailable(Exception):
+    """Raised when the provider has no bars of the index over the dates of the database"""
+
+
 class MarketBreadthAnalysis:
 
     @staticmethod
@@ -91,62 +96,47 @@ class SP500Analysis(MarketBreadthAnalysis):
     def advancing_volume_index(self) -> List[int]:
         ...
 
-    def __init__(self, market_data: SP500Database):
+    def __init__(self, market_data: SP500Database, compact: bool = False, provider: MarketDataProvider = None):
+        """
+        :param compact: keeps the breadth panel in float32 (see `EnhancedDataframe.compact`)
+        :param provider: source of the S&P 500 index bars, the local `CachingProvider` if not set
+        """
         self.sp500 = None
         self.dates = None
+        self.panel = None
         self.market_data = market_data
+        self.compact = compact
+        self.provider = provider
 
     def sefi(self, ma_column='MA20') -> DataFrame:
         self.dates = self.market_data.query_all_dates()
 
-        self.sp500 = GeneralMarketDataFetcher.oex_download_data(start=self.dates[0], end=self.dates[-1])
+        provider = self.provider or CachingProvider()
+        with span("index_history"):
+            self.sp500 = provider.index_history("^GSPC", start=self.dates[0], end=self.dates[-1])
+        if self.sp500.empty:
+            # an offline provider (request paths) before the refresher cached the index
+            raise IndexDataUnavailable(f"No ^GSPC bars from {self.dates[0]} to {self.dates[-1]}")
         self.sp500 = EnhancedDataframe.populate_dataframe(self.sp500, "SPX")
         self.sp500['Change'] = (self.sp500['Close'].pct_change(1) * 100).cumsum()
 
-        # TODO  refactor this code ASAP
-        results = []
-        for date in self.sp500.index:
-            dataframe = self.market_data.query_from_date_to_dataframe(date)
-            dataframe['SEFI'] = Sefi(dataframe['Close'], dataframe[ma_column]).data
-
-            try:
-                results.append(len(dataframe[dataframe["SEFI"] == 0]) / len(dataframe))
-            except ZeroDivisionError as e:
-                print(f"len dataframe where sefi is 0: {len(dataframe[dataframe['SEFI'] == 0])}")
-                print(f"len dataframe: {len(dataframe)}")
-                print(f"date: {date}")
-                results.append(0)
-
-        assert len(results) == len(self.sp500)
-        self.sp500['SEFI'] = np_array(results) * 100
-
-        def sefi_signal_long(sefi):
-            if sefi >= 75:
-                return True
-            return False
-
-        def sefi_signal_short(sefi):
-            if sefi <= 25:
-                return True
-            return False
-
-        self.sp500['SEFI Signal Long'] = np.vectorize(sefi_signal_long)(self.sp500["SEFI"])
-
-        self.sp500["SEFI Signal Short"] = np.vectorize(sefi_signal_short)(self.sp500['SEFI'])
+        if self.panel is None:
+            with span("breadth_panel"):
+                self.panel = BreadthPanel(self.market_data, compact=self.compact)
+        self.sp500['SEFI'] = self.panel.percent_below(ma_column, dates=self.sp500.index).to_numpy()
+        self.sp500['SEFI Signal Long'] = (self.sp500['SEFI'] >= 75).to_numpy()
+        self.sp500["SEFI Signal Short"] = (self.sp500['SEFI'] <= 25).to_numpy()
         return self.sp500
 
     def adr_analysis(self) -> DataFrame:
-        adr = ADR(market_data=self.market_data)
-        # TODO
-
         self.sp500.rename(columns={"Adjusted Close": "Adjusted_Close"}, inplace=True)
-        adr_data = adr.data
-        if not len(self.sp500) == len(adr_data):
-            adr_data = adr_data[-len(self.sp500):]
-        self.sp500["ADR"] = adr_data
-        self.sp500['ADR Signal Long'] = np.vectorize(adr_signals_long)(self.sp500["ADR"], self.sp500['Close'],
-                                                                       self.sp500["MA100"], self.sp500["MA20"])
-        self.sp500['ADR Signal Short'] = np.vectorize(adr_signals_short)(self.sp500["ADR"], self.sp500['Close'],
-                                                                         self.sp500["MA100"], self.sp500["MA20"])
+        # only the dates of the index are computed, dates the database doesn't hold are left undefined
+        dates = [str(date) for date in self.sp500.index]
+        first = bisect_left(self.dates, dates[0]) if dates else len(self.dates)
+        adr = ADR(market_data=self.market_data, since=self.dates[first - 1] if first else None)
+        self.sp500["ADR"] = adr.ad_ratio_frame().set_index("Date")["ADR"].reindex(dates).to_numpy()
+        adr, close, ma100, ma20 = (self.sp500[col].to_numpy() for col in ("ADR", "Close", "MA100", "MA20"))
+        self.sp500['ADR Signal Long'] = adr_signals_long(adr, close, ma100, ma20)
+        self.sp500['ADR Signal Short'] = adr_signals_short(adr, close, ma100, ma20)
 
         return self.sp500
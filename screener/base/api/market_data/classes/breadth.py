@@ -0,0 +1,35 @@
+from dataclasses import dataclass, field
+from typing import List, Iterable
+from pandas import DataFrame, Series
+from base.api.market_data.classes.databases import SP500Database
+from base.api.market_data.classes.dataframe import EnhancedDataframe, to_day_numbers
+
+
+@dataclass
+class BreadthPanel:
+    """
+    Cross-sectional view of the historical table, loaded once with a single query and shared by every breadth
+    computation instead of querying the database date by date
+    :param compact: keeps the panel as `EnhancedDataframe.compact` does (float32 columns, int32 day numbers)
+    """
+    market_data: SP500Database
+    columns: List[str] = field(default_factory=lambda: ["Close", "MA20", "MA50", "MA100"])
+    compact: bool = False
+
+    def __post_init__(self) -> None:
+        self.data: DataFrame = self.market_data.query_historical_columns(self.columns)
+        if self.compact:
+            self.data = EnhancedDataframe.compact(self.data)
+
+    def percent_below(self, ma_column: str = "MA20", dates: Iterable = None) -> Series:
+        """
+        Percentage of stocks closing at or below `ma_column` for each date (SEFI)
+        :param ma_column: moving average column (MA20, MA50, MA100)
+        :param dates: dates to align the result to, dates without data are set to 0
+        """
+        below = ~(self.data["Close"] > self.data[ma_column])
+        percent = below.groupby(self.data["Date"], sort=False).mean()
+        if dates is not None:
+            dates = to_day_numbers(dates) if self.compact else [str(date) for date in dates]
+            percent = percent.reindex(dates, fill_value=0)
+        return percent * 100
@@ -0,0 +1,209 @@
+import json
+import os
+import shutil
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+import numpy as np
+from pandas import DataFrame
+from base.api.market_data.classes.databases import SP500Database
+
+"""
+Read only columnar copy of the historical table.
+
+Each column is stored as a (date x ticker) float64 `.npy` file and opened memory-mapped, so a cross section (one
+date) is a contiguous row and a time series (one ticker) a strided column, both views without copies. Missing
+(date, ticker) pairs hold NaN and are left out of the `present` mask. The store is exported from `SP500Database`
+into a new version directory and published by atomically replacing the `CURRENT` pointer, readers keep the version
+they opened. A version records the write counter of the historical table it was exported from
+(`SP500Database.historical_version`), it is only served while the table holds the same data.
+"""
+
+
+@dataclass
+class ColumnarStore:
+    directory: Union[str, Path]
+
+    columns = SP500Database.columns
+    value_columns = [str(col) for col in SP500Database.columns if col not in SP500Database.str_cols]
+
+    def __post_init__(self) -> None:
+        self.directory = Path(self.directory)
+        self.meta: dict = json.loads((self.directory / "meta.json").read_text())
+        self.dates: np.ndarray = np.load(self.directory / "dates.npy")
+        self.tickers: np.ndarray = np.load(self.directory / "tickers.npy")
+        self._arrays: Dict[str, np.ndarray] = {}
+        self._ticker_index = {ticker: i for i, ticker in enumerate(self.tickers.tolist())}
+
+    def column(self, name: str) -> np.ndarray:
+        """(date x ticker) memory-mapped array of column `name`"""
+        if name not in self._arrays:
+            if name not in self.value_columns:
+                raise ValueError(f"Unknown historical column: {name}")
+            self._arrays[name] = np.load(self.directory / f"{name}.npy", mmap_mode="r")
+        return self._arrays[name]
+
+    @property
+    def present(self) -> np.ndarray:
+        """(date x ticker) mask of the rows of the historical table"""
+        if "present" not in self._arrays:
+            self._arrays["present"] = np.load(self.directory / "present.npy", mmap_mode="r")
+        return self._arrays["present"]
+
+    @staticmethod
+    def store_path(database: SP500Database) -> Path:
+        return Path(f"{database.db_path}.columnar")
+
+    @classmethod
+    def export(cls, database: SP500Database, directory: Union[str, Path] = None, keep: int = 2,
+               base: "ColumnarStore" = None, since: str = None) -> "ColumnarStore":
+        """
+        Writes the historical table of `database` as a new version of the store and publishes it
+        :param directory: store location, next to the database file if not set
+        :param keep: number of versions kept on disk, older ones are removed
+        :param base: store in sync with `database` before its rows from `since` on were written. Only those rows are
+                     read from sqlite, the older ones are copied from `base`
+        :param since: first date written since `base` was exported
+        """
+        directory = Path(directory or cls.store_path(database))
+        version = directory / f"v{time.time_ns()}"
+        version.mkdir(parents=True)
+
+        # read before the rows, a write in between leaves the new version out of date instead of wrong
+        data_version = database.historical_version()
+        if base is None or since is None:
+            base, since = None, None
+        data = database.query_historical_columns(cls.value_columns, since=since)
+        head = base.dates < str(since) if base is not None else np.zeros(0, dtype=bool)
+        dates, date_index = np.unique(data['Date'].to_numpy(dtype=str), return_inverse=True)
+        tickers, ticker_index = np.unique(data['Ticker'].to_numpy(dtype=str), return_inverse=True)
+        if base is not None:
+            # the dates of the copied rows all come before the new ones
+            date_index += int(head.sum())
+            dates = np.concatenate([base.dates[head], dates])
+            tickers = np.union1d(base.tickers, tickers)
+            ticker_index = np.searchsorted(tickers, data['Ticker'].to_numpy(dtype=str))
+            base_tickers = np.searchsorted(tickers, base.tickers)
+
+        def stored(values: np.ndarray, base_values: np.ndarray = None) -> np.ndarray:
+            array = np.full((len(dates), len(tickers)), False if values.dtype == bool else np.nan, dtype=values.dtype)
+            if base_values is not None:
+                array[:len(base_values), base_tickers] = base_values
+            array[date_index, ticker_index] = values
+            return array
+
+        np.save(version / "dates.npy", dates)
+        np.save(version / "tickers.npy", tickers)
+        present = stored(np.ones(len(data), dtype=bool), base.present[head] if base is not None else None)
+        np.save(version / "present.npy", present)
+        for col in cls.value_columns:
+            np.save(version / f"{col}.npy", stored(data[col].to_numpy(dtype=float),
+                                                   base.column(col)[head] if base is not None else None))
+        (version / "meta.json").write_text(json.dumps({"version": data_version, "rows": int(present.sum()),
+                                                       "latest_date": str(dates[-1]) if len(dates) else None}))
+
+        pointer = directory / f"CURRENT.{os.getpid()}"
+        pointer.write_text(version.name)
+        os.replace(pointer, directory / "CURRENT")
+
+        versions = sorted(path for path in directory.iterdir() if path.is_dir() and path.name.startswith("v"))
+        for old in versions[:-keep]:
+            shutil.rmtree(old, ignore_errors=True)
+        return cls(version)
+
+    @classmethod
+    def open(cls, database: SP500Database, directory: Union[str, Path] = None) -> "ColumnarStore" or None:
+        """Current version of the store if it was exported from the current version of `database`, None otherwise"""
+        directory = Path(directory or cls.store_path(database))
+        try:
+            store = cls(directory / (directory / "CURRENT").read_text())
+        except FileNotFoundError:
+            return None
+        data_version = database.historical_version()
+        if data_version is None or store.meta.get("version") != data_version:
+            return None
+        return store
+
+    def date_position(self, date: str) -> int:
+        position = int(np.searchsorted(self.dates, str(date)))
+        if position == len(self.dates) or self.dates[position] != str(date):
+            raise KeyError(date)
+        return position
+
+    def rows(self, date_positions: np.ndarray, ticker_positions: np.ndarray, columns: List[str]) -> DataFrame:
+        data = {"Date": self.dates[date_positions], "Ticker": self.tickers[ticker_positions]}
+        for col in columns:
+            values = self.column(col)[date_positions, ticker_positions]
+            data[col] = values.astype(np.int64) if col in SP500Database.int_cols else values
+        return DataFrame(data, columns=["Date", "Ticker"] + columns)
+
+    # Same interface as `SP500Database` for the read paths
+
+    def query_all_dates(self) -> List[str]:
+        return self.dates.tolist()
+
+    def get_latest_date(self) -> str:
+        return str(self.dates[-1])
+
+    def get_date_before_latest_date(self) -> str:
+        return str(self.dates[-2])
+
+    def query_from_date_to_dataframe(self, date: str) -> DataFrame:
+        try:
+            position = self.date_position(date)
+        except KeyError:
+            return DataFrame(columns=list(self.columns))
+        tickers = np.flatnonzero(self.present[position])
+        return self.rows(np.full(len(tickers), position), tickers, self.value_columns)[list(self.columns)]
+
+    def query_ticker_data(self, ticker: str) -> DataFrame:
+        if ticker not in self._ticker_index:
+            return DataFrame(columns=list(self.columns))
+        position = self._ticker_index[ticker]
+        dates = np.flatnonzero(self.present[:, position])
+        return self.rows(dates, np.full(len(dates), position), self.value_columns)[list(self.columns)]
+
+    def query_historical_columns(self, columns: List[str]) -> DataFrame:
+        columns = [col for col in columns if col not in ("Date", "Ticker")]
+        invalid = [col for col in columns if col not in self.value_columns]
+        if invalid:
+            raise ValueError(f"Unknown historical columns: {invalid}")
+        dates, tickers = np.nonzero(self.present)
+        return self.rows(dates, tickers, columns)
+
+    def query_tickers_columns(self, tickers: List[str], columns: List[str], start: str = None,
+                              end: str = None) -> DataFrame:
+        columns = [col for col in columns if col not in ("Date", "Ticker")]
+        invalid = [col for col in columns if col not in self.value_columns]
+        if invalid:
+            raise ValueError(f"Unknown historical columns: {invalid}")
+        # `self.tickers` is sorted, so are the positions of the tickers sorted by name
+        positions = np.array(sorted({self._ticker_index[ticker] for ticker in tickers if ticker in self._ticker_index}),
+                             dtype=np.int64)
+        first = int(np.searchsorted(self.dates, str(start))) if start is not None else 0
+        last = int(np.searchsorted(self.dates, str(end))) if end is not None else len(self.dates)
+        # (ticker, date) ordered like the sql query
+        ticker_rows, dates = np.nonzero(self.present[first:last, positions].T)
+        return self.rows(dates + first, positions[ticker_rows], columns)
+
+    def since_mask(self, since: str = None) -> np.ndarray:
+        return self.dates > str(since) if since is not None else np.ones(len(self.dates), dtype=bool)
+
+    def query_advance_decline(self, since: str = None) -> DataFrame:
+        mask = self.since_mask(since)
+        change = self.column("Change")[mask]
+        return DataFrame({"Date": self.dates[mask], "Advancing": (change > 0).sum(axis=1),
+                          "Declining": (change <= 0).sum(axis=1)})
+
+    def query_volume_breadth(self, since: str = None) -> DataFrame:
+        mask = self.since_mask(since)
+        volume_change = self.column("Volume_Change")[mask]
+        return DataFrame({"Date": self.dates[mask],
+                          "Net_Volume": (volume_change > 0).sum(axis=1) - (volume_change < 0).sum(axis=1)})
+
+    def query_breadth_specifics(self) -> Tuple[list, list]:
+        changes, volume_changes = self.column("Change")[-1], self.column("Volume_Change")[-1]
+        tickers = np.flatnonzero(self.present[-1])
+        names = self.tickers[tickers].tolist()
+        return list(zip(names, changes[tickers].tolist())), list(zip(names, volume_changes[tickers].tolist()))
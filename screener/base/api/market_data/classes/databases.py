@@ -1,15 +1,20 @@
 from pandas import read_sql, DataFrame
 import numpy as np
-from screener.base.api.market_data.classes.fetchers import GeneralMarketDataFetcher
+from base.api.market_data.classes.fetchers import GeneralMarketDataFetcher
+from base.api.market_data.classes.profiling import profiling
 from cython import cfunc
 import json
+import os
 import sqlite3
+import threading
+import time
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from pathlib import Path
 from sqlite3 import Connection, Cursor, connect, Row
 from enum import Enum
-from dataclasses import dataclass
-from typing import List, Union, Iterator
+from dataclasses import dataclass, field
+from typing import ClassVar, List, Union, Iterator, Dict, Tuple
 
 
 numeric = Union[int, float]
@@ -81,6 +86,24 @@ class ColumnAttributeError(Exception):
 
 
 
+@dataclass
+class Index:
+    """Index on one or more columns of a table, named after them when no name is given"""
+    table_name: str
+    columns: List[str]
+    unique: bool = False
+    name: str = None
+
+    def __post_init__(self) -> None:
+        if not self.name:
+            self.name = f"idx_{self.table_name}_{'_'.join(col.lower() for col in self.columns)}"
+
+    @property
+    def stmt(self) -> str:
+        return f"""CREATE {'UNIQUE ' if self.unique else ''}INDEX IF NOT EXISTS {self.name}
+                   ON {self.table_name} ({', '.join(self.columns)})"""
+
+
 @dataclass
 class Table:
     table_name: str
@@ -98,21 +121,137 @@ class Table:
 
 
 
+@dataclass
+class BulkLoadReport:
+    rows: int = 0
+    seconds: float = 0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0
+
+    def __str__(self) -> str:
+        return f"Loaded {self.rows} rows in {self.seconds:.2f}s ({self.rows_per_second:.0f} rows/s)"
+
+
+@dataclass
+class UpsertReport:
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    # first date of the upserted rows when some were written, the values derived from the dates after it change
+    earliest: str = None
+
+    def __str__(self) -> str:
+        return f"Inserted {self.inserted} rows, updated {self.updated} rows, {self.unchanged} rows unchanged"
+
+
+@dataclass
+class ConnectionPool:
+    """
+    Connections of the threads of a process to one database file: each thread reads through its own connection and
+    writes go through a single connection, one writer at a time. The file is switched to WAL journaling, readers
+    never wait for the writer and see the last committed data
+    :param cached_statements: prepared statements kept by each connection, the queries are built from the same
+                              strings on every call and are only compiled once per connection
+    :param timeout: seconds a write waits for the lock of another process
+    """
+    db_path: Union[str, Path]
+    cached_statements: int = 256
+    timeout: float = 30.
+
+    _pools: ClassVar[Dict[Tuple[int, str], "ConnectionPool"]] = {}
+    _pools_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __post_init__(self) -> None:
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        self._writer = self.connect(check_same_thread=False)
+        self._writer.execute("PRAGMA journal_mode = WAL")
+        self._writer.execute("PRAGMA synchronous = NORMAL")
+
+    @classmethod
+    def shared(cls, db_path: Union[str, Path]) -> "ConnectionPool":
+        """Pool of `db_path` shared by the callers of the process, connections are never inherited by a fork"""
+        key = (os.getpid(), str(db_path))
+        with cls._pools_lock:
+            if key not in cls._pools:
+                cls._pools[key] = cls(db_path)
+            return cls._pools[key]
+
+    def connect(self, check_same_thread: bool = True) -> Connection:
+        connection = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=check_same_thread,
+                                     cached_statements=self.cached_statements, factory=profiling.connection_factory)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def reader(self) -> Connection:
+        """Connection of the calling thread, opened on its first call"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self.connect()
+        return connection
+
+    @contextmanager
+    def writer(self) -> Iterator[Connection]:
+        """
+        The write connection, held by the calling thread for the duration of the block. An uncommitted transaction
+        is rolled back when the block raises
+        """
+        with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                self._writer.rollback()
+                raise
+
+    @property
+    def writer_connection(self) -> Connection:
+        return self._writer
+
+
 @dataclass
 class Database(ABC):
     path: Union[str, Path] = None
     filename: str = None
     extension: str = None
     db_path: Union[str, Path] = None
-    _tablenames = []
+    _tablenames: List[str] = field(default_factory=list)
     _connection: Connection = None
     _cursor: Cursor = None
+    _bulk_load: BulkLoadReport = None
+    _pool: ConnectionPool = None
 
     def connect_existing_database(self, db_path) -> None:
-        self._connection = sqlite3.connect(db_path)
+        self.db_path = db_path
+        self._connection = sqlite3.connect(db_path, factory=profiling.connection_factory)
         self._connection.row_factory = sqlite3.Row
         self._cursor = self._connection.cursor()
 
+    def connect_pool(self, pool: ConnectionPool) -> None:
+        """Reads through the connection of the calling thread in `pool`, see `writing` for the writes"""
+        self.db_path = pool.db_path
+        self._pool = pool
+        self._connection = pool.reader()
+        self._cursor = self._connection.cursor()
+
+    @contextmanager
+    def writing(self) -> Iterator[None]:
+        """
+        Runs the block on the write connection of the pool the database is connected to, the other writers of the
+        process wait for the block to end. Nothing changes for a database connected without a pool
+        """
+        if self._pool is None or self._connection is self._pool.writer_connection:
+            yield
+            return
+        with self._pool.writer() as connection:
+            reader = self._connection, self._cursor
+            self._connection, self._cursor = connection, connection.cursor()
+            try:
+                yield
+            finally:
+                self._connection, self._cursor = reader
+
     def create_database_file(self, path, filename, extension) -> None:
         self.path = path
         self.filename = filename
@@ -123,7 +262,7 @@ class Database(ABC):
             f.write("")
 
     def establish_connection(self) -> None:
-        self._connection = connect(self.db_path)
+        self._connection = connect(self.db_path, factory=profiling.connection_factory)
         self._cursor = self._connection.cursor()
 
     @staticmethod
@@ -143,6 +282,16 @@ class Database(ABC):
                       """
         return stmt
 
+    def create_indexes(self, indexes: List[Index]) -> None:
+        """Creates the missing `indexes`, existing ones are left untouched"""
+        for index in indexes:
+            self._cursor.execute(index.stmt)
+        self.commit()
+
+    def missing_indexes(self, indexes: List[Index]) -> List[Index]:
+        names = {row[0] for row in self._cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        return [index for index in indexes if index.name not in names]
+
     @staticmethod
     def dynamic_table_columns_create(columns: List[Column]):
         stmt = " ".join([f"{col.column_stmt},"
@@ -153,6 +302,50 @@ class Database(ABC):
     def do_populate(self, *args: Union[str, int, float]) -> None:
         pass
 
+    def commit(self) -> None:
+        """Commits the current transaction, deferred to the end of a running bulk load"""
+        if self._bulk_load is None:
+            self._connection.commit()
+
+    @contextmanager
+    def bulk_load(self, tablename: str, wal: bool = True) -> Iterator[BulkLoadReport]:
+        """
+        Runs the block in a single transaction, with the indexes of `tablename` dropped during the load and built
+        again once it's done
+        :param tablename: table being loaded
+        :param wal: switches to WAL journaling with synchronous=NORMAL for the duration of the load
+        """
+        self._connection.commit()
+        indexes = self._cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? "
+                                       "AND sql IS NOT NULL", (tablename,)).fetchall()
+        journal_mode, synchronous = None, None
+        if wal:
+            journal_mode = self._cursor.execute("PRAGMA journal_mode").fetchone()[0]
+            synchronous = self._cursor.execute("PRAGMA synchronous").fetchone()[0]
+            self._cursor.execute("PRAGMA journal_mode = WAL")
+            self._cursor.execute("PRAGMA synchronous = NORMAL")
+
+        report = BulkLoadReport()
+        start = time.perf_counter()
+        self._bulk_load = report
+        try:
+            self._cursor.execute("BEGIN")
+            for name, _ in indexes:
+                self._cursor.execute(f"DROP INDEX IF EXISTS {name}")
+            yield report
+            for _, sql in indexes:
+                self._cursor.execute(sql)
+            self._connection.commit()
+        except BaseException:
+            self._connection.rollback()
+            raise
+        finally:
+            self._bulk_load = None
+            if wal:
+                self._cursor.execute(f"PRAGMA journal_mode = {journal_mode}")
+                self._cursor.execute(f"PRAGMA synchronous = {synchronous}")
+            report.seconds = time.perf_counter() - start
+
     def clear_table(self, table: str) -> None:
         self._cursor.execute(f"DELETE FROM ?", (table,))
 
@@ -175,6 +368,10 @@ class Database(ABC):
 class SP500Database(Database):
     _historical_tablename: str = "historical_data"
     _api_data_tablename: str = "api_data"
+    _cvi_tablename: str = "cvi_data"
+    _state_tablename: str = "indicator_state"
+    _refresh_log_tablename: str = "refresh_log"
+    _meta_tablename: str = "meta"
     _oex_data: str = "sp500_prices"
 
     columns = np.array(["Date", "Ticker", 'Open', 'High', 'Low', 'Close', 'Adj_Close', 'Volume', 'MA20', 'MA50',
@@ -188,6 +385,12 @@ class SP500Database(Database):
 
     tickers = GeneralMarketDataFetcher.tickers
 
+    @property
+    def historical_indexes(self) -> List[Index]:
+        """One row per ticker and date, by-ticker and by-date lookups are index seeks"""
+        return [Index(self._historical_tablename, ["Ticker", "Date"], unique=True),
+                Index(self._historical_tablename, ["Date"])]
+
     def change_default_historical_table_name(self, table_name: str):
         self._historical_tablename = table_name
 
@@ -199,13 +402,87 @@ class SP500Database(Database):
                                           pk=(IntegerColumn("tests", attribute="primary_key", nullable=True)))
 
         self._cursor.execute(stmt)
-        self._connection.commit()
+        self.create_table_meta()
         self._tablenames.append(self._historical_tablename)
+        self.migrate_historical()
+
+    def migrate_historical(self) -> None:
+        """
+        Adds the indexes of `historical_indexes` to a database created without them, duplicated (Ticker, Date)
+        rows are removed first keeping the last inserted one
+        """
+        missing = self.missing_indexes(self.historical_indexes)
+        if not missing:
+            return
+        if any(index.unique for index in missing):
+            deleted = self._cursor.execute(f"""
+                                              DELETE FROM {self._historical_tablename}
+                                              WHERE rowid NOT IN (SELECT MAX(rowid)
+                                                                  FROM {self._historical_tablename}
+                                                                  GROUP BY Ticker, Date)
+                                           """).rowcount
+            if deleted:
+                self.bump_historical_version()
+                print(f"Removed {deleted} duplicated rows from {self._historical_tablename}")
+        self.create_indexes(missing)
+        self._cursor.execute(f"ANALYZE {self._historical_tablename}")
+        self.commit()
 
     def create_table_api_data(self):
         self.cursor.execute(
             f"CREATE TABLE IF NOT EXISTS {self._api_data_tablename} (id INTEGER PRIMARY KEY, Datetime TEXT, Data STRING)")
-        self.connection.commit()
+        self.commit()
+
+    def create_table_meta(self):
+        self.cursor.execute(f"CREATE TABLE IF NOT EXISTS {self._meta_tablename} (Key TEXT PRIMARY KEY, Value INTEGER)")
+        self.commit()
+
+    def create_table_cvi(self):
+        self.cursor.execute(f"CREATE TABLE IF NOT EXISTS {self._cvi_tablename} (Date TEXT PRIMARY KEY, CVI INTEGER)")
+        self.commit()
+
+    def create_table_indicator_state(self):
+        self.cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {self._state_tablename} (Ticker TEXT PRIMARY KEY, Date TEXT, State TEXT)")
+        self.commit()
+
+    def create_table_refresh_log(self):
+        self.cursor.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self._refresh_log_tablename} (id INTEGER PRIMARY KEY, Started TEXT,
+                Finished TEXT, Duration FLOAT, Status TEXT, Data_Date TEXT, Snapshot INTEGER, Error TEXT)""")
+        self.commit()
+
+    def insert_refresh_log(self, started: str, finished: str, duration: float, status: str, data_date: str = None,
+                           snapshot_id: int = None, error: str = None) -> None:
+        with self.writing():
+            self.cursor.execute(
+                f"""INSERT INTO {self._refresh_log_tablename} (Started, Finished, Duration, Status, Data_Date,
+                    Snapshot, Error) VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (started, finished, duration, status, data_date, snapshot_id, error))
+            self.commit()
+
+    def query_last_refresh(self, status: str = None) -> Row or None:
+        """Last background refresh, the last one with `status` if set"""
+        return self.cursor.execute(
+            f"""SELECT * FROM {self._refresh_log_tablename} {'WHERE Status = ?' if status else ''}
+                ORDER BY id DESC LIMIT 1""", (status,) if status else ()).fetchone()
+
+    def query_indicator_states(self) -> Dict[str, str]:
+        """Serialized indicator state of every ticker"""
+        rows = self.cursor.execute(f"SELECT Ticker, State FROM {self._state_tablename}").fetchall()
+        return {row['Ticker']: row['State'] for row in rows}
+
+    def query_oldest_state_date(self) -> str or None:
+        """Date of the least recent indicator state, None if there is none"""
+        return self.cursor.execute(f"SELECT MIN(Date) FROM {self._state_tablename}").fetchone()[0]
+
+    def insert_indicator_states(self, states: List[tuple]) -> None:
+        """
+        :param states: (ticker, date, serialized state) tuples
+        """
+        self.cursor.executemany(
+            f"INSERT OR REPLACE INTO {self._state_tablename} (Ticker, Date, State) VALUES (?, ?, ?)", states)
+        self.commit()
 
     @cfunc
     def do_populate(self, dataframe: DataFrame):
@@ -213,16 +490,84 @@ class SP500Database(Database):
         Populates the tables containing historical data
         :param dataframe: Pandas dataframe with columns = args
         """
-        dataframe.to_sql(self._historical_tablename, self._connection, if_exists="append")
-        self._connection.commit()
+        self.insert_historical(dataframe)
+        self.commit()
+
+    def historical_insert_stmt(self) -> str:
+        return f"""INSERT OR REPLACE INTO {self._historical_tablename} ({', '.join(self.columns)})
+                   VALUES ({', '.join('?' for _ in self.columns)})"""
+
+    def insert_historical(self, dataframe: DataFrame) -> int:
+        """
+        Inserts `dataframe` (indexed by date) with a single prepared statement
+        :return: number of inserted rows
+        """
+        rows = zip(dataframe.index.map(str), *(dataframe[col].tolist() for col in self.columns[1:]))
+        self._cursor.executemany(self.historical_insert_stmt(), rows)
+        self.bump_historical_version()
+        if self._bulk_load is not None:
+            self._bulk_load.rows += len(dataframe)
+        return len(dataframe)
+
+    def historical_upsert_stmt(self) -> str:
+        values = [col for col in self.columns if col not in ("Date", "Ticker")]
+        return f"""INSERT INTO {self._historical_tablename} ({', '.join(self.columns)})
+                   VALUES ({', '.join('?' for _ in self.columns)})
+                   ON CONFLICT (Ticker, Date) DO UPDATE SET {', '.join(f'{col} = excluded.{col}' for col in values)}
+                   WHERE {' OR '.join(f'{col} IS NOT excluded.{col}' for col in values)}"""
+
+    def upsert_historical(self, dataframe: DataFrame) -> UpsertReport:
+        """
+        Inserts the new (Ticker, Date) rows of `dataframe` (indexed by date) and updates the existing ones, rows
+        identical to the stored ones are not written, all in a single batch
+        """
+        dates = dataframe.index.map(str)
+        keys = set(zip(dataframe['Ticker'], dates))
+        existing = set()
+        unique_dates = sorted(set(dates))
+        for i in range(0, len(unique_dates), 500):
+            chunk = unique_dates[i:i + 500]
+            placeholders = ", ".join("?" for _ in chunk)
+            existing.update((row[0], row[1]) for row in self._cursor.execute(
+                f"SELECT Ticker, Date FROM {self._historical_tablename} WHERE Date IN ({placeholders})", chunk))
+
+        rows = zip(dates, *(dataframe[col].tolist() for col in self.columns[1:]))
+        self._cursor.executemany(self.historical_upsert_stmt(), rows)
+        written = self._cursor.rowcount
+        if written:
+            self.bump_historical_version()
+        self.commit()
+
+        inserted = len(keys - existing)
+        return UpsertReport(inserted=inserted, updated=written - inserted, unchanged=len(dataframe) - written,
+                            earliest=unique_dates[0] if written else None)
 
     def query_ticker_data(self, ticker: str) -> Iterator[DataFrame] or DataFrame:
-        return read_sql(f"SELECT * FROM {self._historical_tablename} WHERE ticker = '{ticker}'", self._connection)
+        return read_sql(f"SELECT * FROM {self._historical_tablename} WHERE Ticker = ? ORDER BY Date", self._connection,
+                        params=(ticker,))
+
+    def query_tickers_columns(self, tickers: List[str], columns: List[str], start: str = None,
+                              end: str = None) -> DataFrame:
+        """
+        `Date`, `Ticker` and `columns` of several tickers in a single query, ordered by ticker and date
+        :param tickers: at most 999 tickers (sqlite variable limit)
+        :param start: first date returned if set
+        :param end: date the rows stop at (excluded) if set
+        """
+        invalid = [col for col in columns if col not in self.columns]
+        if invalid:
+            raise ValueError(f"Unknown historical columns: {invalid}")
+        selection = ", ".join(["Date", "Ticker"] + [col for col in columns if col not in ("Date", "Ticker")])
+        params = list(tickers) + [str(date) for date in (start, end) if date is not None]
+        return read_sql(f"""SELECT {selection} FROM {self._historical_tablename}
+                            WHERE Ticker IN ({', '.join('?' for _ in tickers)})
+                            {'AND Date >= ?' if start is not None else ''} {'AND Date < ?' if end is not None else ''}
+                            ORDER BY Ticker, Date""", self._connection, params=params)
 
     def initial_date(self):
         beginning_date = self._cursor.execute(
             f"""SELECT date from {self._historical_tablename}
-                                                WHERE ticker = 'AAPL'"""
+                                                WHERE Ticker = 'AAPL' ORDER BY Date"""
         ).fetchone()
         beginning_date = beginning_date['date']
         print(beginning_date)
@@ -230,13 +575,11 @@ class SP500Database(Database):
 
     def clear_historical(self):
         self._cursor.execute(f"delete from {self._historical_tablename}")
-        self._connection.commit()
-
-    # def update_db(self):
-    #     self._cursor.execute(
-    #         f"""DELETE FROM {self._historical_tablename}
-    #                             WHERE date = ?
-    #                             """, (self.initial_date()))
+        self.bump_historical_version()
+        # the stored cumulative volume index and indicator states are derived from the historical table
+        self._cursor.execute(f"DROP TABLE IF EXISTS {self._cvi_tablename}")
+        self._cursor.execute(f"DROP TABLE IF EXISTS {self._state_tablename}")
+        self.commit()
 
     @property
     def historical_tablename(self):
@@ -252,15 +595,92 @@ class SP500Database(Database):
     def query_by_id(self) -> List[Row]:
         return self._cursor.execute(f"SELECT * from {self._historical_tablename} where id < 10").fetchall()
 
-    def stmt_query_by_date(self, date: str) -> str:
-        return f"SELECT * FROM {self._historical_tablename} WHERE date = '{date}'"
+    def stmt_query_by_date(self) -> str:
+        return f"SELECT * FROM {self._historical_tablename} WHERE Date = ?"
 
     def query_from_date_to_dataframe(self, date: str) -> DataFrame:
         """Build a dataframe from sql query for data on a give date"""
-        return read_sql(self.stmt_query_by_date(date), self._connection)
+        return read_sql(self.stmt_query_by_date(), self._connection, params=(str(date),))
+
+    def query_historical_columns(self, columns: List[str], since: str = None) -> DataFrame:
+        """
+        Loads `Date`, `Ticker` and the requested `columns` for the whole historical table in a single query
+        :param columns: names from `SP500Database.columns`
+        :param since: only the rows from `since` on are loaded if set
+        """
+        invalid = [col for col in columns if col not in self.columns]
+        if invalid:
+            raise ValueError(f"Unknown historical columns: {invalid}")
+        selection = ", ".join(["Date", "Ticker"] + [col for col in columns if col not in ("Date", "Ticker")])
+        return read_sql(f"SELECT {selection} FROM {self._historical_tablename} {'WHERE Date >= ?' if since else ''}",
+                        self._connection, params=(str(since),) if since else None)
+
+    def query_advance_decline(self, since: str = None) -> DataFrame:
+        """
+        Number of advancing (Change > 0) and declining (Change <= 0) stocks for each date, in one aggregate query
+        :param since: only dates after `since` are returned if set
+        """
+        return read_sql(f"""
+                            SELECT Date,
+                                   SUM(CASE WHEN Change > 0 THEN 1 ELSE 0 END) AS Advancing,
+                                   SUM(CASE WHEN Change <= 0 THEN 1 ELSE 0 END) AS Declining
+                            FROM {self._historical_tablename}
+                            {'WHERE Date > ?' if since is not None else ''}
+                            GROUP BY Date
+                            ORDER BY Date
+                         """, self._connection, params=(str(since),) if since is not None else None)
+
+    def query_volume_breadth(self, since: str = None) -> DataFrame:
+        """
+        Number of stocks with rising minus number of stocks with falling volume for each date, in one aggregate query
+        :param since: only dates after `since` are returned if set
+        """
+        return read_sql(f"""
+                            SELECT Date,
+                                   SUM(CASE WHEN Volume_Change > 0 THEN 1 ELSE 0 END)
+                                   - SUM(CASE WHEN Volume_Change < 0 THEN 1 ELSE 0 END) AS Net_Volume
+                            FROM {self._historical_tablename}
+                            {'WHERE Date > ?' if since is not None else ''}
+                            GROUP BY Date
+                            ORDER BY Date
+                         """, self._connection, params=(str(since),) if since is not None else None)
+
+    def query_cvi(self) -> DataFrame:
+        """Stored cumulative volume index, empty if it was never stored"""
+        if not self._cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                    (self._cvi_tablename,)).fetchone():
+            return DataFrame(columns=["Date", "CVI"])
+        return read_sql(f"SELECT Date, CVI FROM {self._cvi_tablename} ORDER BY Date", self._connection)
+
+    def insert_cvi(self, dataframe: DataFrame) -> None:
+        with self.writing():
+            self.cursor.executemany(f"INSERT OR REPLACE INTO {self._cvi_tablename} (Date, CVI) VALUES (?, ?)",
+                                    zip(dataframe['Date'], dataframe['CVI'].astype(int).tolist()))
+            self.commit()
+
+    def bump_historical_version(self) -> None:
+        """
+        Counts a write to the historical table, runs in the transaction of the write so that the version never
+        differs from the data
+        """
+        self._cursor.execute(f"""INSERT INTO {self._meta_tablename} (Key, Value) VALUES ('historical_version', 1)
+                                 ON CONFLICT (Key) DO UPDATE SET Value = Value + 1""")
+
+    def historical_version(self) -> int or None:
+        """
+        Number of writes to the historical table, tells whether a copy of it is up to date. None for a database
+        created before the table was versioned
+        """
+        try:
+            row = self._cursor.execute(f"SELECT Value FROM {self._meta_tablename} WHERE Key = 'historical_version'"
+                                       ).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row is not None else 0
 
     def query_all_dates(self) -> List[str]:
-        dates = self._cursor.execute(f"SELECT DISTINCT (date) FROM {self._historical_tablename}").fetchall()
+        dates = self._cursor.execute(f"SELECT DISTINCT (date) FROM {self._historical_tablename} "
+                                     f"ORDER BY date").fetchall()
         return [date['date'] for date in dates]
 
     def get_latest_date(self) -> str:
@@ -291,11 +711,24 @@ class SP500Database(Database):
         data = self.cursor.execute(f"SELECT * FROM {self._api_data_tablename} ORDER BY id DESC LIMIT 1").fetchone()
         return data
 
-    def insert_api_data(self, datetime, data):
+    def get_last_api_request_info(self) -> Row or None:
+        """id and Datetime of the last stored API snapshot, without loading its data"""
+        return self.cursor.execute(
+            f"SELECT id, Datetime FROM {self._api_data_tablename} ORDER BY id DESC LIMIT 1").fetchone()
+
+    def query_api_data(self, snapshot_id: int) -> str:
+        return self.cursor.execute(f"SELECT Data FROM {self._api_data_tablename} WHERE id = ?",
+                                   (snapshot_id,)).fetchone()['Data']
+
+    def insert_api_data(self, datetime, data) -> int:
+        """:return: id of the stored snapshot"""
         data = json.dumps(data)
         print("Adding to Table")
-        self.cursor.execute(f"INSERT INTO {self._api_data_tablename} (Datetime, Data) VALUES (?, ?)", (datetime, data))
-        self.connection.commit()
+        with self.writing():
+            self.cursor.execute(f"INSERT INTO {self._api_data_tablename} (Datetime, Data) VALUES (?, ?)",
+                                (datetime, data))
+            self.commit()
+            return self.cursor.lastrowid
 
     @cfunc
     def query_all_testing_data(self):
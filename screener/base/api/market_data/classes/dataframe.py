@@ -1,7 +1,61 @@
 from dataclasses import dataclass
+from typing import Dict, Tuple, Iterable
 import numpy as np
-from pandas import DataFrame
-from screener.base.api.market_data.classes.indicators import MovingAverages, inject_ichimoku, RSI, MACD, Bollinger, Stochastic
+from pandas import DataFrame, DatetimeIndex, to_datetime
+from base.api.market_data.classes.indicators import MovingAverages, inject_ichimoku, RSI, MACD, Bollinger, \
+    Stochastic, ichimoku
+
+# Compact mode stores the indicators as float32 once they are computed in float64, every value is rounded once to
+# the nearest float32 (relative error <= 2 ** -24 ~ 6e-8). Tolerances (rtol, atol) a compact column is guaranteed to
+# match its float64 counterpart within, as in `numpy.isclose`. Prices and price-like indicators are only bounded
+# relatively, the 0-100 oscillators also absolutely. Comparisons between two columns (Close > MA20) or against a
+# threshold (RSI < 30) can flip when both sides are closer than these tolerances.
+COMPACT_TOLERANCES: Dict[str, Tuple[float, float]] = {
+    "Open": (1e-7, 0.), "High": (1e-7, 0.), "Low": (1e-7, 0.), "Close": (1e-7, 0.), "Adj_Close": (1e-7, 0.),
+    "MA20": (1e-7, 0.), "MA50": (1e-7, 0.), "MA100": (1e-7, 0.),
+    "BB_lower": (1e-7, 0.), "BB_middle": (1e-7, 0.), "BB_upper": (1e-7, 0.),
+    "tenkan_sen": (1e-7, 0.), "kijun_sen": (1e-7, 0.), "senkou_span_a": (1e-7, 0.), "senkou_span_b": (1e-7, 0.),
+    "RSI": (1e-7, 1e-5), "STOCH_K": (1e-7, 1e-5), "STOCH_D": (1e-7, 1e-5),
+    # unbounded and crossing zero, only relative to their own value
+    "MACD_histogram": (1e-7, 0.), "Change": (1e-7, 0.), "Volume_Change": (1e-7, 0.),
+}
+
+EPOCH = np.datetime64("1970-01-01", "D")
+
+
+def to_day_numbers(dates: Iterable) -> np.ndarray:
+    """Days since 1970-01-01 of `dates` as int32, the time of day is dropped"""
+    return (to_datetime(np.asarray(dates)).values.astype("datetime64[D]") - EPOCH).astype(np.int32)
+
+
+def from_day_numbers(days: Iterable[int]) -> DatetimeIndex:
+    return DatetimeIndex(EPOCH + np.asarray(days, dtype="timedelta64[D]"))
+
+
+@dataclass
+class MemoryReport:
+    """Deep memory usage in bytes of each column before and after `EnhancedDataframe.compact`"""
+    before: Dict[str, int]
+    after: Dict[str, int]
+
+    @property
+    def total_before(self) -> int:
+        return sum(self.before.values())
+
+    @property
+    def total_after(self) -> int:
+        return sum(self.after.values())
+
+    @property
+    def reduction(self) -> float:
+        return 1 - self.total_after / self.total_before if self.total_before else 0.
+
+    def __str__(self) -> str:
+        lines = [f"{column:<16}{self.before.get(column, 0) / 2 ** 20:>10.2f} MiB -> "
+                 f"{self.after.get(column, 0) / 2 ** 20:.2f} MiB" for column in {**self.before, **self.after}]
+        lines.append(f"{'Total':<16}{self.total_before / 2 ** 20:>10.2f} MiB -> {self.total_after / 2 ** 20:.2f} MiB "
+                     f"({100 * self.reduction:.1f}% less)")
+        return "\n".join(lines)
 
 
 @dataclass
@@ -12,10 +66,13 @@ class EnhancedDataframe:
         self.populate_dataframe(self.dataframe, "NULL")
 
     @staticmethod
-    def populate_dataframe(dataframe, ticker: str) -> DataFrame:
+    def populate_dataframe(dataframe, ticker: str, compact: bool = False) -> DataFrame:
+        """
+        :param compact: returns the frame of `EnhancedDataframe.compact`, see `COMPACT_TOLERANCES`
+        """
         dataframe.index.name = "Date"
         dataframe.rename(columns={"Adj Close": "Adj_Close"}, inplace=True)
-        dataframe['Ticker'] = np.array([ticker for _ in range(len(dataframe))])
+        dataframe['Ticker'] = np.full(len(dataframe), ticker)
 
         closes = dataframe['Close']
         highs = dataframe['High']
@@ -45,4 +102,83 @@ class EnhancedDataframe:
         inject_ichimoku(dataframe)
         dataframe.dropna(inplace=True)
 
-        return dataframe
+        return EnhancedDataframe.compact(dataframe) if compact else dataframe
+
+    @staticmethod
+    def populate_panel(tickers_data: DataFrame, compact: bool = False) -> DataFrame:
+        """
+        Computes the indicators of every ticker at once on (date x ticker) frames
+        :param tickers_data: return of `GeneralMarketDataFetcher.download_data`, (ticker, field) x date
+        :param compact: returns the frame of `EnhancedDataframe.compact`, see `COMPACT_TOLERANCES`
+        :return: long format rows for the historical table, same rows and values as `populate_dataframe`
+                 applied ticker by ticker
+        """
+        fields = {field: tickers_data.xs(field, level=1).T.astype(float) for field in
+                  ("Open", "High", "Low", "Close", "Adj Close", "Volume")}
+        closes, highs, lows = fields["Close"], fields["High"], fields["Low"]
+
+        macd, macd_signal, macd_histogram = MACD(fields["Adj Close"]).data
+        lower, middle, upper = Bollinger(closes, lows, highs).data
+        stoch_k, stoch_d = Stochastic(closes, highs, lows).data
+        moving_averages = MovingAverages(closes)
+        tenkan_sen, kijun_sen, senkou_span_a, senkou_span_b = ichimoku(highs, lows)
+
+        panel = {
+            "Open": fields["Open"], "High": highs, "Low": lows, "Close": closes, "Adj_Close": fields["Adj Close"],
+            "Volume": fields["Volume"],
+            "MA20": moving_averages.ma_20,
+            "MA50": moving_averages.ma_50,
+            "MA100": moving_averages.ma_100,
+            "RSI": RSI(closes).data,
+            "MACD_histogram": macd_histogram,
+            "BB_lower": lower,
+            "BB_middle": middle,
+            "BB_upper": upper,
+            "STOCH_K": stoch_k,
+            "STOCH_D": stoch_d,
+            "Volume_Change": fields["Volume"].pct_change(1),
+            "Change": closes.pct_change(1) * 100,
+            "tenkan_sen": tenkan_sen,
+            "kijun_sen": kijun_sen,
+            "senkou_span_a": senkou_span_a,
+            "senkou_span_b": senkou_span_b,
+        }
+
+        # (ticker, date) ordered rows, each column a single 2-D to 1-D reshape
+        dataframe = DataFrame({column: values.T.stack(dropna=False) for column, values in panel.items()})
+        dataframe.index.names = ["Ticker", "Date"]
+        dataframe.dropna(inplace=True)
+        dataframe.reset_index(level="Ticker", inplace=True)
+        columns = list(panel)
+        columns.insert(columns.index("Volume") + 1, "Ticker")
+        dataframe = dataframe[columns]
+        return EnhancedDataframe.compact(dataframe) if compact else dataframe
+
+    @staticmethod
+    def compact(dataframe: DataFrame) -> DataFrame:
+        """
+        Copy of an indicator frame for in-memory analysis: float columns as float32 (within `COMPACT_TOLERANCES`),
+        Volume as int64, Ticker as a categorical and dates as int32 day numbers (`to_day_numbers`). The dates of a
+        Date index or column end up in an int32 `Date` column, pandas indexes can't hold int32.
+        :param dataframe: output of `populate_dataframe`, `populate_panel` or a historical table query
+        """
+        dataframe = dataframe.reset_index() if dataframe.index.name == "Date" else dataframe.copy()
+        columns = {}
+        for column, values in dataframe.items():
+            if column == "Date":
+                columns[column] = to_day_numbers(values)
+            elif column == "Ticker":
+                columns[column] = values.astype("category")
+            elif column == "Volume":
+                columns[column] = values.astype(np.int64)
+            elif values.dtype == np.float64:
+                columns[column] = values.astype(np.float32)
+            else:
+                columns[column] = values
+        return DataFrame(columns, index=dataframe.index)
+
+    @staticmethod
+    def memory_report(dataframe: DataFrame) -> MemoryReport:
+        """Memory used by `dataframe` and by its `compact` copy, the index counts as a column"""
+        return MemoryReport(dict(dataframe.memory_usage(deep=True)),
+                            dict(EnhancedDataframe.compact(dataframe).memory_usage(deep=True)))
@@ -0,0 +1,40 @@
+import numpy as np
+
+"""
+Largest-Triangle-Three-Buckets (Steinarsson 2013, "Downsampling Time Series for Visual Representation").
+
+Keeps the first and last points and, for each of the `threshold - 2` buckets in between, the point forming the
+largest triangle with the point kept in the previous bucket and the average of the next bucket. Peaks and troughs
+survive, so a chart of a few hundred points looks like the full series.
+"""
+
+
+def lttb_indices(y: np.ndarray, threshold: int, x: np.ndarray = None) -> np.ndarray:
+    """
+    Positions of the points of `y` kept by LTTB
+    :param y: values, without NaN
+    :param threshold: number of points to keep, every point is kept if the series is shorter or it's below 3
+    :param x: coordinates of the values, evenly spaced if not set
+    """
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    y = np.asarray(y, dtype=float)
+    x = np.arange(n, dtype=float) if x is None else np.asarray(x, dtype=float)
+
+    # bucket i of the middle points spans [edges[i], edges[i + 1])
+    edges = (np.arange(threshold - 1) * (n - 2) / (threshold - 2)).astype(np.int64) + 1
+    edges[-1] = n - 1
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i + 1]
+        next_stop = edges[i + 2] if i + 2 < len(edges) else n
+        next_x, next_y = x[stop:next_stop].mean(), y[stop:next_stop].mean()
+        # twice the triangle areas, the factor doesn't change the argmax
+        areas = np.abs((x[previous] - next_x) * (y[start:stop] - y[previous]) -
+                       (x[previous] - x[start:stop]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        indices[i + 1] = previous
+    return indices
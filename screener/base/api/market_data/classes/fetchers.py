@@ -1,28 +1,278 @@
-from dataclasses import dataclass
-from typing import List
+import asyncio
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Dict, Callable, AsyncIterator, Union, ClassVar
 
-from pandas import read_csv, DataFrame
+from pandas import read_csv, DataFrame, DateOffset, MultiIndex, Timestamp, concat
 from pandas_datareader.yahoo.daily import YahooDailyReader
-from yfinance import download
-from screener.base.api.market_data.config import file_path
+from yfinance import download, Ticker
+from base.api.market_data.config import file_path
 import datetime
 
 today = datetime.date.today()
 today = today - datetime.timedelta(days=3)
 yesterday = today - datetime.timedelta(days=4)
 
+FIELDS = ["Open", "High", "Low", "Close", "Adj Close", "Volume"]
+
+
+def to_tickers_data(frames: Dict[str, DataFrame]) -> DataFrame:
+    """
+    Puts per ticker OHLCV frames (date x field) together in the layout of `GeneralMarketDataFetcher.download_data`:
+    (ticker, field) x date
+    """
+    frames = {ticker: frame.reindex(columns=FIELDS) for ticker, frame in frames.items()}
+    if not frames:
+        return DataFrame()
+    return concat(frames, axis=1).T
+
+
+def missing_tickers(tickers_data: DataFrame, tickers: List[str]) -> List[str]:
+    """Tickers of `tickers` without a single close in `tickers_data`"""
+    if tickers_data.empty:
+        return list(tickers)
+    has_close = tickers_data.xs("Close", level=1).notna().any(axis=1)
+    return [ticker for ticker in tickers if not has_close.get(ticker, False)]
+
+
+class MarketDataProvider(ABC):
+    """Source of daily bars, a chunk of tickers is downloaded per call"""
+
+    @abstractmethod
+    def download(self, tickers: List[str], period: str, interval: str, start=None, end=None) -> DataFrame:
+        """
+        :param start: first date to download, `period` is ignored if set
+        :param end: date the download stops at (excluded), up to now if not set
+        :return: OHLCV of `tickers`, (ticker, field) x date, tickers that couldn't be downloaded are left out
+        """
+
+    @abstractmethod
+    def index_history(self, symbol: str, start, end) -> DataFrame:
+        """Daily OHLCV (date x field) of an index between `start` and `end`"""
+
+
+class YahooProvider(MarketDataProvider):
+    def download(self, tickers: List[str], period: str, interval: str, start=None, end=None) -> DataFrame:
+        # one batched request per chunk, the chunks already run concurrently. `yfinance.download` gathers its results
+        # in module globals shared by the chunks in flight: only the tickers of the chunk are kept and the ones lost
+        # (or that failed) are requested alone
+        history = download(tickers=tickers, period=period, interval=interval, start=start, end=end,
+                           group_by="ticker", auto_adjust=False, actions=False, threads=False, progress=False)
+        frames = self.split(history, tickers)
+        for ticker in tickers:
+            if ticker not in frames:
+                single = Ticker(ticker).history(period=period, interval=interval, start=start, end=end,
+                                                auto_adjust=False, actions=False)
+                if not single.empty:
+                    frames[ticker] = single
+        return to_tickers_data({ticker: self.tz_naive(frame) for ticker, frame in frames.items()})
+
+    @staticmethod
+    def split(history: DataFrame, tickers: List[str]) -> Dict[str, DataFrame]:
+        """Bars of a `yfinance.download` grouped by ticker, tickers without a single close are left out"""
+        if history.empty:
+            return {}
+        if not isinstance(history.columns, MultiIndex):
+            # a single ticker isn't grouped
+            history = concat({tickers[0]: history}, axis=1)
+        frames = {}
+        for ticker in tickers:
+            if ticker not in history.columns.get_level_values(0):
+                continue
+            frame = history[ticker].dropna(how="all")
+            if "Close" in frame and frame["Close"].notna().any():
+                frames[ticker] = frame
+        return frames
+
+    @staticmethod
+    def tz_naive(history: DataFrame) -> DataFrame:
+        if history.index.tz is not None:
+            history.index = history.index.tz_localize(None)
+        return history
+
+    def index_history(self, symbol: str, start, end) -> DataFrame:
+        return YahooDailyReader(symbols=symbol, start=start, end=end).read()
+
+
+@dataclass
+class FileProvider(MarketDataProvider):
+    """
+    Reads bars from one csv file per ticker (`<directory>/<ticker>.csv`, Date and OHLCV columns), stands in for
+    Yahoo in tests and benchmarks
+    """
+    directory: Union[str, Path]
+
+    periods = {"d": "days", "wk": "weeks", "mo": "months", "y": "years"}
+
+    def path(self, ticker: str) -> Path:
+        return Path(self.directory) / f"{ticker}.csv"
+
+    def exists(self, ticker: str) -> bool:
+        return self.path(ticker).exists()
+
+    def read(self, ticker: str) -> DataFrame:
+        return read_csv(self.path(ticker), index_col="Date", parse_dates=True, float_precision="round_trip")
+
+    def select(self, history: DataFrame, period: str) -> DataFrame:
+        """Last `period` of `history`, like yahoo periods ("5d", "1mo", "1y", "max")"""
+        if period == "max":
+            return history
+        unit = period.lstrip("0123456789")
+        count = int(period[:-len(unit)])
+        if unit == "d":
+            # trading days
+            return history.iloc[-count:]
+        return history[history.index > history.index[-1] - DateOffset(**{self.periods[unit]: count})]
+
+    def download(self, tickers: List[str], period: str, interval: str, start=None, end=None) -> DataFrame:
+        frames = {}
+        for ticker in tickers:
+            if not self.exists(ticker):
+                continue
+            history = self.read(ticker)
+            if start is None:
+                history = self.select(history, period)
+            else:
+                history = history[(history.index >= Timestamp(start)) &
+                                  (history.index < Timestamp(end) if end is not None else True)]
+            if not history.empty:
+                frames[ticker] = history
+        return to_tickers_data(frames)
+
+    def index_history(self, symbol: str, start, end) -> DataFrame:
+        history = self.read(symbol)
+        return history[(history.index >= Timestamp(start)) & (history.index <= Timestamp(end))]
+
+    def write(self, tickers_data: DataFrame) -> None:
+        """Stores the output of a download ((ticker, field) x date) as one csv file per ticker"""
+        Path(self.directory).mkdir(parents=True, exist_ok=True)
+        for ticker in tickers_data.index.unique(level=0):
+            history = tickers_data.loc[ticker].T.dropna(how="all")
+            history.index.name = "Date"
+            history.to_csv(self.path(ticker))
+
+
+class DownloadError(Exception):
+    """Raised when some tickers are still missing after every retry"""
+
+    def __init__(self, tickers: List[str], msg: str) -> None:
+        self.tickers = tickers
+        self.msg = msg
+        super().__init__(msg)
+
+
+@dataclass
+class ChunkedDownloader:
+    """
+    Downloads a universe in chunks of `chunk_size` tickers with at most `concurrency` chunks in flight, a failed
+    chunk (or the tickers missing from it) is retried `retries` times with exponential backoff
+    """
+    provider: MarketDataProvider
+    chunk_size: int = 50
+    concurrency: int = 4
+    retries: int = 3
+    backoff: float = 1.
+    failed: List[str] = field(default_factory=list)
+
+    def chunks(self, tickers: List[str]) -> List[List[str]]:
+        return [tickers[i:i + self.chunk_size] for i in range(0, len(tickers), self.chunk_size)]
+
+    async def download_chunk(self, tickers: List[str], period: str, interval: str,
+                             semaphore: asyncio.Semaphore, start=None) -> DataFrame:
+        downloaded, remaining = [], list(tickers)
+        async with semaphore:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+                try:
+                    data = await asyncio.to_thread(self.provider.download, remaining, period, interval, start=start)
+                except Exception as error:
+                    print(f"Download of {len(remaining)} tickers failed ({error!r}), attempt {attempt + 1}")
+                    continue
+                missing = missing_tickers(data, remaining)
+                if len(missing) < len(remaining):
+                    downloaded.append(data[~data.index.get_level_values(0).isin(missing)])
+                remaining = missing
+                if not remaining:
+                    break
+        if remaining:
+            print(f"Could not download {remaining}")
+            self.failed.extend(remaining)
+        return concat(downloaded) if downloaded else DataFrame()
+
+    async def stream(self, tickers: List[str], period: str, interval: str, start=None) -> AsyncIterator[DataFrame]:
+        """
+        Yields the chunks in the order they finish downloading
+        :param start: first date to download, `period` is ignored if set
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = [asyncio.create_task(self.download_chunk(chunk, period, interval, semaphore, start=start))
+                 for chunk in self.chunks(tickers)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                chunk = await task
+                if not chunk.empty:
+                    yield chunk
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def run(self, tickers: List[str], period: str, interval: str, consume: Callable[[DataFrame], None],
+            start=None) -> None:
+        """Calls `consume` on each chunk as soon as it is downloaded, while the next ones are still downloading"""
+        async def pipeline():
+            async for chunk in self.stream(tickers, period, interval, start=start):
+                # runs in the calling thread (sqlite connections are bound to it), downloads already started keep
+                # going in their worker threads meanwhile
+                consume(chunk)
+
+        self.failed = []
+        asyncio.run(pipeline())
+
+    def download(self, tickers: List[str], period: str, interval: str, start=None) -> DataFrame:
+        chunks = []
+        self.run(tickers, period, interval, chunks.append, start=start)
+        if not chunks:
+            raise DownloadError(self.failed, "No data could be downloaded")
+        return concat(chunks)
+
 
 @dataclass
 class GeneralMarketDataFetcher:
+    # replaced by tests and benchmarks to run offline, also used by `oex_download_data`
+    default_provider: ClassVar[MarketDataProvider] = YahooProvider()
 
-    def download_data(self, period: str = "10y", interval: str = "1d") -> DataFrame:
-        tickers_data = download(
-            tickers=self.tickers, period=period,
-            interval=interval, group_by='ticker', auto_adjust=False,
-            prepost=False, threads=True, proxy=None)
+    provider: MarketDataProvider = None
+    chunk_size: int = 50
+    concurrency: int = 4
+    retries: int = 3
 
-        tickers_data = tickers_data.T
-        return tickers_data
+    def __post_init__(self) -> None:
+        if self.provider is None:
+            self.provider = type(self).default_provider
+
+    @property
+    def downloader(self) -> ChunkedDownloader:
+        return ChunkedDownloader(self.provider, chunk_size=self.chunk_size, concurrency=self.concurrency,
+                                 retries=self.retries)
+
+    def download_data(self, period: str = "10y", interval: str = "1d", start=None) -> DataFrame:
+        """
+        OHLCV of the whole universe, (ticker, field) x date
+        :param start: first date to download, `period` is ignored if set
+        """
+        return self.downloader.download(self.tickers, period, interval, start=start)
+
+    def stream_data(self, consume: Callable[[DataFrame], None], period: str = "10y",
+                    interval: str = "1d") -> List[str]:
+        """
+        Downloads the universe chunk by chunk, calling `consume` on each chunk ((ticker, field) x date) as it arrives
+        :return: tickers that couldn't be downloaded
+        """
+        downloader = self.downloader
+        downloader.run(self.tickers, period, interval, consume)
+        return downloader.failed
 
     @property
     def tickers(self) -> List[str]:
@@ -34,7 +284,6 @@ class GeneralMarketDataFetcher:
     def single_ticker_download(ticker, period, interval):
         download(ticker, period=period, interval=interval)
 
-    @staticmethod
-    def oex_download_data(start, end) -> DataFrame:
-        dataframe = YahooDailyReader(symbols="^GSPC", start=start, end=end).read()
-        return dataframe
+    @classmethod
+    def oex_download_data(cls, start, end) -> DataFrame:
+        return cls.default_provider.index_history("^GSPC", start=start, end=end)
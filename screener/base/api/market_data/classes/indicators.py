@@ -1,8 +1,10 @@
 from dataclasses import dataclass
+from enum import Enum
 from typing import Union, List
 import numpy as np
-from pandas import Series, DataFrame
-from screener.base.api.market_data.classes.databases import SP500Database
+from pandas import Series, DataFrame, concat
+from base.api.market_data.classes.databases import SP500Database
+from base.api.market_data.classes.profiling import span
 
 
 # ============================================================
@@ -125,10 +127,25 @@ def get_tr(high, low, previous_close):
     return max([(high - low), abs(high - previous_close), abs(low - previous_close)])
 
 
+def true_range(highs: Union[Series, DataFrame], lows: Union[Series, DataFrame],
+               closes: Union[Series, DataFrame]) -> Union[Series, DataFrame]:
+    """Column-wise true range, takes a single ticker (Series) or a (date x ticker) panel (DataFrame)"""
+    previous_closes = closes.shift(1)
+    # fmax ignores the missing previous close of the first row, like `get_tr`
+    return np.fmax(highs - lows, np.fmax((highs - previous_closes).abs(), (lows - previous_closes).abs()))
+
+
+def directional_movement(highs: Union[Series, DataFrame], lows: Union[Series, DataFrame]) -> tuple:
+    """Column-wise positive and negative directional movement, same values as `get_pdm` and `get_ndm`"""
+    move_up = highs - highs.shift(1)
+    move_down = lows.shift(1) - lows
+    pdm = move_up.where((move_up > 0) & (move_up > move_down), 0.)
+    ndm = move_down.where((move_down > 0) & (move_down > move_up), 0.)
+    return pdm, ndm
+
+
 def get_atr(df: DataFrame) -> Series:
-    df["TR"] = np.vectorize(get_tr)(df['High'], df['Low'], df['Close'].shift(1))
-    atr = df["TR"].ewm(span=14, adjust=False).mean()
-    return atr
+    return true_range(df['High'], df['Low'], df['Close']).ewm(span=14, adjust=False).mean()
 
 
 def get_pdm(high, previous_high, low, previous_low) -> float:
@@ -156,14 +173,26 @@ def get_adx(pdi, ndi):
     return ((abs(pdi - ndi) / (pdi + ndi)).ewm(span=14, adjust=False).mean()) * 100
 
 
+@dataclass
+class ADX:
+    """ATR, directional indicators and ADX of a single ticker (Series) or a (date x ticker) panel (DataFrame)"""
+    highs: Union[Series, DataFrame]
+    lows: Union[Series, DataFrame]
+    closes: Union[Series, DataFrame]
+
+    def __post_init__(self) -> None:
+        self.data = self.get_adx()
+
+    def get_adx(self) -> tuple:
+        atr = true_range(self.highs, self.lows, self.closes).ewm(span=14, adjust=False).mean()
+        pdm, ndm = directional_movement(self.highs, self.lows)
+        pdi = get_di(pdm, atr)
+        ndi = get_di(ndm, atr)
+        return atr, pdi, ndi, get_adx(pdi, ndi)
+
+
 def compute_adx(df: DataFrame):
-    df['TR'] = np.vectorize(get_tr)(df['High'], df['Low'], df['Close'].shift())
-    df['ATR'] = get_atr(df)
-    df['PDM'] = np.vectorize(get_pdm)(df['High'], df['High'].shift(), df['Low'], df['Low'].shift())
-    df['NDM'] = np.vectorize(get_ndm)(df['High'], df['High'].shift(), df['Low'], df['Low'].shift())
-    df['PDI'] = get_di(df['PDM'], df['ATR'])
-    df['NDI'] = get_di(df['NDM'], df['ATR'])
-    df['ADX'] = get_adx(df['PDI'], df['NDI'])
+    df['ATR'], df['PDI'], df['NDI'], df['ADX'] = ADX(df['High'], df['Low'], df['Close']).data
 
 
 # ============================================================
@@ -210,20 +239,57 @@ class Sefi:
         return 1 if close > ma20 else 0
 
 
+class ZeroDecliners(Enum):
+    """How ADR handles dates on which no stock declined"""
+    Cap = 0
+    Nan = 1
+    Epsilon = 2
+
+
+# ADR of a date without decliners with ZeroDecliners.Cap: five times the threshold of the long signal
+# (`adr_signals_long`), such a day always reads as a broad advance. The ratio is finite unlike a/0, it's sent in the
+# API snapshots and JSON has no infinity
+ADR_CAP = 10.0
+
+
 # MARKETS ONLY
 class ADR:
-    def __init__(self, market_data: SP500Database):
+    def __init__(self, market_data: SP500Database, zero_decliners: ZeroDecliners = ZeroDecliners.Cap,
+                 cap: float = ADR_CAP, epsilon: float = 1e-6, since: str = None):
+        """
+        :param market_data: database holding the historical table
+        :param zero_decliners: Cap sets the ratio to `cap`, Nan leaves it undefined and Epsilon divides by `epsilon`
+        :param since: only dates after `since` are computed if set
+        """
         self.market_data = market_data
+        self.zero_decliners = zero_decliners
+        self.cap = cap
+        self.epsilon = epsilon
+        self.since = since
+
+    def ad_ratio_frame(self) -> DataFrame:
+        """Advancing, declining and their ratio for each date"""
+        with span("adr"):
+            dataframe = self.market_data.query_advance_decline(since=self.since)
+        advancing = dataframe['Advancing'].to_numpy(dtype=float)
+        declining = dataframe['Declining'].to_numpy(dtype=float)
+        no_decliners = declining == 0
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = advancing / declining
+
+        if self.zero_decliners is ZeroDecliners.Cap:
+            ratio[no_decliners] = self.cap
+        elif self.zero_decliners is ZeroDecliners.Nan:
+            ratio[no_decliners] = np.nan
+        else:
+            ratio[no_decliners] = advancing[no_decliners] / self.epsilon
+
+        dataframe['ADR'] = ratio
+        return dataframe
 
     def ad_ratio_value(self) -> List[Union[int, float]]:
-        dates = self.market_data.query_all_dates()
-        values = []
-        for date in dates:
-            dataframe = self.market_data.query_from_date_to_dataframe(date)
-
-            # TODO division by 0
-            values.append(len(dataframe[dataframe['Change'] > 0]) / len(dataframe[dataframe['Change'] <= 0]))
-        return values
+        return list(self.ad_ratio_frame()['ADR'])
 
     @property
     def data(self):
@@ -234,40 +300,79 @@ class CVI:
     def __init__(self, market_data: SP500Database):
         self.market_data = market_data
 
-    def advancing_volume_index(self) -> List[int]:
-        dates = self.market_data.query_all_dates()
-        return [self.count_volume_change(date) - self.count_volume_change(date, positive=False) for date in dates]
-
-    def count_volume_change(self, date: str, positive: bool = True) -> int:
-        return self.market_data.cursor.execute(
-            f"""select count(Volume_Change) from historical_data
-                where date = '{date}' and volume_change {'>' if positive else '<'} 0""").fetchone()['count('
-                                                                                                    'Volume_Change)']
+    def advancing_volume_index(self, since: str = None) -> List[int]:
+        return list(self.market_data.query_volume_breadth(since=since)['Net_Volume'])
+
+    def cumulative_volume_frame(self, since: str = None, offset: int = 0) -> DataFrame:
+        """
+        Cumulative volume index with its dates
+        :param since: only dates after `since` are computed if set
+        :param offset: cumulative value the series starts from (last stored value when extending)
+        """
+        with span("cvi"):
+            dataframe = self.market_data.query_volume_breadth(since=since)
+        dataframe['CVI'] = dataframe['Net_Volume'].cumsum() + offset
+        return dataframe[['Date', 'CVI']]
+
+    def extend(self, since: str = None) -> DataFrame:
+        """
+        Stored cumulative volume index brought up to date, and returned as the complete series. The dates after the
+        last but one stored date are recomputed from its stored value instead of the whole history: the last stored
+        date may have been computed from an intraday bar that was replaced since
+        :param since: earliest date of the rows written since the last extend (`UpsertReport.earliest`), the stored
+                      values from it on are recomputed too
+        """
+        with self.market_data.writing():
+            self.market_data.create_table_cvi()
+            kept = self.market_data.query_cvi().iloc[:-1]
+            if since is not None:
+                kept = kept[kept['Date'] < str(since)]
+            if kept.empty:
+                new = self.cumulative_volume_frame()
+                if len(new):
+                    self.market_data.insert_cvi(new)
+                return new
+            new = self.cumulative_volume_frame(since=kept['Date'].iloc[-1], offset=int(kept['CVI'].iloc[-1]))
+            if len(new):
+                self.market_data.insert_cvi(new)
+        return concat([kept, new], ignore_index=True)
+
+    def stored(self) -> DataFrame:
+        """Series stored by the last `extend`, read only: computed without being stored if there is none yet"""
+        stored = self.market_data.query_cvi()
+        return stored if len(stored) else self.cumulative_volume_frame()
 
     def cumulative_volume_index(self):
-        return np.array(self.advancing_volume_index()).cumsum()
+        return self.cumulative_volume_frame()['CVI'].to_numpy()
 
     @property
     def data(self):
         return self.cumulative_volume_index()
 
 
-def inject_ichimoku(dataframe: DataFrame):
-    nine_period_high = dataframe['High'].rolling(window=9).max()
-    nine_period_low = dataframe['Low'].rolling(window=9).min()
+def ichimoku(highs: Union[Series, DataFrame], lows: Union[Series, DataFrame]) -> tuple:
+    """Tenkan sen, kijun sen and senkou spans of a single ticker (Series) or a (date x ticker) panel (DataFrame)"""
+    nine_period_high = highs.rolling(window=9).max()
+    nine_period_low = lows.rolling(window=9).min()
+
+    tenkan_sen = (nine_period_high + nine_period_low) / 2
 
-    dataframe['tenkan_sen'] = (nine_period_high + nine_period_low) / 2
+    period26_high = highs.rolling(window=26).max()
+    period26_low = lows.rolling(window=26).min()
 
-    period26_high = dataframe['High'].rolling(window=26).max()
-    period26_low = dataframe['Low'].rolling(window=26).min()
+    kijun_sen = (period26_high + period26_low) / 2
+    senkou_span_a = ((tenkan_sen + kijun_sen) / 2).shift(26)
 
-    dataframe['kijun_sen'] = (period26_high + period26_low) / 2
-    dataframe['senkou_span_a'] = ((dataframe['tenkan_sen'] + dataframe['kijun_sen']) / 2).shift(26)
+    period52_high = highs.rolling(window=52).max()
+    period52_low = lows.rolling(window=52).min()
 
-    period52_high = dataframe['High'].rolling(window=52).max()
-    period52_low = dataframe['Low'].rolling(window=52).min()
+    senkou_span_b = ((period52_high + period52_low) / 2).shift(26)
+    return tenkan_sen, kijun_sen, senkou_span_a, senkou_span_b
 
-    dataframe['senkou_span_b'] = ((period52_high + period52_low) / 2).shift(26)
+
+def inject_ichimoku(dataframe: DataFrame):
+    dataframe['tenkan_sen'], dataframe['kijun_sen'], dataframe['senkou_span_a'], dataframe['senkou_span_b'] = \
+        ichimoku(dataframe['High'], dataframe['Low'])
 
 
 # ============================================================
@@ -277,12 +382,8 @@ def inject_ichimoku(dataframe: DataFrame):
 # ============================================================
 
 def adr_signals_long(adr: float, close: float, ma100: float, ma20: float) -> bool:
-    if (adr >= 2) and (close > ma100) and (close < ma20):
-        return True
-    return False
+    return (adr >= 2) & (close > ma100) & (close < ma20)
 
 
 def adr_signals_short(adr: float, close: float, ma100: float, ma20: float) -> bool:
-    if (adr <= .5) and (close < ma100) and (close > ma20):
-        return True
-    return False
+    return (adr <= .5) & (close < ma100) & (close > ma20)
@@ -0,0 +1,144 @@
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from typing import Dict, Tuple
+from zoneinfo import ZoneInfo
+
+
+def _nth_weekday(year: int, month: int, weekday: int, n: int) -> date:
+    """`n`th `weekday` (0 = Monday) of the month, the last one if `n` is -1"""
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = date(year, month + 1, 1) - timedelta(days=1) if month < 12 else date(year, 12, 31)
+    return last - timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def _easter(year: int) -> date:
+    """Gregorian easter sunday (anonymous gregorian algorithm)"""
+    a, b, c = year % 19, year // 100, year % 100
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+def _observed(holiday: date) -> date:
+    """Saturday holidays are observed on friday, sunday holidays on monday"""
+    if holiday.weekday() == 5:
+        return holiday - timedelta(days=1)
+    if holiday.weekday() == 6:
+        return holiday + timedelta(days=1)
+    return holiday
+
+
+@lru_cache(maxsize=None)
+def nyse_holidays(year: int) -> Dict[date, str]:
+    """Full day closures of the NYSE for `year`"""
+    holidays = {
+        _nth_weekday(year, 1, 0, 3): "Martin Luther King Jr. Day",
+        _nth_weekday(year, 2, 0, 3): "Washington's Birthday",
+        _easter(year) - timedelta(days=2): "Good Friday",
+        _nth_weekday(year, 5, 0, -1): "Memorial Day",
+        _observed(date(year, 7, 4)): "Independence Day",
+        _nth_weekday(year, 9, 0, 1): "Labor Day",
+        _nth_weekday(year, 11, 3, 4): "Thanksgiving Day",
+        _observed(date(year, 12, 25)): "Christmas Day",
+    }
+    # a saturday new year's day is not moved to the last trading day of the previous year
+    if date(year, 1, 1).weekday() != 5:
+        holidays[_observed(date(year, 1, 1))] = "New Year's Day"
+    if year >= 2022:
+        holidays[_observed(date(year, 6, 19))] = "Juneteenth"
+    return holidays
+
+
+@lru_cache(maxsize=None)
+def nyse_early_closes(year: int) -> Dict[date, time]:
+    """Trading days closing at 13:00"""
+    early_closes = [_nth_weekday(year, 11, 3, 4) + timedelta(days=1), date(year, 12, 24), date(year, 7, 3)]
+    holidays = nyse_holidays(year)
+    return {day: time(13) for day in early_closes if day.weekday() < 5 and day not in holidays}
+
+
+@dataclass(frozen=True)
+class MarketCalendar:
+    """Regular trading sessions of an exchange, NYSE by default"""
+    timezone: str = "America/New_York"
+    open_time: time = time(9, 30)
+    close_time: time = time(16)
+
+    @property
+    def tz(self) -> ZoneInfo:
+        return ZoneInfo(self.timezone)
+
+    def now(self) -> datetime:
+        return datetime.now(self.tz)
+
+    def localize(self, moment: datetime) -> datetime:
+        """Converts `moment` to the exchange timezone, naive datetimes are taken as local time of the server"""
+        return moment.astimezone(self.tz)
+
+    def is_trading_day(self, day: date) -> bool:
+        return day.weekday() < 5 and day not in nyse_holidays(day.year)
+
+    def session_bounds(self, day: date) -> Tuple[datetime, datetime]:
+        """Open and close of the session on `day`"""
+        close_time = nyse_early_closes(day.year).get(day, self.close_time)
+        return (datetime.combine(day, self.open_time, self.tz), datetime.combine(day, close_time, self.tz))
+
+    def previous_trading_day(self, day: date) -> date:
+        day -= timedelta(days=1)
+        while not self.is_trading_day(day):
+            day -= timedelta(days=1)
+        return day
+
+    def next_trading_day(self, day: date) -> date:
+        day += timedelta(days=1)
+        while not self.is_trading_day(day):
+            day += timedelta(days=1)
+        return day
+
+    def is_open(self, moment: datetime = None) -> bool:
+        moment = self.localize(moment or self.now())
+        if not self.is_trading_day(moment.date()):
+            return False
+        session_open, session_close = self.session_bounds(moment.date())
+        return session_open <= moment < session_close
+
+    def last_session(self, moment: datetime = None) -> date:
+        """Trading day of the running session, or of the last one that has started if the market is closed"""
+        moment = self.localize(moment or self.now())
+        day = moment.date()
+        if self.is_trading_day(day) and moment >= self.session_bounds(day)[0]:
+            return day
+        return self.previous_trading_day(day)
+
+    def last_close(self, moment: datetime = None) -> datetime:
+        """Close of the last completed session"""
+        moment = self.localize(moment or self.now())
+        day = self.last_session(moment)
+        session_close = self.session_bounds(day)[1]
+        return session_close if session_close <= moment else self.session_bounds(self.previous_trading_day(day))[1]
+
+    def next_change(self, moment: datetime = None) -> datetime:
+        """Next open or close of the market"""
+        moment = self.localize(moment or self.now())
+        day = self.last_session(moment)
+        session_close = self.session_bounds(day)[1]
+        if moment < session_close:
+            return session_close
+        return self.session_bounds(self.next_trading_day(day))[0]
+
+    def session_key(self, moment: datetime = None) -> str:
+        """Identifies the market phase of `moment`: the last session date and whether it's still trading"""
+        moment = self.localize(moment or self.now())
+        return f"{self.last_session(moment)}:{'open' if self.is_open(moment) else 'closed'}"
+
+
+NYSE = MarketCalendar()
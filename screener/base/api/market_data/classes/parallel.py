@@ -0,0 +1,142 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from multiprocessing import shared_memory
+from typing import List, Tuple
+import numpy as np
+from pandas import DataFrame, DatetimeIndex, MultiIndex, concat
+from base.api.market_data.classes.dataframe import EnhancedDataframe
+from base.api.market_data.classes.state import IndicatorState
+
+"""
+Rebuild of the indicators on a process pool, one task per downloaded chunk of tickers.
+
+The bars of a chunk go to the worker as a float64 (ticker x field x date) array in a shared memory block and the
+indicator rows come back the same way, only the block names, tickers, dates and the serialized indicator states are
+pickled. Workers run the code of the serial rebuild (`EnhancedDataframe.populate_panel`,
+`IndicatorState.from_dataframe`) on a copy of the chunk, the rows are the same.
+"""
+
+FIELDS = ("Open", "High", "Low", "Close", "Adj Close", "Volume")
+
+
+@dataclass
+class SharedArray:
+    """float64 array held in a named shared memory block, the block lives until `unlink`"""
+    name: str
+    shape: Tuple[int, ...]
+
+    @classmethod
+    def create(cls, values: np.ndarray) -> "SharedArray":
+        values = np.asarray(values, dtype=np.float64)
+        # a block can't be empty
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype=np.float64, buffer=block.buf)[...] = values
+        block.close()
+        return cls(block.name, values.shape)
+
+    def read(self) -> np.ndarray:
+        """Copy of the array, the block is closed again"""
+        block = shared_memory.SharedMemory(name=self.name)
+        try:
+            return np.ndarray(self.shape, dtype=np.float64, buffer=block.buf).copy()
+        finally:
+            block.close()
+
+    def unlink(self) -> None:
+        block = shared_memory.SharedMemory(name=self.name)
+        block.close()
+        block.unlink()
+
+
+@dataclass
+class ChunkResult:
+    """
+    :param rows: (row x 2 + columns) array: position of the ticker in the chunk, position of the date, values
+    :param columns: value columns of the rows, `Ticker` goes after `Volume`
+    :param states: (ticker, date, serialized state) of each ticker
+    """
+    rows: SharedArray
+    columns: List[str]
+    states: List[tuple]
+
+
+def compute_chunk(bars: SharedArray, tickers: List[str], dates: np.ndarray) -> ChunkResult:
+    """Indicator rows and states of a chunk of tickers, runs in a worker"""
+    values = bars.read()
+    tickers_data = DataFrame(values.reshape(len(tickers) * len(FIELDS), len(dates)),
+                             index=MultiIndex.from_product([tickers, FIELDS]), columns=DatetimeIndex(dates))
+    panel = EnhancedDataframe.populate_panel(tickers_data)
+    states = []
+    for ticker in tickers:
+        state = IndicatorState.from_dataframe(tickers_data.loc[ticker].T, ticker)
+        states.append((ticker, state.date, state.to_json()))
+
+    columns = [col for col in panel.columns if col != "Ticker"]
+    positions = {ticker: i for i, ticker in enumerate(tickers)}
+    rows = np.column_stack([panel['Ticker'].map(positions).to_numpy(dtype=float),
+                            tickers_data.columns.get_indexer(panel.index).astype(float),
+                            panel[columns].to_numpy(dtype=float)])
+    return ChunkResult(SharedArray.create(rows), columns, states)
+
+
+@dataclass
+class ParallelRebuild:
+    """
+    Computes the chunks submitted while the universe downloads on `workers` processes, `collect` gathers the rows of
+    every chunk for a single bulk write
+    """
+    workers: int
+    _executor: ProcessPoolExecutor = None
+    _pending: List[Tuple[SharedArray, List[str], np.ndarray, Future]] = field(default_factory=list)
+
+    def __enter__(self) -> "ParallelRebuild":
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._executor.shutdown(cancel_futures=True)
+        # chunks left over after an error, the blocks of their results too
+        for bars, _, _, future in self._pending:
+            bars.unlink()
+            if not future.cancelled() and future.exception() is None:
+                future.result().rows.unlink()
+        self._pending.clear()
+
+    def submit(self, tickers_data: DataFrame) -> None:
+        """
+        Queues a downloaded chunk
+        :param tickers_data: (ticker, field) x date, the chunks `GeneralMarketDataFetcher.stream_data` passes on
+        """
+        tickers = list(tickers_data.index.unique(level=0))
+        dates = tickers_data.columns.to_numpy()
+        values = np.stack([tickers_data.xs(name, level=1).reindex(tickers).to_numpy(dtype=float) for name in FIELDS],
+                          axis=1)
+        bars = SharedArray.create(values)
+        self._pending.append((bars, tickers, dates, self._executor.submit(compute_chunk, bars, tickers, dates)))
+
+    def collect(self, total: int = None) -> Tuple[DataFrame, List[tuple]]:
+        """
+        Waits for the submitted chunks
+        :param total: number of tickers of the universe, for the progress
+        :return: rows for the historical table indexed by date like `EnhancedDataframe.populate_panel`, indicator
+                 states of every ticker
+        """
+        frames, states = [], []
+        while self._pending:
+            bars, tickers, dates, future = self._pending.pop(0)
+            try:
+                result = future.result()
+            finally:
+                bars.unlink()
+            rows = result.rows.read()
+            result.rows.unlink()
+
+            frame = DataFrame(rows[:, 2:], columns=result.columns,
+                              index=DatetimeIndex(dates[rows[:, 1].astype(np.int64)], name="Date"))
+            frame.insert(result.columns.index("Volume") + 1, "Ticker",
+                         np.asarray(tickers, dtype=object)[rows[:, 0].astype(np.int64)])
+            frames.append(frame)
+            states.extend(result.states)
+            if total:
+                print(f"status:  {100 * len(states) / float(total):.2f}")
+        return (concat(frames) if frames else DataFrame()), states
@@ -0,0 +1,165 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Dict, Iterator
+
+"""
+Timing spans and SQL counters of the market data code paths.
+
+`span(name)` times a stage. Spans land in the profile of the running request (exported as a Server-Timing header by
+`ServerTimingMiddleware`) and in the cumulative `metrics`. SQL statements run through `ProfiledConnection` are counted
+and timed the same way under the `sql` and `sql_fetch` names. Profiling is off unless MARKET_DATA_PROFILING=1, spans
+are then a shared no-op context manager and connections plain sqlite ones.
+"""
+
+
+@dataclass
+class Timing:
+    count: int = 0
+    total: float = 0.
+    max: float = 0.
+
+    def add(self, duration: float) -> None:
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def to_dict(self) -> dict:
+        return {"count": self.count, "total": self.total, "max": self.max}
+
+
+@dataclass
+class Profile:
+    """Timings of one request, by span name"""
+    timings: Dict[str, Timing] = field(default_factory=dict)
+
+    def add(self, name: str, duration: float) -> None:
+        self.timings.setdefault(name, Timing()).add(duration)
+
+    def server_timing(self) -> str:
+        """Server-Timing header value, durations in milliseconds"""
+        return ", ".join(f'{name};dur={timing.total * 1000:.1f};desc="{timing.count}x"'
+                         for name, timing in self.timings.items())
+
+
+@dataclass
+class Metrics:
+    """Cumulative timings of every span and request since the process started (or the last `reset`)"""
+    spans: Dict[str, Timing] = field(default_factory=dict)
+    requests: Dict[str, Timing] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def add_span(self, name: str, duration: float) -> None:
+        with self._lock:
+            self.spans.setdefault(name, Timing()).add(duration)
+
+    def add_request(self, path: str, duration: float) -> None:
+        with self._lock:
+            self.requests.setdefault(path, Timing()).add(duration)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {"spans": {name: timing.to_dict() for name, timing in self.spans.items()},
+                    "requests": {path: timing.to_dict() for path, timing in self.requests.items()}}
+
+    def reset(self) -> None:
+        with self._lock:
+            self.spans.clear()
+            self.requests.clear()
+
+
+@dataclass
+class Profiling:
+    enabled: bool = os.environ.get("MARKET_DATA_PROFILING", "0") == "1"
+    metrics: Metrics = field(default_factory=Metrics)
+    current: ContextVar = field(default_factory=lambda: ContextVar("market_data_profile", default=None))
+
+    def record(self, name: str, duration: float) -> None:
+        profile = self.current.get()
+        if profile is not None:
+            profile.add(name, duration)
+        self.metrics.add_span(name, duration)
+
+    @contextmanager
+    def _span(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def span(self, name: str):
+        """Context manager timing the stage `name`"""
+        if not self.enabled:
+            return _NO_SPAN
+        return self._span(name)
+
+    @contextmanager
+    def request(self) -> Iterator[Profile]:
+        """Collects the spans of a request (of the current context) in the yielded profile"""
+        profile = Profile()
+        token = self.current.set(profile)
+        try:
+            yield profile
+        finally:
+            self.current.reset(token)
+
+    @property
+    def connection_factory(self) -> type:
+        """`sqlite3.connect` factory, statements are only timed when profiling is on"""
+        return ProfiledConnection if self.enabled else sqlite3.Connection
+
+
+_NO_SPAN = nullcontext()
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Times the execution and the fetches of the statements under the `sql` span"""
+
+    def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args, **kwargs)
+        finally:
+            profiling.record("sql", time.perf_counter() - start)
+
+    def executemany(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args, **kwargs)
+        finally:
+            profiling.record("sql", time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            profiling.record("sql_fetch", time.perf_counter() - start)
+
+    def fetchmany(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(*args, **kwargs)
+        finally:
+            profiling.record("sql_fetch", time.perf_counter() - start)
+
+
+class ProfiledConnection(sqlite3.Connection):
+    def cursor(self, factory: type = ProfiledCursor) -> sqlite3.Cursor:
+        return super().cursor(factory)
+
+    # the shortcuts of sqlite3.Connection don't go through `cursor`
+    def execute(self, *args, **kwargs) -> sqlite3.Cursor:
+        return self.cursor().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs) -> sqlite3.Cursor:
+        return self.cursor().executemany(*args, **kwargs)
+
+
+profiling = Profiling()
+span = profiling.span
@@ -0,0 +1,180 @@
+import threading
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+from pandas import DataFrame, DateOffset, MultiIndex, Timestamp, read_sql, to_datetime
+from base.api.market_data.classes.databases import Database
+from base.api.market_data.classes.fetchers import MarketDataProvider, GeneralMarketDataFetcher, FIELDS, \
+    missing_tickers
+from base.api.market_data.classes.market_calendar import MarketCalendar, NYSE
+from base.api.market_data.config import db_path
+
+# several chunks download in parallel threads, each with its own connection, writes to the cache are serialized
+_write_lock = threading.Lock()
+
+
+@dataclass
+class RawBarDatabase(Database):
+    """
+    Downloaded daily bars, with the date range fetched for each ticker so that only the missing ranges are
+    downloaded again
+    """
+    _bars_tablename: str = "raw_bars"
+    _coverage_tablename: str = "raw_bar_coverage"
+
+    columns = ["Date", "Ticker", "Open", "High", "Low", "Close", "Adj_Close", "Volume"]
+
+    def create_tables(self) -> None:
+        self._cursor.execute(f"""CREATE TABLE IF NOT EXISTS {self._bars_tablename} (Ticker TEXT NOT NULL,
+                                 Date TEXT NOT NULL, Open FLOAT, High FLOAT, Low FLOAT, Close FLOAT, Adj_Close FLOAT,
+                                 Volume INTEGER, PRIMARY KEY (Ticker, Date))""")
+        self._cursor.execute(f"""CREATE TABLE IF NOT EXISTS {self._coverage_tablename} (Ticker TEXT PRIMARY KEY,
+                                 Start TEXT, End TEXT)""")
+        self.commit()
+
+    def do_populate(self, tickers_data: DataFrame) -> None:
+        """
+        Inserts or replaces the bars of `tickers_data` ((ticker, field) x date), rows without a close are skipped
+        """
+        # (date, ticker) x field
+        bars = tickers_data.T.stack(level=0).reindex(columns=FIELDS)
+        bars = bars[bars['Close'].notna()]
+        self._cursor.executemany(
+            f"""INSERT OR REPLACE INTO {self._bars_tablename} ({', '.join(self.columns)})
+                VALUES ({', '.join('?' for _ in self.columns)})""",
+            zip(bars.index.get_level_values(0).map(str), bars.index.get_level_values(1),
+                *(bars[col].tolist() for col in FIELDS)))
+        self.commit()
+
+    def query_coverage(self, tickers: List[str]) -> Dict[str, Tuple[str, str]]:
+        """Fetched (start, end) dates of `tickers`"""
+        rows = self._cursor.execute(f"""SELECT Ticker, Start, End FROM {self._coverage_tablename}
+                                        WHERE Ticker IN ({', '.join('?' for _ in tickers)})""", tickers).fetchall()
+        return {row['Ticker']: (row['Start'], row['End']) for row in rows}
+
+    def update_coverage(self, coverage: Dict[str, Tuple[str, str]]) -> None:
+        self._cursor.executemany(
+            f"INSERT OR REPLACE INTO {self._coverage_tablename} (Ticker, Start, End) VALUES (?, ?, ?)",
+            [(ticker, start, end) for ticker, (start, end) in coverage.items()])
+        self.commit()
+
+    def query_bars(self, tickers: List[str], start: Union[date, str], end: Union[date, str] = None) -> DataFrame:
+        """
+        Cached bars of `tickers` from `start` up to `end` (excluded), (ticker, field) x date like a download
+        """
+        params = list(tickers) + [str(start)] + ([str(end)] if end is not None else [])
+        bars = read_sql(f"""SELECT {', '.join(self.columns)} FROM {self._bars_tablename}
+                            WHERE Ticker IN ({', '.join('?' for _ in tickers)}) AND Date >= ?
+                            {'AND Date < ?' if end is not None else ''}""", self._connection, params=params)
+        if bars.empty:
+            return DataFrame()
+        bars['Date'] = to_datetime(bars['Date'])
+        bars = bars.rename(columns={"Adj_Close": "Adj Close"}).astype({"Volume": float})
+        # date x (field, ticker) to (ticker, field) x date, in the order of `tickers`
+        bars = bars.pivot(index="Date", columns="Ticker").T.swaplevel()
+        order = [ticker for ticker in tickers if ticker in bars.index]
+        return bars.reindex(MultiIndex.from_product([order, FIELDS]))
+
+
+@dataclass
+class CachingProvider(MarketDataProvider):
+    """
+    Serves daily bars from `RawBarDatabase`, only the date ranges that were never fetched (or the running session)
+    are downloaded from `upstream`
+    :param upstream: provider the missing ranges come from, `GeneralMarketDataFetcher.default_provider` if not set
+    :param offline: only serves what's cached, nothing is downloaded
+    """
+    upstream: MarketDataProvider = None
+    path: Union[str, Path] = db_path / "raw_bars.sqlite"
+    offline: bool = False
+    calendar: MarketCalendar = NYSE
+
+    def __post_init__(self) -> None:
+        if self.upstream is None:
+            self.upstream = GeneralMarketDataFetcher.default_provider
+
+    def connect(self) -> RawBarDatabase:
+        database = RawBarDatabase()
+        database.connect_existing_database(self.path)
+        database.create_tables()
+        return database
+
+    def period_start(self, period: str, moment: datetime) -> date:
+        """First date of a yahoo style `period` ("5d", "1mo", "1y"), "Nd" periods count trading days"""
+        session = self.calendar.last_session(moment)
+        if period == "max":
+            return date(1900, 1, 1)
+        unit = period.lstrip("0123456789")
+        count = int(period[:-len(unit)])
+        if unit == "d":
+            for _ in range(count - 1):
+                session = self.calendar.previous_trading_day(session)
+            return session
+        units = {"wk": "weeks", "mo": "months", "y": "years"}
+        return (Timestamp(session) - DateOffset(**{units[unit]: count})).date() + timedelta(days=1)
+
+    def fetch(self, database: RawBarDatabase, tickers: List[str], start: date, end: date = None) -> List[str]:
+        """
+        Downloads the bars of `tickers` from `start` to `end` (excluded, up to now if not set) into the cache
+        :return: tickers that were downloaded
+        """
+        data = self.upstream.download(tickers, "max", "1d", start=start, end=end)
+        missing = set(missing_tickers(data, tickers))
+        fetched = [ticker for ticker in tickers if ticker not in missing]
+        if fetched:
+            with _write_lock:
+                database.do_populate(data[data.index.get_level_values(0).isin(fetched)])
+        return fetched
+
+    def refresh(self, database: RawBarDatabase, tickers: List[str], start: date, moment: datetime) -> None:
+        """Downloads the ranges of `tickers` from `start` up to now that aren't in the cache yet"""
+        last_session = self.calendar.last_session(moment)
+        # bars up to the last close are final, a bar of the running session is downloaded again on each refresh
+        final = self.calendar.last_close(moment).date()
+        coverage = database.query_coverage(tickers)
+        ranges: Dict[Tuple[date, date or None], List[str]] = {}
+        for ticker in tickers:
+            if ticker not in coverage:
+                ranges.setdefault((start, None), []).append(ticker)
+                continue
+            covered_start, covered_end = (date.fromisoformat(day) for day in coverage[ticker])
+            if start < covered_start:
+                ranges.setdefault((start, covered_start), []).append(ticker)
+            if covered_end < last_session:
+                ranges.setdefault((covered_end + timedelta(days=1), None), []).append(ticker)
+
+        updated = {}
+        for (range_start, range_end), range_tickers in ranges.items():
+            for ticker in self.fetch(database, range_tickers, range_start, range_end):
+                covered = updated.get(ticker) or coverage.get(ticker)
+                if covered is None:
+                    updated[ticker] = (str(start), str(final))
+                    continue
+                covered_start, covered_end = covered
+                if range_end is not None:
+                    covered_start = str(range_start)
+                else:
+                    covered_end = str(max(date.fromisoformat(covered_end), final))
+                updated[ticker] = (covered_start, covered_end)
+        if updated:
+            with _write_lock:
+                database.update_coverage(updated)
+
+    def download(self, tickers: List[str], period: str, interval: str, start: date = None,
+                 end: date = None) -> DataFrame:
+        if interval != "1d":
+            return self.upstream.download(tickers, period, interval, start=start, end=end)
+        moment = self.calendar.now()
+        start = Timestamp(start).date() if start is not None else self.period_start(period, moment)
+        end = Timestamp(end).date() if end is not None else None
+        database = self.connect()
+        if not self.offline:
+            self.refresh(database, tickers, start, moment)
+        return database.query_bars(tickers, start, end)
+
+    def index_history(self, symbol: str, start, end) -> DataFrame:
+        history = self.download([symbol], "max", "1d", start=start, end=Timestamp(end) + timedelta(days=1))
+        if history.empty:
+            return DataFrame(columns=FIELDS)
+        return history.loc[symbol].T
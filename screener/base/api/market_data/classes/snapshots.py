@@ -0,0 +1,197 @@
+import gzip
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable, Dict, Hashable, Tuple
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from base.api.market_data.classes.databases import SP500Database
+from base.api.market_data.classes.market_calendar import MarketCalendar, NYSE
+from base.api.market_data.classes.profiling import span
+
+
+@dataclass
+class SnapshotCache:
+    """
+    Thread safe LRU with a time to live per entry. Concurrent misses on the same key share a single computation,
+    the other callers wait for its result instead of computing it again
+    """
+    maxsize: int = 16
+    ttl: float = 60.
+    clock: Callable[[], float] = time.monotonic
+    _entries: "OrderedDict[Hashable, Tuple[float, Any]]" = field(default_factory=OrderedDict)
+    _inflight: Dict[Hashable, threading.Event] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def get(self, key: Hashable) -> Any:
+        """Cached value of `key`, None if missing or expired"""
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key: Hashable) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires <= self.clock():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any, ttl: float = None) -> None:
+        with self._lock:
+            self._entries[key] = (self.clock() + (self.ttl if ttl is None else ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any], ttl: float = None) -> Any:
+        """
+        Cached value of `key`, computed with `compute` on a miss
+        :param ttl: seconds the computed value is kept for, `SnapshotCache.ttl` if not set
+        """
+        while True:
+            with self._lock:
+                value = self._get(key)
+                if value is not None:
+                    return value
+                event = self._inflight.get(key)
+                is_leader = event is None
+                if is_leader:
+                    event = self._inflight[key] = threading.Event()
+            if is_leader:
+                break
+            # a failed computation leaves nothing cached, the next waiter takes over
+            event.wait()
+
+        try:
+            value = compute()
+            self.put(key, value, ttl)
+            return value
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+@dataclass
+class EncodedSnapshot:
+    """
+    API snapshot as the JSON bytes stored in `api_data`, served without decoding it. Compressed bodies are built once
+    per snapshot and kept with it
+    """
+    snapshot_id: int
+    data: bytes
+    etag: str = field(init=False)
+    _encoded: Dict[str, bytes] = field(default_factory=dict, repr=False)
+
+    def __post_init__(self) -> None:
+        self.etag = f"{self.snapshot_id}-{hashlib.sha1(self.data).hexdigest()[:20]}"
+
+    @property
+    def encodings(self) -> Tuple[str, ...]:
+        """Content codings the snapshot can be served with, by order of preference"""
+        return ("br", "gzip", "identity") if brotli is not None else ("gzip", "identity")
+
+    def has_body(self, encoding: str) -> bool:
+        """Whether the body in `encoding` is ready, without compressing it"""
+        return encoding == "identity" or encoding in self._encoded
+
+    def body(self, encoding: str = "identity") -> bytes:
+        if encoding == "identity":
+            return self.data
+        if encoding not in self._encoded:
+            with span(f"compress_{encoding}"):
+                self._encoded[encoding] = self.compress(encoding)
+        return self._encoded[encoding]
+
+    def compress(self, encoding: str) -> bytes:
+        if encoding == "gzip":
+            return gzip.compress(self.data, compresslevel=6, mtime=0)
+        if encoding == "br" and brotli is not None:
+            return brotli.compress(self.data, quality=5)
+        raise ValueError(f"Unsupported content coding: {encoding}")
+
+
+@dataclass
+class MarketSnapshots:
+    """
+    Serves the API snapshot stored in the `api_data` table, decoded once per trading session and data version.
+    Snapshots are never refreshed with a download: a stale one is recomputed from the database
+    """
+    calendar: MarketCalendar = NYSE
+    ttl: float = 60.
+    cache: SnapshotCache = field(default_factory=SnapshotCache)
+
+    def is_fresh(self, taken: datetime, moment: datetime) -> bool:
+        """
+        A snapshot taken while the market is open expires after `ttl` seconds, one taken after the last close
+        stays valid until the next open
+        """
+        taken = self.calendar.localize(taken)
+        if self.calendar.is_open(moment):
+            return (moment - taken).total_seconds() < self.ttl
+        return taken >= self.calendar.last_close(moment)
+
+    def seconds_to_expire(self, taken: datetime, moment: datetime) -> float:
+        if self.calendar.is_open(moment):
+            return max(self.ttl - (moment - self.calendar.localize(taken)).total_seconds(), 0.)
+        return (self.calendar.next_change(moment) - moment).total_seconds()
+
+    def latest_encoded(self, database: SP500Database, compute: Callable[[], dict], moment: datetime = None,
+                       recompute_stale: bool = True) -> EncodedSnapshot:
+        """
+        Latest API snapshot, as stored
+        :param database: database holding the `api_data` table
+        :param compute: builds a snapshot from the database when the stored one is stale or missing
+        :param moment: time of the request, now if not set
+        :param recompute_stale: if False the last stored snapshot is served even if stale, `compute` only runs
+                                when no snapshot was ever published
+        """
+        moment = self.calendar.localize(moment or self.calendar.now())
+        session = self.calendar.session_key(moment)
+        last_request = database.get_last_api_request_info()
+
+        if last_request is not None:
+            taken = datetime.strptime(last_request['Datetime'], "%Y-%m-%d %H:%M:%S")
+            is_fresh = self.is_fresh(taken, moment)
+            if is_fresh or not recompute_stale:
+                return self.cache.get_or_compute(
+                    (session, last_request['id']),
+                    lambda: EncodedSnapshot(last_request['id'], database.query_api_data(last_request['id']).encode()),
+                    ttl=self.seconds_to_expire(taken, moment) if is_fresh else self.ttl)
+
+        def recompute() -> EncodedSnapshot:
+            with span("compute_snapshot"):
+                data = compute()
+            snapshot_id = database.insert_api_data(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), data)
+            # same bytes as the stored snapshot
+            snapshot = EncodedSnapshot(snapshot_id, json.dumps(data).encode())
+            self.cache.put((session, snapshot_id), snapshot, ttl=self.seconds_to_expire(datetime.now(), moment))
+            return snapshot
+
+        return self.cache.get_or_compute((session, None), recompute, ttl=self.seconds_to_expire(moment, moment))
+
+    def latest(self, database: SP500Database, compute: Callable[[], dict], moment: datetime = None,
+               recompute_stale: bool = True) -> dict:
+        """Latest API snapshot decoded, see `latest_encoded`. A snapshot never changes, it is decoded once per id"""
+        snapshot = self.latest_encoded(database, compute, moment, recompute_stale)
+
+        def decode() -> dict:
+            with span("json_decode"):
+                return json.loads(snapshot.data)
+
+        return self.cache.get_or_compute(("decoded", snapshot.snapshot_id), decode)
+
+snapshots = MarketSnapshots()
@@ -0,0 +1,267 @@
+import json
+import math
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Union
+import numpy as np
+from pandas import DataFrame, Series, Timestamp
+
+numeric = Union[int, float]
+
+"""
+Incremental counterpart of `EnhancedDataframe.populate_dataframe`.
+
+`IndicatorState` holds everything needed to fold one more bar into the indicators of a ticker: the exponential
+moving average accumulators (RSI, MACD, ADX), the rolling windows (moving averages, Bollinger, Stochastic, Ichimoku)
+and the last close and volume. Exponential averages reproduce pandas `ewm().mean()` operation by operation, rolling
+windows are recomputed over the buffered values and match pandas up to floating point rounding.
+"""
+
+
+@dataclass
+class Ewm:
+    """Single column exponential moving average, same recursion as pandas `ewm(...).mean()` with ignore_na=False"""
+    com: float
+    adjust: bool = True
+    weighted: float = np.nan
+    old_wt: float = 1.
+
+    @classmethod
+    def from_span(cls, span: float, adjust: bool = True) -> "Ewm":
+        return cls(com=(span - 1) / 2., adjust=adjust)
+
+    def update(self, value: numeric) -> float:
+        alpha = 1. / (1. + self.com)
+        new_wt = 1. if self.adjust else alpha
+        is_observation = value == value
+
+        if self.weighted == self.weighted:
+            self.old_wt *= 1. - alpha
+            if is_observation:
+                if self.weighted != value:
+                    self.weighted = (self.old_wt * self.weighted + new_wt * value) / (self.old_wt + new_wt)
+                self.old_wt = self.old_wt + new_wt if self.adjust else 1.
+        elif is_observation:
+            self.weighted = float(value)
+        return self.weighted
+
+
+def _divide(numerator: float, denominator: float) -> float:
+    """Float division returning inf/nan on a zero denominator, like pandas, instead of raising"""
+    if denominator == 0:
+        if numerator != numerator or numerator == 0:
+            return np.nan
+        return math.copysign(np.inf, numerator) * math.copysign(1., denominator)
+    return numerator / denominator
+
+
+def _window_mean(window: Union[deque, list], length: int) -> float:
+    return math.fsum(window) / length if len(window) == length else np.nan
+
+
+def _window_midpoint(highs: list, lows: list, length: int) -> float:
+    return (max(highs) + min(lows)) / 2 if len(highs) == length else np.nan
+
+
+def _stochastic_k(close: float, highs: list, lows: list) -> float:
+    """%K over the last 14 highs and lows"""
+    if len(highs) < 14:
+        return np.nan
+    return _divide((close - min(lows)) * 100, max(highs) - min(lows))
+
+
+def _ichimoku_mid(highs: list, lows: list) -> float:
+    """Midpoint of tenkan sen and kijun sen over the last 26 highs and lows, senkou span a 26 bars later"""
+    return (_window_midpoint(highs[-9:], lows[-9:], 9) + _window_midpoint(highs, lows, 26)) / 2
+
+
+@dataclass
+class IndicatorState:
+    ticker: str
+    date: str = None
+    bars: int = 0
+    last_close: float = np.nan
+    last_volume: float = np.nan
+
+    rsi_up: Ewm = field(default_factory=lambda: Ewm(com=13, adjust=False))
+    rsi_down: Ewm = field(default_factory=lambda: Ewm(com=13, adjust=False))
+    macd_fast: Ewm = field(default_factory=lambda: Ewm.from_span(12))
+    macd_slow: Ewm = field(default_factory=lambda: Ewm.from_span(26))
+    macd_signal: Ewm = field(default_factory=lambda: Ewm.from_span(9))
+    atr: Ewm = field(default_factory=lambda: Ewm.from_span(14, adjust=False))
+    pdm: Ewm = field(default_factory=lambda: Ewm.from_span(14, adjust=False))
+    ndm: Ewm = field(default_factory=lambda: Ewm.from_span(14, adjust=False))
+    adx: Ewm = field(default_factory=lambda: Ewm.from_span(14, adjust=False))
+
+    closes: deque = field(default_factory=lambda: deque(maxlen=100))
+    typical_prices: deque = field(default_factory=lambda: deque(maxlen=20))
+    highs: deque = field(default_factory=lambda: deque(maxlen=78))
+    lows: deque = field(default_factory=lambda: deque(maxlen=78))
+    stoch_k: deque = field(default_factory=lambda: deque(maxlen=3))
+    ichimoku_mid: deque = field(default_factory=lambda: deque(maxlen=27))
+    previous: dict = None
+
+    @classmethod
+    def from_dataframe(cls, dataframe: DataFrame, ticker: str) -> "IndicatorState":
+        """Builds the state of `ticker` from a raw OHLCV dataframe, the last bar is folded so it can be replaced"""
+        state = cls(ticker)
+        dataframe = dataframe.rename(columns={"Adj Close": "Adj_Close"})
+        dataframe = dataframe[dataframe['Close'].notna()]
+        if len(dataframe) > 1:
+            state.seed(dataframe.iloc[:-1])
+        if len(dataframe):
+            state.fold(dataframe.index[-1], dataframe.iloc[-1])
+        return state
+
+    def seed(self, dataframe: DataFrame) -> None:
+        """
+        Initializes an empty state from a raw OHLCV dataframe: only the exponential averages are accumulated bar by
+        bar, the rolling windows are filled with the last values
+        """
+        highs, lows, closes, adj_closes, volumes = (dataframe[col].to_numpy(dtype=float).tolist() for col in
+                                                    ('High', 'Low', 'Close', 'Adj_Close', 'Volume'))
+        previous_high, previous_low, previous_close = np.nan, np.nan, np.nan
+        for high, low, close, adj_close in zip(highs, lows, closes, adj_closes):
+            self.fold_rsi(close - previous_close)
+            self.fold_macd(adj_close)
+            self.fold_adx(high, low, previous_high, previous_low, previous_close)
+            previous_high, previous_low, previous_close = high, low, close
+
+        self.closes.extend(closes[-100:])
+        self.typical_prices.extend((close + low + high) / 3 for close, low, high in
+                                   zip(closes[-20:], lows[-20:], highs[-20:]))
+        self.highs.extend(highs[-78:])
+        self.lows.extend(lows[-78:])
+        for i in range(max(len(closes) - 3, 0), len(closes)):
+            self.stoch_k.append(_stochastic_k(closes[i], highs[max(i - 13, 0):i + 1], lows[max(i - 13, 0):i + 1]))
+        for i in range(max(len(closes) - 27, 0), len(closes)):
+            self.ichimoku_mid.append(_ichimoku_mid(highs[max(i - 25, 0):i + 1], lows[max(i - 25, 0):i + 1]))
+
+        self.bars = len(closes)
+        self.date = str(dataframe.index[-1])
+        self.last_close = closes[-1]
+        self.last_volume = volumes[-1]
+
+    def fold(self, date: Union[Timestamp, str], bar: Union[Series, dict], snapshot: bool = True) -> dict or None:
+        """
+        Folds a new bar into the state
+        :param date: date of the bar, a bar with the same date as the last folded one replaces it
+        :param bar: Open, High, Low, Close, Adj_Close and Volume of the bar
+        :param snapshot: keeps a copy of the state before the bar so that it can be replaced later on
+        :return: row with the same columns `EnhancedDataframe.populate_dataframe` keeps after `dropna`,
+                 None while the indicators are warming up or if the bar can't be folded (older than the state or
+                 without a close)
+        """
+        if bar['Close'] != bar['Close']:
+            return None
+        if self.date is not None and str(date) <= self.date:
+            if not (str(date) == self.date and self.previous):
+                return None
+            self.restore(self.previous)
+        self.previous = self.to_dict(include_previous=False) if snapshot else None
+        self.date = str(date)
+        self.bars += 1
+
+        open_, high, low, close = float(bar['Open']), float(bar['High']), float(bar['Low']), float(bar['Close'])
+        adj_close, volume = float(bar['Adj_Close']), float(bar['Volume'])
+
+        rsi = self.fold_rsi(close - self.last_close)
+        macd_histogram = self.fold_macd(adj_close)
+        self.fold_adx(high, low, self.highs[-1] if len(self.highs) else np.nan,
+                      self.lows[-1] if len(self.lows) else np.nan, self.last_close)
+
+        self.closes.append(close)
+        self.typical_prices.append((close + low + high) / 3)
+        self.highs.append(high)
+        self.lows.append(low)
+        highs, lows = list(self.highs), list(self.lows)
+
+        bb_middle = _window_mean(self.typical_prices, 20)
+        bb_std = (math.sqrt(math.fsum((price - bb_middle) ** 2 for price in self.typical_prices) / 20)
+                  if len(self.typical_prices) == 20 else np.nan)
+        stoch_k = _stochastic_k(close, highs[-14:], lows[-14:])
+        self.stoch_k.append(stoch_k)
+        self.ichimoku_mid.append(_ichimoku_mid(highs[-26:], lows[-26:]))
+
+        row = {
+            "Date": date, "Open": open_, "High": high, "Low": low, "Close": close, "Adj_Close": adj_close,
+            "Volume": volume, "Ticker": self.ticker,
+            "MA20": _window_mean(list(self.closes)[-20:], 20),
+            "MA50": _window_mean(list(self.closes)[-50:], 50),
+            "MA100": _window_mean(self.closes, 100),
+            "RSI": rsi if self.bars > 15 else np.nan,
+            "MACD_histogram": macd_histogram,
+            "BB_lower": bb_middle - 2 * bb_std,
+            "BB_middle": bb_middle,
+            "BB_upper": bb_middle + 2 * bb_std,
+            "STOCH_K": stoch_k,
+            "STOCH_D": _window_mean(self.stoch_k, 3),
+            "Volume_Change": _divide(volume, self.last_volume) - 1,
+            "Change": (_divide(close, self.last_close) - 1) * 100,
+            "tenkan_sen": _window_midpoint(highs[-9:], lows[-9:], 9),
+            "kijun_sen": _window_midpoint(highs[-26:], lows[-26:], 26),
+            "senkou_span_a": self.ichimoku_mid[0] if len(self.ichimoku_mid) == 27 else np.nan,
+            "senkou_span_b": _window_midpoint(highs[:52], lows[:52], 52) if len(highs) == 78 else np.nan,
+        }
+        self.last_close = close
+        self.last_volume = volume
+
+        if any(value != value for value in row.values()):
+            return None
+        return row
+
+    def fold_rsi(self, delta: float) -> float:
+        ema_up = self.rsi_up.update(max(delta, 0.) if delta == delta else delta)
+        ema_down = self.rsi_down.update(-1 * min(delta, 0.) if delta == delta else delta)
+        return 100 - _divide(100, 1 + _divide(ema_up, ema_down))
+
+    def fold_macd(self, adj_close: float) -> float:
+        """:return: MACD histogram"""
+        macd = (self.macd_slow.update(adj_close) - self.macd_fast.update(adj_close)) * -1
+        return macd - self.macd_signal.update(macd)
+
+    def fold_adx(self, high: float, low: float, previous_high: float, previous_low: float,
+                 previous_close: float) -> None:
+        # same values as `true_range` and `directional_movement`
+        true_range = float(np.fmax(high - low, np.fmax(abs(high - previous_close), abs(low - previous_close))))
+        move_up, move_down = high - previous_high, previous_low - low
+
+        atr = self.atr.update(true_range)
+        pdi = _divide(self.pdm.update(move_up if move_up > 0 and move_up > move_down else 0.), atr) * 100
+        ndi = _divide(self.ndm.update(move_down if move_down > 0 and move_down > move_up else 0.), atr) * 100
+        self.adx.update(_divide(abs(pdi - ndi), pdi + ndi))
+
+    @property
+    def adx_value(self) -> float:
+        return self.adx.weighted * 100
+
+    def to_dict(self, include_previous: bool = True) -> dict:
+        data = {key: value for key, value in self.__dict__.items() if key != "previous"}
+        for key, value in data.items():
+            if isinstance(value, Ewm):
+                data[key] = dict(value.__dict__)
+            elif isinstance(value, deque):
+                data[key] = list(value)
+        if include_previous:
+            data["previous"] = self.previous
+        return data
+
+    def restore(self, data: dict) -> None:
+        for key, value in data.items():
+            current = getattr(self, key)
+            if isinstance(current, Ewm):
+                setattr(self, key, Ewm(**value))
+            elif isinstance(current, deque):
+                setattr(self, key, deque(value, maxlen=current.maxlen))
+            else:
+                setattr(self, key, value)
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict())
+
+    @classmethod
+    def from_json(cls, data: str) -> "IndicatorState":
+        data = json.loads(data)
+        state = cls(data["ticker"])
+        state.restore(data)
+        return state
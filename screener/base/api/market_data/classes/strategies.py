@@ -1,5 +1,5 @@
-from typing import Union
-from numpy import vectorize
+from typing import Union, Callable, Tuple
+import numpy as np
 from pandas import DataFrame
 from dataclasses import dataclass
 from base.api.market_data.classes.dataframe import EnhancedDataframe
@@ -11,48 +11,79 @@ class TickerStrategy:
         self.ticker = ticker
         self.dataframe = EnhancedDataframe.populate_dataframe(dataframe, ticker=self.ticker)
 
+    def last_signal(self, signal: Callable, *columns: str) -> bool:
+        """`signal` evaluated over whole columns of the ticker, value of the last date"""
+        return bool(StrategyRule(signal.__name__, columns, signal).evaluate(self.dataframe)[-1])
+
     def r_ma20_ma50(self) -> bool:
-        signal = vectorize(self.r_ma20_ma50_signal)(self.dataframe['RSI'],
-                                                    self.dataframe['MA20'], self.dataframe["MA50"])[-1]
+        signal = self.last_signal(self.r_ma20_ma50_signal, 'RSI', 'MA20', 'MA50')
         print(f"r_ma20_ma50 returned a {signal} value for {self.ticker}")
         return signal
 
     def r_sd_m(self) -> bool:
-        signal = vectorize(self.r_sd_m_signal)(self.dataframe['RSI'], self.dataframe['STOCH_K'],
-                                               self.dataframe["MACD_histogram"])[-1]
+        signal = self.last_signal(self.r_sd_m_signal, 'RSI', 'STOCH_K', 'MACD_histogram')
         print(f"rsi_stoch_macd returned a {signal} value for {self.ticker} ")
         return signal
 
     def ma_bol_rsi(self) -> bool:
-        signal = vectorize(self.ma_bol_rsi_signal)(self.dataframe['Close'], self.dataframe["MA50"],
-                                                   self.dataframe['BB_Lower'], self.dataframe['RSI'])[-1]
-
+        signal = self.last_signal(self.ma_bol_rsi_signal, 'Close', 'MA50', 'BB_lower', 'RSI')
         print(f"ma_bol_rsi returned a {signal} value for {self.ticker} ")
         return signal
 
+    # Signals are written with element-wise operators so that they evaluate scalars and whole columns alike
+
     @staticmethod
     def ichimoku_entry(span_a: float, span_b: float, rsi: float) -> bool:
-        return ((span_b - span_a) / span_b) > 0.15 and rsi < 35
+        return (((span_b - span_a) / span_b) > 0.15) & (rsi < 35)
 
     @staticmethod
     def ma_bol_rsi_signal(close: Union[float, int], ma50: Union[float, int], bollinger_lower: Union[float, int],
                           rsi: Union[float, int]) -> Union[float, int]:
-        return rsi <= 35 and close < ma50 and close < bollinger_lower
+        return (rsi <= 35) & (close < ma50) & (close < bollinger_lower)
 
     @staticmethod
     def r_sd_m_signal(
             rsi: Union[float, int], stoch_d: Union[float, int], macd: Union[float, int]) -> Union[float, int]:
-        return rsi <= 35 and macd <= -1 and stoch_d <= 15
+        return (rsi <= 35) & (macd <= -1) & (stoch_d <= 15)
 
     @staticmethod
     def r_ma20_ma50_signal(
             rsi: Union[float, int], ma20: Union[float, int], ma50: Union[float, int]) -> Union[float, int]:
-        return rsi < 35 and (ma20 < ma50)
+        return (rsi < 35) & (ma20 < ma50)
 
     @staticmethod
     def rsima_signal(close, rsi, ma_rsi, bb_lower):
-        return (close < bb_lower) and (rsi < 35) and (ma_rsi < 35)
+        return (close < bb_lower) & (rsi < 35) & (ma_rsi < 35)
 
     @staticmethod
     def good_sefi_oversold(sefi, rsi, bollinger, close):
-        return (sefi > 65) and (rsi < 35) and (close < bollinger)
+        return (sefi > 65) & (rsi < 35) & (close < bollinger)
+
+
+@dataclass(frozen=True)
+class StrategyRule:
+    """A signal declared once over the columns it reads, evaluated over whole columns at once"""
+    name: str
+    columns: Tuple[str, ...]
+    signal: Callable
+
+    def evaluate(self, dataframe: DataFrame) -> np.ndarray:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.asarray(self.signal(*(dataframe[col].to_numpy() for col in self.columns)), dtype=bool)
+
+
+ENTRY_STRATEGIES = (
+    StrategyRule("Ichimoku_strategy", ("senkou_span_a", "senkou_span_b", "RSI"), TickerStrategy.ichimoku_entry),
+    StrategyRule("Signal_R_MA20_MA50", ("RSI", "MA20", "MA50"), TickerStrategy.r_ma20_ma50_signal),
+    StrategyRule("Signal_MA_BOL_RSI", ("Close", "MA50", "BB_lower", "RSI"), TickerStrategy.ma_bol_rsi_signal),
+    StrategyRule("Signal_RSI_STOCH_MACD", ("RSI", "STOCH_D", "MACD_histogram"), TickerStrategy.r_sd_m_signal),
+)
+
+MARKET_STRATEGIES = (
+    StrategyRule("good_SEFI_oversold", ("SEFI", "RSI", "BB_lower", "Close"), TickerStrategy.good_sefi_oversold),
+)
+
+
+def evaluate_strategies(dataframe: DataFrame, strategies: Tuple[StrategyRule, ...] = ENTRY_STRATEGIES) -> DataFrame:
+    """Boolean frame with one column per strategy, aligned to `dataframe`"""
+    return DataFrame({strategy.name: strategy.evaluate(dataframe) for strategy in strategies}, index=dataframe.index)
@@ -1,9 +1,16 @@
 from pathlib import Path
-from typing import Union
-from screener.base.api.market_data.classes.dataframe import EnhancedDataframe
-from screener.base.api.market_data.classes.fetchers import GeneralMarketDataFetcher
-from screener.base.api.market_data.classes.databases import SP500Database
-from screener.base.api.market_data.config import db_path
+from typing import Union, List
+from pandas import DataFrame
+from base.api.market_data.classes.dataframe import EnhancedDataframe
+from base.api.market_data.classes.fetchers import GeneralMarketDataFetcher, MarketDataProvider
+from base.api.market_data.classes.databases import SP500Database, BulkLoadReport, UpsertReport
+from base.api.market_data.classes.state import IndicatorState
+from base.api.market_data.classes.indicators import CVI
+from base.api.market_data.classes.raw_bars import CachingProvider
+from base.api.market_data.classes.columnar import ColumnarStore
+from base.api.market_data.classes.parallel import ParallelRebuild
+from base.api.market_data.classes.profiling import span
+from base.api.market_data.config import db_path
 from cython import cfunc
 
 
@@ -15,32 +22,142 @@ def create_database_sp500(filename: str, extension: str, database_dir: Union[Pat
     return database
 
 
+def update_start(database: SP500Database) -> str or None:
+    """
+    First date an update downloads: the day of the oldest indicator state. Sessions missed since (downtime, failed
+    refreshes) are downloaded too and the bars of the day each state stops at replace the ones folded into it
+    """
+    oldest = database.query_oldest_state_date()
+    return oldest[:10] if oldest else None
+
+
+def market_data_fetcher(offline: bool = False, provider: MarketDataProvider = None) -> GeneralMarketDataFetcher:
+    # bars come from the local cache, only the ranges it doesn't hold yet are downloaded
+    return GeneralMarketDataFetcher(provider=provider or CachingProvider(offline=offline), retries=0 if offline else 3)
+
+
+def download_update(database: SP500Database, offline: bool = False, provider: MarketDataProvider = None) -> DataFrame:
+    """
+    Bars an update folds into the stored indicator states, from `update_start` on. Only reads the database, the
+    download doesn't need to hold its write connection
+    """
+    database.create_table_indicator_state()
+    with span("download"):
+        return market_data_fetcher(offline, provider).download_data(period='1d', interval='1d',
+                                                                    start=update_start(database))
+
+
+def update_sp500(database: SP500Database, tickers: List[str], tickers_data: DataFrame) -> UpsertReport:
+    """
+    Folds the downloaded bars into the stored indicator state of each ticker instead of recomputing the
+    indicators over the whole history, the rows of every ticker are upserted in one batch so that repeated
+    updates on the same day replace the day's rows. Every bar from the date of a state on is folded, in order,
+    bars older than the state are skipped
+    """
+    states = database.query_indicator_states()
+    rows, updated_states = [], []
+
+    for ticker in tickers:
+        if ticker not in states:
+            print(f"No indicator state for {ticker}, the database needs to be rebuilt")
+            continue
+        if ticker not in tickers_data.index:
+            continue
+        state = IndicatorState.from_json(states[ticker])
+        bars = tickers_data.loc[ticker].T.rename(columns={"Adj Close": "Adj_Close"})
+        for date, bar in bars.iterrows():
+            row = state.fold(date, bar)
+            if row:
+                rows.append(row)
+        updated_states.append((ticker, state.date, state.to_json()))
+
+    report = UpsertReport()
+    if rows:
+        report = database.upsert_historical(DataFrame(rows).set_index("Date"))
+    database.insert_indicator_states(updated_states)
+    print(report)
+    return report
+
+
 @cfunc
-def populate_sp500(database: SP500Database, update: bool = True) -> None:
+def populate_sp500(database: SP500Database, update: bool = True, wal: bool = True,
+                   offline: bool = False, columnar: bool = True,
+                   provider: MarketDataProvider = None, workers: int = 1,
+                   tickers_data: DataFrame = None) -> Union[BulkLoadReport, UpsertReport]:
     """
      Populates SP500 database with (OHLCV, adj close, and indicators )
 
     :param database: database to be updated
     :param verbose: shows progress in % if set to True
     :param update: updates only last day if set to True
+    :param wal: uses WAL journaling while rebuilding the database (update=False)
+    :param offline: computes the indicators from the cached bars only, nothing is downloaded
+    :param columnar: exports the historical table to its `ColumnarStore` once the database is populated, an update
+                     only reads the rows it wrote from sqlite
+    :param provider: source of the bars, the local `CachingProvider` if not set
+    :param workers: processes computing the indicators of a rebuild (update=False), the chunks are computed while
+                    the next ones download and written all at once
+    :param tickers_data: bars of an update downloaded beforehand with `download_update`, downloaded here if not set
+    :return: rows inserted and updated by an update, rows loaded and load rate of a rebuild
     """
-    sp100_historical = GeneralMarketDataFetcher()
+    sp100_historical = market_data_fetcher(offline, provider)
     tickers = sp100_historical.tickers
 
+    database.create_table_meta()
     if update:
-        tickers_data = sp100_historical.download_data(period='1d', interval='1d')
-        # database.update_db()
-    else:
+        database.create_table_indicator_state()
+        # the rows before `start` don't change, the store in sync with them is only extended with the new ones
+        store = ColumnarStore.open(database) if columnar else None
+        start = update_start(database)
+        if tickers_data is None:
+            tickers_data = download_update(database, offline, provider)
+        with span("update_sp500"):
+            report = update_sp500(database, tickers, tickers_data)
+        with span("cvi_extend"):
+            # a ticker missing from earlier downloads gets its older rows now, the index is recomputed from them on
+            CVI(database).extend(since=report.earliest)
+        if columnar:
+            with span("columnar_export"):
+                ColumnarStore.export(database, base=store, since=start)
+        return report
+
+    with database.bulk_load(database.historical_tablename, wal=wal) as report:
         database.clear_historical()
         print(f"Cleared {database.historical_tablename} table")
-        tickers_data = sp100_historical.download_data(period="1y", interval="1d")
-
-    for n, ticker in enumerate(tickers):
-        percent = 100 * (n / float(len(tickers)))
-        print(f"status:  {percent:.2f}")
+        database.create_table_indicator_state()
+        done = []
 
-        df = tickers_data.loc[ticker].T
-        df = EnhancedDataframe.populate_dataframe(df, ticker)
-        database.do_populate(df)
+        def store_chunk(tickers_data: DataFrame) -> None:
+            """Computes and stores the indicators and states of a downloaded chunk of tickers"""
+            with span("populate_panel"):
+                panel = EnhancedDataframe.populate_panel(tickers_data)
+            database.do_populate(panel)
+            states = []
+            for ticker in tickers_data.index.unique(level=0):
+                state = IndicatorState.from_dataframe(tickers_data.loc[ticker].T, ticker)
+                states.append((ticker, state.date, state.to_json()))
+            database.insert_indicator_states(states)
+            done.extend(states)
+            print(f"status:  {100 * len(done) / float(len(tickers)):.2f}")
 
+        if workers > 1:
+            with ParallelRebuild(workers) as rebuild:
+                failed = sp100_historical.stream_data(rebuild.submit, period="1y", interval="1d")
+                with span("populate_panel"):
+                    panel, states = rebuild.collect(total=len(tickers))
+            if len(panel):
+                database.do_populate(panel)
+            database.insert_indicator_states(states)
+        else:
+            failed = sp100_historical.stream_data(store_chunk, period="1y", interval="1d")
 
+    if failed:
+        print(f"Missing tickers: {failed}")
+    print(report)
+    with span("cvi_extend"):
+        # dropped with the cleared rows, computed over the whole history
+        CVI(database).extend()
+    if columnar:
+        with span("columnar_export"):
+            ColumnarStore.export(database)
+    return report
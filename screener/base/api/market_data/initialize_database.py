@@ -1,18 +1,30 @@
-from screener.base.api.market_data.classes.databases import SP500Database
-from screener.base.api.market_data.config import db_path
-from screener.base.api.market_data.database_functions import populate_sp500
+import argparse
+import os
+from typing import List
+from base.api.market_data.classes.databases import SP500Database
+from base.api.market_data.config import db_path
+from base.api.market_data.database_functions import populate_sp500
 
 
-def main():
+def main(argv: List[str] = None):
+    """Run from the Django project directory: python -m base.api.market_data.initialize_database [--workers N]"""
+    parser = argparse.ArgumentParser(description="Creates the S&P 500 database and computes the indicators")
+    parser.add_argument("--workers", type=int, default=1,
+                        help=f"processes computing the indicators (this machine has {os.cpu_count()} cores)")
+    args = parser.parse_args(argv)
+
     database = SP500Database()
     database.connect_existing_database(db_path=db_path / "sp500.sqlite")
 
     # Creating the tables
     database.create_table_historical()
     database.create_table_api_data()
+    database.create_table_cvi()
+    database.create_table_indicator_state()
+    database.create_table_refresh_log()
 
     # Populate tables
-    populate_sp500(database, update=False)
+    populate_sp500(database, update=False, workers=args.workers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,115 @@
+import time
+import traceback
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable
+from base.api.market_data.classes.databases import SP500Database
+from base.api.market_data.classes.market_calendar import MarketCalendar, NYSE
+from base.api.market_data.api_requests import connect_sp500, market_status_to_dict
+from base.api.market_data.database_functions import download_update, populate_sp500
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+@dataclass
+class MarketDataRefresher:
+    """
+    Updates `historical_data` and publishes a new API snapshot to `api_data` out of the request path: every
+    `interval` seconds while the market is open, and once after each close to pick up the final bars
+    """
+    interval: float = 300.
+    calendar: MarketCalendar = NYSE
+    connect: Callable[[], SP500Database] = connect_sp500
+
+    def is_due(self, database: SP500Database, moment: datetime = None) -> bool:
+        moment = self.calendar.localize(moment or self.calendar.now())
+        last_run = database.query_last_refresh(status="success")
+        if last_run is None:
+            return True
+        finished = self.calendar.localize(datetime.strptime(last_run['Finished'], DATETIME_FORMAT))
+        if self.calendar.is_open(moment):
+            return (moment - finished).total_seconds() >= self.interval
+        return finished < self.calendar.last_close(moment)
+
+    def seconds_to_next_run(self, database: SP500Database, moment: datetime = None) -> float:
+        moment = self.calendar.localize(moment or self.calendar.now())
+        if self.is_due(database, moment):
+            return 0.
+        if self.calendar.is_open(moment):
+            finished = datetime.strptime(database.query_last_refresh(status="success")['Finished'], DATETIME_FORMAT)
+            elapsed = (moment - self.calendar.localize(finished)).total_seconds()
+            return min(self.interval - elapsed, (self.calendar.next_change(moment) - moment).total_seconds())
+        return (self.calendar.next_change(moment) - moment).total_seconds()
+
+    def run_once(self) -> bool:
+        """
+        Downloads the last bars, recomputes the API snapshot and publishes it with a single insert, so readers
+        only ever see complete snapshots
+        :return: True if the refresh succeeded
+        """
+        database = self.connect()
+        database.create_table_refresh_log()
+        started = datetime.now()
+        start = time.perf_counter()
+        try:
+            # the write connection is only held for the writes, not while the bars download
+            tickers_data = download_update(database)
+            with database.writing():
+                populate_sp500(database, update=True, tickers_data=tickers_data)
+            data = market_status_to_dict()
+            snapshot_id = database.insert_api_data(datetime.now().strftime(DATETIME_FORMAT), data)
+        except Exception as error:
+            traceback.print_exc()
+            database.insert_refresh_log(started.strftime(DATETIME_FORMAT), datetime.now().strftime(DATETIME_FORMAT),
+                                        time.perf_counter() - start, "error", error=repr(error))
+            return False
+
+        duration = time.perf_counter() - start
+        database.insert_refresh_log(started.strftime(DATETIME_FORMAT), datetime.now().strftime(DATETIME_FORMAT),
+                                    duration, "success", data_date=database.get_latest_date(),
+                                    snapshot_id=snapshot_id)
+        print(f"Published snapshot {snapshot_id} in {duration:.2f}s")
+        return True
+
+    def run_forever(self) -> None:
+        while True:
+            database = self.connect()
+            database.create_table_refresh_log()
+            wait = self.seconds_to_next_run(database)
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            if not self.run_once():
+                # don't hammer the data provider after a failure
+                time.sleep(self.interval)
+
+
+def refresh_status(database: SP500Database, calendar: MarketCalendar = NYSE) -> dict:
+    """Duration, outcome and lag of the background refreshes"""
+    database.create_table_refresh_log()
+    now = calendar.now()
+    last_run = database.query_last_refresh()
+    last_success = database.query_last_refresh(status="success")
+
+    def age(row) -> float or None:
+        if row is None:
+            return None
+        return (now - calendar.localize(datetime.strptime(row['Finished'], DATETIME_FORMAT))).total_seconds()
+
+    return {
+        "market_open": calendar.is_open(now),
+        "last_run": {
+            "started": last_run['Started'],
+            "finished": last_run['Finished'],
+            "duration": last_run['Duration'],
+            "status": last_run['Status'],
+            "error": last_run['Error'],
+        } if last_run else None,
+        "last_success": {
+            "finished": last_success['Finished'],
+            "duration": last_success['Duration'],
+            "data_date": last_success['Data_Date'],
+            "snapshot": last_success['Snapshot'],
+        } if last_success else None,
+        "lag": age(last_success),
+    }
@@ -0,0 +1,44 @@
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from base.api.market_data.classes.profiling import profiling
+
+
+class ServerTimingMiddleware:
+    """
+    Times each request while market data profiling is on (MARKET_DATA_PROFILING=1): the spans of the request are
+    sent back in a Server-Timing header and added to the cumulative metrics (`market-data/metrics`). Runs in the
+    mode of the views it wraps, the async views are not moved to a thread
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not profiling.enabled:
+            return self.get_response(request)
+        start = time.perf_counter()
+        with profiling.request() as profile:
+            response = self.get_response(request)
+        return self.add_timings(request, response, profile, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        if not profiling.enabled:
+            return await self.get_response(request)
+        start = time.perf_counter()
+        with profiling.request() as profile:
+            response = await self.get_response(request)
+        return self.add_timings(request, response, profile, time.perf_counter() - start)
+
+    @staticmethod
+    def add_timings(request, response, profile, duration: float):
+        profiling.metrics.add_request(request.path, duration)
+        timings = profile.server_timing()
+        response["Server-Timing"] = f"{timings + ', ' if timings else ''}total;dur={duration * 1000:.1f}"
+        return response
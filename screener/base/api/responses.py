@@ -0,0 +1,64 @@
+from typing import Iterable
+from django.http import HttpRequest, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import parse_etags, quote_etag
+from base.api.market_data.classes.snapshots import EncodedSnapshot
+
+
+def negotiate_encoding(accept_encoding: str, available: Iterable[str]) -> str:
+    """
+    Content coding of `available` (by order of preference) the client accepts with the highest weight
+    :param accept_encoding: value of the Accept-Encoding header
+    """
+    weights = {}
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.strip().partition(";")
+        q = 1.
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.
+        weights[name.strip().lower()] = q
+
+    def weight(coding: str) -> float:
+        if coding in weights:
+            return weights[coding]
+        if "*" in weights:
+            return weights["*"]
+        return 1. if coding == "identity" else 0.
+
+    accepted = [coding for coding in available if weight(coding) > 0]
+    return max(accepted, key=weight, default="identity")
+
+
+def snapshot_response(request: HttpRequest, snapshot: EncodedSnapshot, chunk_size: int = 64 * 1024,
+                      stream: bool = True) -> HttpResponse:
+    """
+    Streams the stored bytes of `snapshot`, compressed if the client accepts it, or answers 304 when the client
+    already holds this version (If-None-Match). Clients revalidate on every poll (no-cache)
+    :param stream: False for the async views, the ASGI handler sends the body in chunks itself while a streaming
+                   response with a sync iterator would be consumed on a thread
+    """
+    encoding = negotiate_encoding(request.META.get("HTTP_ACCEPT_ENCODING", ""), snapshot.encodings)
+    # every representation has its own tag
+    etag = quote_etag(snapshot.etag if encoding == "identity" else f"{snapshot.etag}-{encoding}")
+
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    # weak comparison, a W/ prefix added by a proxy still matches
+    if if_none_match and any(tag.removeprefix("W/") in ("*", etag) for tag in parse_etags(if_none_match)):
+        response = HttpResponseNotModified()
+    else:
+        body = snapshot.body(encoding)
+        if not stream:
+            response = HttpResponse(body, content_type="application/json")
+        else:
+            response = StreamingHttpResponse((body[i:i + chunk_size] for i in range(0, len(body), chunk_size)),
+                                             content_type="application/json")
+        response["Content-Length"] = str(len(body))
+        if encoding != "identity":
+            response["Content-Encoding"] = encoding
+
+    response["ETag"] = etag
+    response["Vary"] = "Accept-Encoding"
+    response["Cache-Control"] = "no-cache"
+    return response
@@ -11,5 +11,8 @@ urlpatterns = [
     path("watchlists/", views.get_watchlists),
     path('token/', MyTokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
-    path('market-data/general', views.get_general_market_data)
+    path('market-data/general', views.get_general_market_data),
+    path('market-data/status', views.get_market_data_status),
+    path('market-data/charts', views.get_chart_data),
+    path('market-data/metrics', views.get_market_data_metrics),
 ]
\ No newline at end of file
@@ -1,10 +1,18 @@
+from datetime import date
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from rest_framework_simplejwt.views import TokenObtainPairView
 from .serializers import WatchlistSerializer
-from base.api.market_data.api_requests import general_market_data_request
+from base.api.market_data.api_requests import general_market_data_snapshot, chart_data_request, connect_sp500, \
+    ENTRY_FORMATS
+from base.api.responses import negotiate_encoding, snapshot_response
+from base.api.executor import run_coalesced
+from base.api.market_data.refresher import refresh_status
+from base.api.market_data.classes.analysis import IndexDataUnavailable
+from base.api.market_data.classes.profiling import profiling, span
 
 
 class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
@@ -48,7 +56,70 @@ def get_watchlists(request):
     return Response(serializer.data)
 
 
-@api_view(["GET"])
 # @permission_classes([IsAuthenticated])
-def get_general_market_data(request):
-    return Response(general_market_data_request())
+async def get_general_market_data(request):
+    """
+    Async view, the database read and the compression of a new snapshot run on the executor and are shared by the
+    concurrent polls, the event loop only sends bytes
+    """
+    # require_GET only wraps async views from Django 5
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    # the stored snapshot is already JSON, it is sent as is instead of being decoded and rendered again by DRF
+    entries_format = request.GET.get("format", "nested")
+    if entries_format not in ENTRY_FORMATS:
+        return HttpResponseBadRequest(f"format must be one of {', '.join(ENTRY_FORMATS)}")
+    try:
+        snapshot = await run_coalesced(("snapshot", entries_format), general_market_data_snapshot, entries_format)
+    except IndexDataUnavailable:
+        return snapshot_unavailable()
+    encoding = negotiate_encoding(request.META.get("HTTP_ACCEPT_ENCODING", ""), snapshot.encodings)
+    if not snapshot.has_body(encoding):
+        await run_coalesced(("body", snapshot.etag, encoding), snapshot.body, encoding)
+    with span("response"):
+        return snapshot_response(request, snapshot, stream=False)
+
+
+def snapshot_unavailable() -> HttpResponse:
+    """503 until the refresher published a first snapshot (or cached the index bars one is built from)"""
+    response = HttpResponse("No market data snapshot was published yet", status=503, content_type="text/plain")
+    response["Retry-After"] = "60"
+    return response
+
+
+MAX_CHART_TICKERS = 100
+
+
+@api_view(["GET"])
+def get_chart_data(request):
+    """
+    Close, MA20 and MA50 of several tickers in one request:
+    ?tickers=AAPL,MSFT[&start=YYYY-MM-DD][&end=YYYY-MM-DD (excluded)][&points=N (LTTB downsampling)]
+    """
+    tickers = [ticker.strip().upper() for ticker in request.GET.get("tickers", "").split(",") if ticker.strip()]
+    if not tickers or len(tickers) > MAX_CHART_TICKERS:
+        return Response({"detail": f"tickers must list 1 to {MAX_CHART_TICKERS} tickers"}, status=400)
+    points = request.GET.get("points")
+    if points is not None and (not points.isdigit() or int(points) < 3):
+        return Response({"detail": "points must be an integer of at least 3"}, status=400)
+    bounds = {}
+    for bound in ("start", "end"):
+        value = request.GET.get(bound)
+        try:
+            bounds[bound] = date.fromisoformat(value).isoformat() if value is not None else None
+        except ValueError:
+            return Response({"detail": f"{bound} must be a date formatted as YYYY-MM-DD"}, status=400)
+    if bounds["start"] and bounds["end"] and bounds["start"] >= bounds["end"]:
+        return Response({"detail": "start must be before end"}, status=400)
+    return Response(chart_data_request(list(dict.fromkeys(tickers)), **bounds, points=int(points) if points else None))
+
+
+@api_view(["GET"])
+def get_market_data_status(request):
+    return Response(refresh_status(connect_sp500()))
+
+
+@api_view(["GET"])
+def get_market_data_metrics(request):
+    """Cumulative timings of the market data spans, SQL statements and requests (MARKET_DATA_PROFILING=1)"""
+    return Response({"enabled": profiling.enabled, **profiling.metrics.to_dict()})
@@ -0,0 +1,29 @@
+import json
+from django.core.management.base import BaseCommand
+from base.api.market_data.benchmarks import BenchmarkSuite, compare, write_results
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the market data pipeline offline on a synthetic S&P 500 universe and writes the results as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=2520, help="sessions of synthetic history per ticker")
+        parser.add_argument("--sample", type=int, default=20,
+                            help="tickers the single ticker benchmarks loop over")
+        parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark, the best one is kept")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", default=None,
+                            help="JSON file the results are written to, benchmark-<commit>.json if not set")
+        parser.add_argument("--compare", default=None, help="JSON results of an earlier run to compare against")
+
+    def handle(self, *args, **options):
+        suite = BenchmarkSuite(days=options["days"], sample=options["sample"], repeat=options["repeat"],
+                               seed=options["seed"])
+        results = suite.run()
+        output = options["output"] or f"benchmark-{results['meta']['commit'] or 'local'}.json"
+        write_results(results, output)
+        self.stdout.write(f"Results written to {output}")
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                baseline = json.load(f)
+            self.stdout.write("\n".join(compare(baseline, results)))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from base.api.market_data.refresher import MarketDataRefresher
+
+
+class Command(BaseCommand):
+    help = "Updates the historical data and publishes the market data API snapshot on a schedule"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=300.,
+                            help="seconds between refreshes while the market is open")
+        parser.add_argument("--once", action="store_true", help="refresh once and exit")
+
+    def handle(self, *args, **options):
+        refresher = MarketDataRefresher(interval=options["interval"])
+        if options["once"]:
+            if not refresher.run_once():
+                self.stderr.write("Refresh failed")
+            return
+        self.stdout.write(f"Refreshing market data every {options['interval']:.0f}s while the market is open")
+        refresher.run_forever()
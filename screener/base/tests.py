@@ -1,3 +1,1264 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+import numpy as np
+import pandas
+from pandas import DataFrame, DatetimeIndex, Timestamp, bdate_range
+from pandas.testing import assert_frame_equal
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase
+from base.api.market_data.classes.analysis import IndexDataUnavailable, SP500Analysis
+from base.api.market_data.classes.breadth import BreadthPanel
+from base.api.market_data.classes.columnar import ColumnarStore
+from base.api.market_data.classes.databases import ConnectionPool, SP500Database, UpsertReport
+from base.api.market_data.classes.dataframe import EnhancedDataframe, COMPACT_TOLERANCES, from_day_numbers
+from base.api.market_data.classes.indicators import ADR, ADR_CAP, ADX, CVI, Sefi, ZeroDecliners, compute_adx, \
+    get_atr, get_tr, get_pdm, get_ndm, get_di, get_adx
+from base.api.market_data.classes.fetchers import ChunkedDownloader, FileProvider, YahooProvider, to_tickers_data
+from base.api.market_data.classes.market_calendar import NYSE, MarketCalendar
+from base.api.market_data.classes.raw_bars import CachingProvider
+from base.api.market_data.classes.snapshots import EncodedSnapshot, SnapshotCache
+from base.api.responses import negotiate_encoding, snapshot_response
+from base.api.market_data.api_requests import columnar_entries, entry_columns, parse_entries, plotting_data_entries
+from base.api.market_data.classes.downsampling import lttb_indices
+from base.api.market_data.benchmarks import SyntheticProvider, compare
+from base.api.market_data.classes.parallel import ParallelRebuild
+from base.api.market_data.classes.state import IndicatorState
+from base.api.market_data.database_functions import update_sp500, update_start
+from base.api.market_data.classes.strategies import ENTRY_STRATEGIES, MARKET_STRATEGIES, TickerStrategy, \
+    evaluate_strategies
+from base.api.market_data.classes.profiling import Profiling, ProfiledConnection, profiling
+from base.api.middleware import ServerTimingMiddleware
+from base.api.executor import run_coalesced
+from base.api.live import SnapshotBroadcaster, live_updates, snapshot_diff
+from base.api.views import get_chart_data
+from base.api.market_data.refresher import DATETIME_FORMAT, MarketDataRefresher, refresh_status
 
-# Create your tests here.
+
+def ohlc_dataframe(days: int = 300, seed: int = 0) -> DataFrame:
+    rng = np.random.default_rng(seed)
+    closes = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, days)))
+    return DataFrame({
+        "High": closes * (1 + rng.uniform(0, 0.02, days)),
+        "Low": closes * (1 - rng.uniform(0, 0.02, days)),
+        "Close": closes,
+    }, index=bdate_range("2020-01-01", periods=days))
+
+
+def scalar_adx(df: DataFrame) -> tuple:
+    """Reference ATR/PDI/NDI/ADX computed row by row with the scalar helpers"""
+    tr = np.vectorize(get_tr)(df['High'], df['Low'], df['Close'].shift())
+    atr = DataFrame({"TR": tr}, index=df.index)["TR"].ewm(span=14, adjust=False).mean()
+    pdm = np.vectorize(get_pdm)(df['High'], df['High'].shift(), df['Low'], df['Low'].shift())
+    ndm = np.vectorize(get_ndm)(df['High'], df['High'].shift(), df['Low'], df['Low'].shift())
+    pdi = get_di(DataFrame({"PDM": pdm}, index=df.index)["PDM"], atr)
+    ndi = get_di(DataFrame({"NDM": ndm}, index=df.index)["NDM"], atr)
+    return atr, pdi, ndi, get_adx(pdi, ndi)
+
+
+class ADXTestCase(SimpleTestCase):
+    def test_matches_scalar_helpers(self):
+        df = ohlc_dataframe()
+        for expected, result in zip(scalar_adx(df), ADX(df['High'], df['Low'], df['Close']).data):
+            np.testing.assert_array_equal(expected.to_numpy(), result.to_numpy())
+
+    def test_get_atr_matches_scalar_helpers(self):
+        df = ohlc_dataframe()
+        np.testing.assert_array_equal(scalar_adx(df)[0].to_numpy(), get_atr(df).to_numpy())
+
+    def test_compute_adx_writes_no_scratch_columns(self):
+        df = ohlc_dataframe()
+        compute_adx(df)
+        self.assertEqual(list(df.columns), ["High", "Low", "Close", "ATR", "PDI", "NDI", "ADX"])
+
+    def test_panel_matches_single_ticker(self):
+        tickers = {ticker: ohlc_dataframe(seed=seed) for seed, ticker in enumerate(["AAA", "BBB", "CCC"])}
+        panel = ADX(*(DataFrame({ticker: df[col] for ticker, df in tickers.items()})
+                      for col in ("High", "Low", "Close"))).data
+        for ticker, df in tickers.items():
+            for expected, result in zip(ADX(df['High'], df['Low'], df['Close']).data, panel):
+                np.testing.assert_array_equal(expected.to_numpy(), result[ticker].to_numpy())
+
+
+def new_york(*args) -> datetime:
+    return datetime(*args, tzinfo=ZoneInfo("America/New_York"))
+
+
+class MarketCalendarTestCase(SimpleTestCase):
+    def test_holidays(self):
+        for day in [date(2023, 1, 2), date(2023, 1, 16), date(2023, 2, 20), date(2023, 4, 7), date(2023, 5, 29),
+                    date(2023, 6, 19), date(2023, 7, 4), date(2023, 9, 4), date(2023, 11, 23), date(2023, 12, 25),
+                    date(2022, 12, 26), date(2027, 6, 18)]:
+            self.assertFalse(NYSE.is_trading_day(day), day)
+        # new year's day 2022 fell on a saturday and was not observed on the previous friday
+        self.assertTrue(NYSE.is_trading_day(date(2021, 12, 31)))
+        self.assertTrue(NYSE.is_trading_day(date(2023, 11, 24)))
+
+    def test_session_hours(self):
+        self.assertFalse(NYSE.is_open(new_york(2023, 3, 14, 9, 29)))
+        self.assertTrue(NYSE.is_open(new_york(2023, 3, 14, 9, 30)))
+        self.assertFalse(NYSE.is_open(new_york(2023, 3, 14, 16)))
+        self.assertFalse(NYSE.is_open(new_york(2023, 11, 24, 13, 30)))
+        self.assertTrue(NYSE.is_open(datetime(2023, 3, 14, 14, 0, tzinfo=ZoneInfo("UTC"))))
+
+    def test_last_close_and_next_change(self):
+        # saturday after good friday
+        moment = new_york(2023, 4, 8, 12)
+        self.assertEqual(NYSE.last_close(moment), new_york(2023, 4, 6, 16))
+        self.assertEqual(NYSE.next_change(moment), new_york(2023, 4, 10, 9, 30))
+        self.assertEqual(NYSE.session_key(moment), "2023-04-06:closed")
+        moment = new_york(2023, 4, 10, 10)
+        self.assertEqual(NYSE.last_close(moment), new_york(2023, 4, 6, 16))
+        self.assertEqual(NYSE.next_change(moment), new_york(2023, 4, 10, 16))
+        self.assertEqual(NYSE.session_key(moment), "2023-04-10:open")
+
+
+class SnapshotCacheTestCase(SimpleTestCase):
+    def test_ttl_and_lru(self):
+        now = [0.]
+        cache = SnapshotCache(maxsize=2, ttl=10, clock=lambda: now[0])
+        cache.put("a", 1)
+        cache.put("b", 2, ttl=100)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        now[0] = 10
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get_or_compute("a", lambda: 4), 4)
+
+    def test_concurrent_misses_compute_once(self):
+        cache = SnapshotCache()
+        calls, results = [], []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return {"data": 1}
+
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute("key", compute)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"data": 1}] * 8)
+
+    def test_failed_compute_is_retried(self):
+        cache = SnapshotCache()
+
+        def fail():
+            raise RuntimeError
+
+        with self.assertRaises(RuntimeError):
+            cache.get_or_compute("key", fail)
+        self.assertEqual(cache.get_or_compute("key", lambda: 1), 1)
+
+
+def ohlcv_dataframe(days: int = 300, seed: int = 0) -> DataFrame:
+    df = ohlc_dataframe(days, seed)
+    return df.assign(Open=df['Close'], **{"Adj Close": df['Close']}, Volume=1e6)
+
+
+class CompactModeTestCase(SimpleTestCase):
+    def setUp(self):
+        self.bars = to_tickers_data({ticker: ohlcv_dataframe(seed=seed) for seed, ticker in enumerate(["AAA", "BBB"])})
+
+    def test_within_tolerances(self):
+        full = EnhancedDataframe.populate_panel(self.bars)
+        compact = EnhancedDataframe.populate_panel(self.bars, compact=True)
+        for column, (rtol, atol) in COMPACT_TOLERANCES.items():
+            self.assertEqual(compact[column].dtype, np.float32)
+            np.testing.assert_allclose(compact[column].to_numpy(dtype=float), full[column], rtol=rtol, atol=atol)
+        self.assertEqual(compact["Ticker"].dtype, "category")
+        self.assertEqual(compact["Date"].dtype, np.int32)
+        self.assertTrue((from_day_numbers(compact["Date"]) == full.index).all())
+        np.testing.assert_array_equal(compact["Volume"], full["Volume"])
+
+    def test_memory_report(self):
+        report = EnhancedDataframe.memory_report(EnhancedDataframe.populate_panel(self.bars))
+        self.assertGreater(report.reduction, .4)
+        self.assertLess(report.after["Close"], report.before["Close"])
+        self.assertIn("Total", str(report))
+
+
+class PopulatePanelTestCase(SimpleTestCase):
+    def setUp(self):
+        bars = to_tickers_data({ticker: ohlcv_dataframe(seed=seed)
+                                for seed, ticker in enumerate(["AAA", "BBB", "CCC", "DDD"])})
+        # a ticker listed later than the others, sessions missing in the middle of histories
+        bars.loc["BBB", bars.columns[:120]] = np.nan
+        bars.loc["CCC", bars.columns[150:153]] = np.nan
+        bars.loc[("DDD", "Volume"), bars.columns[200]] = np.nan
+        bars.loc[("AAA", "Close"), bars.columns[-1]] = np.nan
+        self.bars = bars
+
+    def test_matches_populate_dataframe(self):
+        panel = EnhancedDataframe.populate_panel(self.bars)
+        expected = pandas.concat([EnhancedDataframe.populate_dataframe(self.bars.loc[ticker].T, ticker=ticker)
+                                  for ticker in self.bars.index.unique(level=0)])
+        self.assertEqual(set(panel.columns), set(expected.columns))
+        assert_frame_equal(panel, expected[panel.columns], check_freq=False, check_names=False)
+        dates = {ticker: rows.index for ticker, rows in panel.groupby("Ticker")}
+        self.assertGreater(dates["BBB"][0], dates["AAA"][0])
+        self.assertNotIn(self.bars.columns[151], dates["CCC"])
+        self.assertNotIn(self.bars.columns[200], dates["DDD"])
+        self.assertNotIn(self.bars.columns[-1], dates["AAA"])
+        self.assertIn(self.bars.columns[-1], dates["CCC"])
+
+
+class SnapshotResponseTestCase(SimpleTestCase):
+    def setUp(self):
+        self.snapshot = EncodedSnapshot(3, json.dumps({"entries": list(range(50000))}).encode())
+        self.factory = RequestFactory()
+
+    def get(self, **headers):
+        return snapshot_response(self.factory.get("/market-data/general", **headers), self.snapshot, chunk_size=1024)
+
+    def test_negotiate_encoding(self):
+        self.assertEqual(negotiate_encoding("", ("br", "gzip", "identity")), "identity")
+        self.assertEqual(negotiate_encoding("gzip, deflate, br", ("br", "gzip", "identity")), "br")
+        self.assertEqual(negotiate_encoding("gzip, br;q=0.5", ("br", "gzip", "identity")), "gzip")
+        self.assertEqual(negotiate_encoding("br", ("gzip", "identity")), "identity")
+        self.assertEqual(negotiate_encoding("*;q=0, identity;q=0", ("gzip", "identity")), "identity")
+
+    def test_streams_stored_bytes(self):
+        response = self.get()
+        self.assertTrue(response.streaming)
+        self.assertEqual(b"".join(response.streaming_content), self.snapshot.data)
+        self.assertEqual(int(response["Content-Length"]), len(self.snapshot.data))
+        self.assertFalse(response.has_header("Content-Encoding"))
+
+    def test_not_streamed(self):
+        response = snapshot_response(self.factory.get("/market-data/general", HTTP_ACCEPT_ENCODING="gzip"),
+                                     self.snapshot, stream=False)
+        self.assertFalse(response.streaming)
+        self.assertEqual(gzip.decompress(response.content), self.snapshot.data)
+        self.assertEqual(int(response["Content-Length"]), len(response.content))
+
+    def test_gzip(self):
+        response = self.get(HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        body = b"".join(response.streaming_content)
+        self.assertEqual(gzip.decompress(body), self.snapshot.data)
+        self.assertLess(len(body), len(self.snapshot.data))
+        self.assertNotEqual(response["ETag"], self.get()["ETag"])
+
+    def test_not_modified(self):
+        etag = self.get(HTTP_ACCEPT_ENCODING="gzip")["ETag"]
+        response = self.get(HTTP_ACCEPT_ENCODING="gzip", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(self.get(HTTP_ACCEPT_ENCODING="gzip", HTTP_IF_NONE_MATCH=f'W/{etag}').status_code, 304)
+        # a new snapshot has a new tag
+        self.snapshot = EncodedSnapshot(4, self.snapshot.data)
+        self.assertEqual(self.get(HTTP_ACCEPT_ENCODING="gzip", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class EntriesSerializerTestCase(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        columns = ["senkou_span_a", "senkou_span_b", "RSI", "MA20", "MA50", "Close", "BB_lower", "STOCH_D",
+                   "MACD_histogram"]
+        self.entries = DataFrame({column: rng.normal(50, 20, 40) for column in columns}, index=range(100, 140))
+        self.entries["Ticker"] = [f"T{i}" for i in range(40)]
+        for strategy in ENTRY_STRATEGIES:
+            self.entries[strategy.name] = rng.random(40) > .5
+
+    def test_nested_payload(self):
+        entries = parse_entries(self.entries)
+        row = self.entries.iloc[7]
+        self.assertEqual(list(entries), list(self.entries["Ticker"]))
+        self.assertEqual(entries["T7"]["oversold_stochastic"], {
+            "status": bool(row["Signal_MA_BOL_RSI"]),
+            "values": {"close": row["Close"], "ma50": row["MA50"], "bollinger_lower": row["BB_lower"],
+                       "rsi": row["RSI"]},
+        })
+        self.assertEqual(entries["T7"]["oversold_MACD"]["values"]["macd"], row["MACD_histogram"])
+        self.assertFalse(parse_entries(self.entries.iloc[:0]))
+
+    def test_columnar_payload(self):
+        columns = entry_columns(self.entries)
+        self.assertEqual(columns["values"]["rsi"], self.entries["RSI"].tolist())
+        self.assertEqual(columns["status"]["Ichimoku"], self.entries["Ichimoku_strategy"].tolist())
+        self.assertEqual(columns["strategy_values"]["oversold_MACD"], ["rsi", "stochastic_d", "macd"])
+        # stored snapshots hold the nested form
+        self.assertEqual(columnar_entries(json.loads(json.dumps(parse_entries(self.entries)))), columns)
+        self.assertEqual(columnar_entries(False)["tickers"], [])
+
+
+# the rules as they were written before the strategies were evaluated column-wise, applied one row at a time to numpy
+# scalars like `np.vectorize` did
+ROW_WISE_RULES = {
+    "Ichimoku_strategy": lambda row: ((row.senkou_span_b - row.senkou_span_a) / row.senkou_span_b) > 0.15
+    and row.RSI < 35,
+    "Signal_R_MA20_MA50": lambda row: row.RSI < 35 and (row.MA20 < row.MA50),
+    "Signal_MA_BOL_RSI": lambda row: row.RSI <= 35 and row.Close < row.MA50 and row.Close < row.BB_lower,
+    "Signal_RSI_STOCH_MACD": lambda row: row.RSI <= 35 and row.MACD_histogram <= -1 and row.STOCH_D <= 15,
+    "good_SEFI_oversold": lambda row: (row.SEFI > 65) and (row.RSI < 35) and (row.Close < row.BB_lower),
+}
+
+
+class StrategiesTestCase(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        size = 400
+        self.dataframe = DataFrame({
+            "senkou_span_a": rng.uniform(50, 150, size), "senkou_span_b": rng.uniform(50, 150, size),
+            "RSI": rng.uniform(0, 100, size), "MA20": rng.uniform(80, 120, size), "MA50": rng.uniform(80, 120, size),
+            "Close": rng.uniform(80, 120, size), "BB_lower": rng.uniform(80, 120, size),
+            "STOCH_D": rng.uniform(0, 100, size), "STOCH_K": rng.uniform(0, 100, size),
+            "MACD_histogram": rng.uniform(-5, 5, size), "SEFI": rng.uniform(0, 100, size),
+        }, index=bdate_range("2022-01-03", periods=size))
+        # warm-up rows of the indicators and a flat cloud
+        self.dataframe.iloc[:20, ::2] = np.nan
+        self.dataframe.iloc[20:25, 1] = 0.
+
+    def row_wise(self, dataframe: DataFrame, name: str) -> list:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return [bool(ROW_WISE_RULES[name](row)) for _, row in dataframe.iterrows()]
+
+    def test_matches_row_wise_rules(self):
+        signals = evaluate_strategies(self.dataframe, ENTRY_STRATEGIES + MARKET_STRATEGIES)
+        self.assertEqual(list(signals.columns), list(ROW_WISE_RULES))
+        self.assertTrue((signals.index == self.dataframe.index).all())
+        for name in ROW_WISE_RULES:
+            expected = self.row_wise(self.dataframe, name)
+            self.assertTrue(any(expected), name)
+            self.assertEqual(signals[name].tolist(), expected, name)
+
+    def test_ticker_strategy(self):
+        for seed in range(5):
+            strategy = TickerStrategy("AAA", ohlcv_dataframe(seed=seed))
+            last = strategy.dataframe.iloc[-1]
+            self.assertIs(strategy.r_ma20_ma50(), bool(last.RSI < 35 and (last.MA20 < last.MA50)))
+            self.assertIs(strategy.r_sd_m(), bool(last.RSI <= 35 and last.MACD_histogram <= -1
+                                                  and last.STOCH_K <= 15))
+            self.assertIs(strategy.ma_bol_rsi(), bool(last.RSI <= 35 and last.Close < last.MA50
+                                                      and last.Close < last.BB_lower))
+
+
+class LTTBTestCase(SimpleTestCase):
+    def test_downsampling(self):
+        y = np.sin(np.linspace(0, 20, 2000))
+        y[1234] = 5
+        indices = lttb_indices(y, 100)
+        self.assertEqual(len(indices), 100)
+        self.assertEqual((indices[0], indices[-1]), (0, 1999))
+        self.assertTrue((np.diff(indices) > 0).all())
+        self.assertIn(1234, indices)
+
+    def test_short_series(self):
+        np.testing.assert_array_equal(lttb_indices(np.arange(10.), 20), np.arange(10))
+        np.testing.assert_array_equal(lttb_indices(np.arange(10.), 2), np.arange(10))
+
+
+class BenchmarkTestCase(SimpleTestCase):
+    def test_synthetic_provider(self):
+        provider = SyntheticProvider(days=300, end=date(2023, 7, 5))
+        bars = provider.download(["AAA", "BBB"], "1y", "1d")
+        assert_frame_equal(SyntheticProvider(days=300, end=date(2023, 7, 5)).download(["AAA", "BBB"], "1y", "1d"),
+                           bars)
+        self.assertEqual(bars.columns[-1], Timestamp("2023-07-05"))
+        self.assertNotIn(Timestamp("2023-07-04"), bars.columns)
+        self.assertEqual(len(provider.read("AAA")), 300)
+        self.assertFalse(np.allclose(bars.loc["AAA"], bars.loc["BBB"]))
+        closes = provider.read("AAA")
+        self.assertTrue((closes["High"] >= closes[["Open", "Close"]].max(axis=1)).all())
+
+    def test_compare(self):
+        baseline = {"meta": {"commit": "a"}, "results": {"cvi": {"min": 2.}}}
+        current = {"meta": {"commit": "b"}, "results": {"cvi": {"min": 1.}, "sefi": {"min": 1.}}}
+        lines = compare(baseline, current)
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith("cvi") and lines[1].endswith("0.50"))
+
+
+class ProfilingTestCase(SimpleTestCase):
+    def setUp(self):
+        self.enabled = profiling.enabled
+        profiling.enabled = True
+        profiling.metrics.reset()
+
+    def tearDown(self):
+        profiling.enabled = self.enabled
+        profiling.metrics.reset()
+
+    def test_spans(self):
+        with profiling.request() as profile:
+            with profiling.span("stage"):
+                pass
+            with profiling.span("stage"):
+                pass
+        self.assertEqual(profile.timings["stage"].count, 2)
+        self.assertEqual(profiling.metrics.to_dict()["spans"]["stage"]["count"], 2)
+        self.assertIn('stage;dur=', profile.server_timing())
+        self.assertIn('desc="2x"', profile.server_timing())
+
+    def test_sql(self):
+        connection = sqlite3.connect(":memory:", factory=profiling.connection_factory)
+        self.assertIsInstance(connection, ProfiledConnection)
+        with profiling.request() as profile:
+            connection.execute("CREATE TABLE t (x INTEGER)")
+            connection.executemany("INSERT INTO t VALUES (?)", [(1,), (2,)])
+            self.assertEqual(connection.execute("SELECT x FROM t").fetchall(), [(1,), (2,)])
+        self.assertEqual(profile.timings["sql"].count, 3)
+        self.assertEqual(profile.timings["sql_fetch"].count, 1)
+
+    def test_disabled(self):
+        disabled = Profiling(enabled=False)
+        self.assertIs(disabled.span("a"), disabled.span("b"))
+        self.assertIs(disabled.connection_factory, sqlite3.Connection)
+        with disabled.span("a"):
+            pass
+        self.assertEqual(disabled.metrics.to_dict(), {"spans": {}, "requests": {}})
+
+    def test_middleware(self):
+        def view(request):
+            with profiling.span("work"):
+                return HttpResponse("ok")
+
+        response = ServerTimingMiddleware(view)(RequestFactory().get("/api/market-data"))
+        self.assertTrue(response["Server-Timing"].startswith("work;dur="))
+        self.assertIn("total;dur=", response["Server-Timing"])
+        self.assertEqual(profiling.metrics.to_dict()["requests"]["/api/market-data"]["count"], 1)
+
+
+class ConnectionPoolTestCase(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(f"{self.directory.name}/sp500.sqlite", timeout=.1)
+        self.database = SP500Database()
+        self.database.connect_pool(self.pool)
+        with self.database.writing():
+            self.database.create_table_api_data()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_connections(self):
+        self.assertIs(self.pool.reader(), self.pool.reader())
+        other = []
+        thread = threading.Thread(target=lambda: other.append(self.pool.reader()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], self.pool.reader())
+        self.assertEqual(self.pool.reader().execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.assertIsNot(SP500Database()._tablenames, self.database._tablenames)
+
+    def test_readers_dont_wait_for_the_writer(self):
+        snapshot_id = self.database.insert_api_data("2023-01-03 10:00:00", {"a": 1})
+        self.assertEqual(self.database.get_last_api_request_info()['id'], snapshot_id)
+        with self.pool.writer() as connection:
+            connection.execute("INSERT INTO api_data (Datetime, Data) VALUES ('2023-01-03 11:00:00', '{}')")
+            counts = []
+            thread = threading.Thread(target=lambda: counts.append(
+                self.pool.reader().execute("SELECT COUNT(*) FROM api_data").fetchone()[0]))
+            thread.start()
+            thread.join()
+            # the reader sees the last committed data while the write is in progress
+            self.assertEqual(counts, [1])
+            connection.commit()
+        self.assertEqual(self.database.get_last_api_request_info()['id'], snapshot_id + 1)
+
+    def test_writer_rollback(self):
+        with self.assertRaises(ValueError):
+            with self.database.writing():
+                self.database.cursor.execute("INSERT INTO api_data (Datetime, Data) VALUES ('x', '{}')")
+                raise ValueError
+        self.assertIsNone(self.database.get_last_api_request_info())
+        self.assertIs(self.database.connection, self.pool.reader())
+
+
+class RunCoalescedTestCase(SimpleTestCase):
+    def test_concurrent_calls_share_a_run(self):
+        calls = []
+
+        def compute(value):
+            calls.append(threading.current_thread().name)
+            time.sleep(.05)
+            return value * 2
+
+        async def main():
+            first = await asyncio.gather(*(run_coalesced("key", compute, 21) for _ in range(50)))
+            second = await run_coalesced("key", compute, 1)
+            return first, second
+
+        first, second = asyncio.run(main())
+        self.assertEqual(first, [42] * 50)
+        self.assertEqual(second, 2)
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(calls[0].startswith("market-data"))
+
+    def test_cancelled_waiter(self):
+        async def main():
+            waiters = [asyncio.ensure_future(run_coalesced("cancel", time.sleep, .05)) for _ in range(2)]
+            await asyncio.sleep(0)
+            waiters[0].cancel()
+            return await asyncio.gather(*waiters, return_exceptions=True)
+
+        cancelled, result = asyncio.run(main())
+        self.assertIsInstance(cancelled, asyncio.CancelledError)
+        self.assertIsNone(result)
+
+    def test_async_middleware(self):
+        enabled, profiling.enabled = profiling.enabled, True
+        try:
+            async def view(request):
+                with profiling.span("work"):
+                    return HttpResponse("ok")
+
+            middleware = ServerTimingMiddleware(view)
+            self.assertTrue(asyncio.iscoroutinefunction(middleware))
+            response = asyncio.run(middleware(RequestFactory().get("/api/market-data")))
+            self.assertTrue(response["Server-Timing"].startswith("work;dur="))
+        finally:
+            profiling.enabled = enabled
+
+
+class LiveUpdatesTestCase(SimpleTestCase):
+    def snapshot(self, snapshot_id, is_entry=True, entries=None):
+        return EncodedSnapshot(snapshot_id, json.dumps({
+            "market_breadth": {"is_entry": is_entry, "SEFI": {"value": float("nan")}},
+            "entries": entries if entries is not None else {"AAA": {"rsi": 30.}, "BBB": {"rsi": 25.}},
+            "plotting": {"breadth": [1, 2]},
+        }).encode())
+
+    def test_snapshot_diff(self):
+        before = json.loads(self.snapshot(1).data)
+        self.assertEqual(snapshot_diff(before, json.loads(self.snapshot(2).data)), {})
+        after = json.loads(self.snapshot(2, is_entry=False, entries={"AAA": {"rsi": 28.}, "CCC": {"rsi": 20.}}).data)
+        diff = snapshot_diff(before, after)
+        self.assertEqual(diff["entries"], {"changed": {"AAA": {"rsi": 28.}, "CCC": {"rsi": 20.}}, "removed": ["BBB"]})
+        self.assertFalse(diff["market_breadth"]["is_entry"])
+        self.assertNotIn("plotting", diff)
+        self.assertEqual(snapshot_diff(after, json.loads(self.snapshot(3, entries=False).data))["entries"]["removed"],
+                         ["AAA", "CCC"])
+
+    def stream(self, broadcaster, publish, headers=()):
+        sent = []
+        inbox = asyncio.Queue()
+
+        async def send(message):
+            sent.append(message)
+
+        async def main():
+            task = asyncio.ensure_future(live_updates({"type": "http", "headers": list(headers)}, inbox.get, send,
+                                                      broadcaster=broadcaster, heartbeat=.2))
+            await asyncio.sleep(.05)
+            publish()
+            await asyncio.sleep(.3)
+            await inbox.put({"type": "http.disconnect"})
+            await task
+
+        asyncio.run(main())
+        return [message.get("body", b"") for message in sent[1:]]
+
+    def test_stream(self):
+        snapshots = [self.snapshot(1)]
+        broadcaster = SnapshotBroadcaster(interval=.02, latest=lambda: snapshots[-1])
+        bodies = self.stream(broadcaster, lambda: snapshots.append(self.snapshot(2, is_entry=False)))
+        self.assertTrue(bodies[0].startswith(b"event: snapshot\nid: 1\n"))
+        self.assertTrue(bodies[1].startswith(b"event: diff\nid: 2\n"))
+        diff = json.loads(bodies[1].split(b"data: ")[1])
+        self.assertEqual(list(diff), ["market_breadth"])
+        self.assertFalse(diff["market_breadth"]["is_entry"])
+        self.assertIn(b": keep-alive\n\n", bodies)
+        self.assertIsNone(broadcaster._task)
+
+    def test_last_event_id(self):
+        broadcaster = SnapshotBroadcaster(interval=.02, latest=lambda: self.snapshot(1))
+        bodies = self.stream(broadcaster, lambda: None, headers=[(b"last-event-id", b"1")])
+        self.assertEqual(set(bodies), {b": keep-alive\n\n"})
+
+    def test_slow_subscriber(self):
+        async def main():
+            broadcaster = SnapshotBroadcaster(queue_size=2, latest=lambda: self.snapshot(1))
+            await broadcaster.current()
+            queue = broadcaster.subscribe()
+            for _ in range(3):
+                broadcaster.put(queue, b"event")
+            broadcaster.unsubscribe(queue)
+            # the backlog is replaced with the whole snapshot
+            return [queue.get_nowait() for _ in range(queue.qsize())], broadcaster.snapshot_event()
+
+        events, snapshot_event = asyncio.run(main())
+        self.assertEqual(events, [snapshot_event])
+        self.assertTrue(snapshot_event.startswith(b"event: snapshot\nid: 1\ndata: {"))
+
+    def test_nothing_published(self):
+        def latest():
+            raise IndexDataUnavailable("No ^GSPC bars")
+
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        async def receive():
+            await asyncio.sleep(1)
+
+        asyncio.run(live_updates({"type": "http", "headers": []}, receive, send,
+                                 broadcaster=SnapshotBroadcaster(latest=latest)))
+        self.assertEqual(sent[0]["status"], 503)
+        self.assertEqual(len(sent), 2)
+
+
+class ParallelRebuildTestCase(SimpleTestCase):
+    def test_same_rows_as_serial(self):
+        provider = SyntheticProvider(days=200)
+        chunks = [provider.download(["AAA", "BBB", "CCC"], "1y", "1d"), provider.download(["DDD", "EEE"], "1y", "1d")]
+        # a ticker without bars at the start of the period
+        chunks[1].loc[("EEE", slice(None)), chunks[1].columns[:20]] = np.nan
+
+        with ParallelRebuild(2) as rebuild:
+            for chunk in chunks:
+                rebuild.submit(chunk)
+            rows, states = rebuild.collect()
+
+        expected = pandas.concat([EnhancedDataframe.populate_panel(chunk) for chunk in chunks])
+        assert_frame_equal(rows, expected, check_freq=False)
+        expected_states = []
+        for chunk in chunks:
+            for ticker in chunk.index.unique(level=0):
+                state = IndicatorState.from_dataframe(chunk.loc[ticker].T, ticker)
+                expected_states.append((ticker, state.date, state.to_json()))
+        self.assertEqual(states, expected_states)
+
+
+class TemporaryDatabaseTestCase(SimpleTestCase):
+    """`SP500Database` in a temporary directory, with an empty historical table unless `historical_table` is False"""
+    historical_table = True
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database = SP500Database()
+        self.database.connect_existing_database(f"{self.directory.name}/sp500.sqlite")
+        if self.historical_table:
+            self.database.create_table_historical()
+
+    def tearDown(self):
+        self.database.connection.close()
+        self.directory.cleanup()
+
+    def build_panel(self, tickers: list, gaps: dict = None) -> DataFrame:
+        """
+        Indicator rows of `ohlcv_dataframe` bars of `tickers`, one seed per ticker, the bars are kept in `self.bars`
+        :param gaps: ticker -> slice of the sessions without bars for it
+        """
+        self.bars = to_tickers_data({ticker: ohlcv_dataframe(seed=seed) for seed, ticker in enumerate(tickers)})
+        for ticker, sessions in (gaps or {}).items():
+            self.bars.loc[ticker, self.bars.columns[sessions]] = np.nan
+        return EnhancedDataframe.populate_panel(self.bars)
+
+
+class IncrementalUpdateTestCase(TemporaryDatabaseTestCase):
+    """Bars folded into the stored indicator states give the rows of a full recompute"""
+    sessions = 250
+
+    def setUp(self):
+        super().setUp()
+        self.tickers = ["AAA", "BBB"]
+        self.bars = SyntheticProvider(days=self.sessions).download(self.tickers, "max", "1d")
+        self.database.create_table_indicator_state()
+
+    def rebuild(self, sessions: int) -> None:
+        bars = self.bars.iloc[:, :sessions]
+        self.database.do_populate(EnhancedDataframe.populate_panel(bars))
+        states = []
+        for ticker in self.tickers:
+            state = IndicatorState.from_dataframe(bars.loc[ticker].T, ticker)
+            states.append((ticker, state.date, state.to_json()))
+        self.database.insert_indicator_states(states)
+
+    def update(self, bars: DataFrame) -> UpsertReport:
+        """Update with the bars published so far, downloaded from `update_start` like `populate_sp500` does"""
+        return update_sp500(self.database, self.tickers,
+                            bars.loc[:, bars.columns >= Timestamp(update_start(self.database))])
+
+    def assert_full_recompute(self) -> None:
+        columns = [str(col) for col in SP500Database.columns[2:]]
+        stored = self.database.query_historical_columns(columns).sort_values(["Ticker", "Date"])
+        expected = EnhancedDataframe.populate_panel(self.bars).reset_index()
+        self.assertEqual(list(zip(stored['Ticker'], stored['Date'])),
+                         list(zip(expected['Ticker'], expected['Date'].map(str))))
+        self.assertEqual(len(columns), 22)
+        for column in columns:
+            np.testing.assert_allclose(stored[column].to_numpy(dtype=float), expected[column].to_numpy(dtype=float),
+                                       rtol=1e-9, atol=1e-9, err_msg=column)
+
+    def test_one_session_at_a_time(self):
+        self.rebuild(self.sessions - 5)
+        for sessions in range(self.sessions - 4, self.sessions + 1):
+            self.update(self.bars.iloc[:, :sessions])
+        self.assert_full_recompute()
+
+    def test_missed_sessions(self):
+        self.rebuild(self.sessions - 5)
+        self.assertEqual(update_start(self.database), str(self.bars.columns[-6].date()))
+        # a single update after 5 sessions without any
+        self.update(self.bars)
+        self.assert_full_recompute()
+
+    def test_same_day_replace(self):
+        self.rebuild(self.sessions - 1)
+        intraday = self.bars.copy()
+        last = intraday.columns[-1]
+        for ticker in self.tickers:
+            intraday.loc[(ticker, "Close"), last] *= 1.01
+            intraday.loc[(ticker, "High"), last] = intraday.loc[[(ticker, "High"), (ticker, "Close")], last].max()
+            intraday.loc[(ticker, "Volume"), last] /= 2
+        self.update(intraday)
+        self.update(self.bars)
+        self.assert_full_recompute()
+
+    def test_backfilled_session(self):
+        self.rebuild(self.sessions - 5)
+        cvi = CVI(self.database)
+        cvi.extend()
+        # BBB is missing from a download, its rows of these sessions are only written by the next update
+        partial = self.bars.iloc[:, :self.sessions - 2].drop(index="BBB", level=0)
+        cvi.extend(since=self.update(partial).earliest)
+        report = self.update(self.bars)
+        self.assertEqual(report.earliest, str(self.bars.columns[-6]))
+        assert_frame_equal(cvi.extend(since=report.earliest), cvi.cumulative_volume_frame())
+        assert_frame_equal(self.database.query_cvi(), cvi.cumulative_volume_frame())
+        self.assert_full_recompute()
+
+
+class CVITestCase(TemporaryDatabaseTestCase):
+    """The stored cumulative volume index extended date by date equals a full recompute"""
+
+    def setUp(self):
+        super().setUp()
+        bars = SyntheticProvider(days=250).download(["AAA", "BBB", "CCC"], "max", "1d")
+        self.panel = EnhancedDataframe.populate_panel(bars)
+        self.last = self.panel.index.max()
+        self.database.upsert_historical(self.panel[self.panel.index < self.last])
+        self.cvi = CVI(self.database)
+
+    def assert_full_recompute(self) -> None:
+        expected = self.cvi.cumulative_volume_frame()
+        assert_frame_equal(self.cvi.extend(), expected)
+        assert_frame_equal(self.database.query_cvi(), expected)
+
+    def test_appended_day(self):
+        self.assert_full_recompute()
+        self.database.upsert_historical(self.panel[self.panel.index == self.last])
+        self.assert_full_recompute()
+
+    def test_replaced_day(self):
+        intraday = self.panel[self.panel.index == self.last].copy()
+        final = intraday.copy()
+        intraday['Volume_Change'] = -intraday['Volume_Change'].abs()
+        final['Volume_Change'] = intraday['Volume_Change'].abs() + 1
+        self.database.upsert_historical(intraday)
+        self.assert_full_recompute()
+        self.database.upsert_historical(final)
+        self.assert_full_recompute()
+        self.assertEqual(self.database.query_cvi()['CVI'].iloc[-1] - self.database.query_cvi()['CVI'].iloc[-2], 3)
+
+    def test_stored_read_only(self):
+        expected = self.cvi.cumulative_volume_frame()
+        assert_frame_equal(self.cvi.stored(), expected)
+        self.assertTrue(self.database.query_cvi().empty)
+        self.cvi.extend()
+        self.database.upsert_historical(self.panel[self.panel.index == self.last])
+        # the rows of the last date are only read once the index is extended
+        assert_frame_equal(self.cvi.stored(), expected)
+        self.cvi.extend()
+        assert_frame_equal(self.cvi.stored(), self.cvi.cumulative_volume_frame())
+
+
+class BreadthPanelTestCase(TemporaryDatabaseTestCase):
+    historical_table = False
+
+    def setUp(self):
+        super().setUp()
+        # nullable columns, the moving averages of some rows are missing
+        self.database.cursor.execute(f"CREATE TABLE historical_data (tests INTEGER PRIMARY KEY, "
+                                     f"{', '.join(SP500Database.columns)})")
+        self.database.create_table_meta()
+        # BBB starts later and CCC has a gap, those dates have no row for them
+        panel = self.build_panel(["AAA", "BBB", "CCC"], gaps={"BBB": slice(None, 150), "CCC": slice(200, 210)})
+        # rows stored without their moving averages
+        panel.loc[(panel['Ticker'] == "AAA") & (panel.index < self.bars.columns[180]), ["MA20", "MA50"]] = np.nan
+        self.database.do_populate(panel)
+        # the index has a date without any row
+        self.dates = sorted(set(panel.index)) + [self.bars.columns[-1] + pandas.Timedelta(days=1)]
+
+    def per_date_sefi(self, ma_column: str) -> list:
+        """SEFI as `SP500Analysis.sefi` computed it before the panel, one query per date"""
+        results = []
+        for date_ in self.dates:
+            dataframe = self.database.query_from_date_to_dataframe(date_)
+            dataframe['SEFI'] = Sefi(dataframe['Close'], dataframe[ma_column]).data
+            try:
+                results.append(len(dataframe[dataframe["SEFI"] == 0]) / len(dataframe))
+            except ZeroDivisionError:
+                results.append(0)
+        return list(np.array(results) * 100)
+
+    def test_matches_per_date_queries(self):
+        panel = BreadthPanel(self.database)
+        for ma_column in ("MA20", "MA50"):
+            expected = self.per_date_sefi(ma_column)
+            self.assertGreater(len(set(expected)), 1)
+            np.testing.assert_allclose(panel.percent_below(ma_column, dates=self.dates).to_numpy(), expected)
+
+
+class HistoricalTableTestCase(TemporaryDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.panel = self.build_panel(["AAA", "BBB"])
+
+    def rows(self) -> list:
+        return [tuple(row) for row in self.database.cursor.execute(
+            "SELECT Ticker, Date, Close FROM historical_data ORDER BY Ticker, Date").fetchall()]
+
+    def test_migrate_historical(self):
+        # a table created before the indexes, the same rows inserted twice
+        for index in self.database.historical_indexes:
+            self.database.cursor.execute(f"DROP INDEX {index.name}")
+        self.database.do_populate(self.panel)
+        last = self.panel.copy()
+        last['Close'] += 1
+        self.database.do_populate(last)
+        self.assertEqual(len(self.rows()), 2 * len(self.panel))
+        self.assertEqual(len(self.database.missing_indexes(self.database.historical_indexes)), 2)
+
+        self.database.migrate_historical()
+        rows = self.rows()
+        self.assertEqual(len(rows), len(self.panel))
+        # the last inserted row is kept
+        expected = last.reset_index().sort_values(["Ticker", "Date"])
+        self.assertEqual([close for _, _, close in rows], expected['Close'].tolist())
+        self.assertEqual(self.database.missing_indexes(self.database.historical_indexes), [])
+        plan = self.database.cursor.execute("EXPLAIN QUERY PLAN SELECT * FROM historical_data WHERE Date = ?",
+                                            ("2020-01-01",)).fetchall()
+        self.assertIn("idx_historical_data_date", " ".join(row[-1] for row in plan))
+
+        self.database.migrate_historical()
+        self.assertEqual(self.rows(), rows)
+        columns = ", ".join(SP500Database.columns)
+        with self.assertRaisesRegex(sqlite3.IntegrityError, "UNIQUE"):
+            self.database.cursor.execute(f"INSERT INTO historical_data ({columns}) "
+                                         f"SELECT {columns} FROM historical_data LIMIT 1")
+
+    def test_upsert_historical(self):
+        first, last = self.panel[self.panel.index < self.panel.index.max()], self.panel
+        report = self.database.upsert_historical(first)
+        self.assertEqual((report.inserted, report.updated, report.unchanged), (len(first), 0, 0))
+        report = self.database.upsert_historical(first)
+        self.assertEqual((report.inserted, report.updated, report.unchanged), (0, 0, len(first)))
+
+        # the last session, then its final bar replacing the same day of one ticker
+        report = self.database.upsert_historical(last[last.index == last.index.max()])
+        self.assertEqual((report.inserted, report.updated, report.unchanged), (2, 0, 0))
+        final = last[last.index == last.index.max()].copy()
+        final.loc[final['Ticker'] == "AAA", "Close"] += 1
+        report = self.database.upsert_historical(final)
+        self.assertEqual((report.inserted, report.updated, report.unchanged), (0, 1, 1))
+
+        rows = self.rows()
+        self.assertEqual(len(rows), len(self.panel))
+        stored = {(ticker, date_): close for ticker, date_, close in rows}
+        for ticker, close in zip(final['Ticker'], final['Close']):
+            self.assertEqual(stored[(ticker, str(last.index.max()))], close)
+
+    def test_bulk_load(self):
+        self.database.do_populate(self.panel)
+        with self.database.bulk_load("historical_data") as report:
+            self.assertEqual(len(self.database.missing_indexes(self.database.historical_indexes)), 2)
+            self.assertEqual(self.database.cursor.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+            self.database.clear_historical()
+            self.database.do_populate(self.panel.iloc[:100])
+            self.database.do_populate(self.panel.iloc[100:])
+        self.assertEqual(report.rows, len(self.panel))
+        self.assertGreater(report.seconds, 0)
+        self.assertEqual(str(report), f"Loaded {len(self.panel)} rows in {report.seconds:.2f}s "
+                                      f"({report.rows / report.seconds:.0f} rows/s)")
+        self.assertEqual(self.database.missing_indexes(self.database.historical_indexes), [])
+        self.assertEqual(self.database.cursor.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+        self.assertEqual(len(self.rows()), len(self.panel))
+
+    def test_bulk_load_rollback(self):
+        self.database.do_populate(self.panel)
+        rows, version = self.rows(), self.database.historical_version()
+        with self.assertRaises(RuntimeError):
+            with self.database.bulk_load("historical_data"):
+                self.database.clear_historical()
+                self.database.do_populate(self.panel.iloc[:100])
+                raise RuntimeError
+        self.assertEqual(self.rows(), rows)
+        self.assertEqual(self.database.historical_version(), version)
+        self.assertEqual(self.database.missing_indexes(self.database.historical_indexes), [])
+        self.assertEqual(self.database.cursor.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+        # the table is usable again, commits are no longer deferred
+        self.database.upsert_historical(self.panel.iloc[:1].assign(Close=0.))
+        self.database.connection.rollback()
+        self.assertEqual(self.rows()[0][2], 0.)
+
+
+class ADRTestCase(TemporaryDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        panel = self.build_panel(["AAA", "BBB", "CCC"], gaps={"CCC": slice(None, 150)})
+        self.dates = sorted(set(panel.index.map(str)))
+        # nothing declined on these dates, one of them without CCC
+        self.no_decliners = [self.dates[10], self.dates[-1]]
+        panel.loc[panel.index.map(str).isin(self.no_decliners), "Change"] = 1.
+        self.database.do_populate(panel)
+
+    def per_date_counts(self) -> tuple:
+        """Advancing and declining stocks as ADR counted them before the aggregate query, one query per date"""
+        advancing, declining = [], []
+        for date_ in self.dates:
+            dataframe = self.database.query_from_date_to_dataframe(date_)
+            advancing.append(len(dataframe[dataframe['Change'] > 0]))
+            declining.append(len(dataframe[dataframe['Change'] <= 0]))
+        return np.array(advancing, dtype=float), np.array(declining, dtype=float)
+
+    def test_matches_per_date_queries(self):
+        advancing, declining = self.per_date_counts()
+        frame = ADR(self.database).ad_ratio_frame()
+        self.assertEqual(frame['Date'].tolist(), self.dates)
+        np.testing.assert_array_equal(frame['Advancing'].to_numpy(), advancing)
+        np.testing.assert_array_equal(frame['Declining'].to_numpy(), declining)
+        np.testing.assert_allclose(frame['ADR'].to_numpy()[declining > 0], (advancing / declining)[declining > 0])
+
+    def test_zero_decliners(self):
+        advancing, declining = self.per_date_counts()
+        no_decliners = declining == 0
+        self.assertTrue(all(no_decliners[self.dates.index(date_)] for date_ in self.no_decliners))
+        for policy, values in ((ZeroDecliners.Cap, np.full(no_decliners.sum(), ADR_CAP)),
+                               (ZeroDecliners.Nan, np.full(no_decliners.sum(), np.nan)),
+                               (ZeroDecliners.Epsilon, advancing[no_decliners] / 1e-6)):
+            ratio = ADR(self.database, zero_decliners=policy).ad_ratio_frame()['ADR'].to_numpy()
+            np.testing.assert_allclose(ratio[no_decliners], values, err_msg=policy.name)
+            np.testing.assert_allclose(ratio[~no_decliners], (advancing / declining)[~no_decliners],
+                                       err_msg=policy.name)
+        ratio = ADR(self.database, cap=4.).ad_ratio_frame()['ADR'].to_numpy()
+        self.assertTrue((ratio[no_decliners] == 4.).all())
+
+    def test_since(self):
+        frame = ADR(self.database, since=self.dates[-5]).ad_ratio_frame()
+        self.assertEqual(frame['Date'].tolist(), self.dates[-4:])
+        np.testing.assert_allclose(frame['ADR'].to_numpy(), ADR(self.database).ad_ratio_frame()['ADR'].iloc[-4:])
+
+        # the analysis only computes the dates of the index
+        index = to_tickers_data({"^GSPC": ohlcv_dataframe(seed=9).set_axis(self.bars.columns, axis=0)})
+        FileProvider(self.directory.name).write(index)
+        analysis = SP500Analysis(self.database, provider=FileProvider(self.directory.name))
+        analysis.sefi()
+        sp500 = analysis.adr_analysis()
+        expected = ADR(self.database).ad_ratio_frame().set_index("Date")['ADR']
+        np.testing.assert_allclose(sp500['ADR'].to_numpy(), expected.reindex(sp500.index.map(str)).to_numpy())
+        self.assertGreater(len(sp500), 10)
+
+
+def server_time(moment: datetime) -> str:
+    """`moment` as the refresh log stores it, naive local time of the server"""
+    return moment.astimezone().strftime(DATETIME_FORMAT)
+
+
+class RefresherTestCase(SimpleTestCase):
+    def setUp(self):
+        self.database = SP500Database()
+        self.database.connect_existing_database(":memory:")
+        self.database.create_table_refresh_log()
+        self.refresher = MarketDataRefresher(interval=300.)
+
+    def tearDown(self):
+        self.database.connection.close()
+
+    def log(self, finished: datetime, status: str = "success") -> None:
+        self.database.insert_refresh_log(server_time(finished - timedelta(seconds=20)), server_time(finished), 20.,
+                                         status, data_date="2023-06-30 00:00:00", snapshot_id=1)
+
+    def assert_next_run(self, moment: datetime, seconds: float) -> None:
+        self.assertEqual(self.refresher.is_due(self.database, moment), seconds == 0, moment)
+        self.assertEqual(self.refresher.seconds_to_next_run(self.database, moment), seconds, moment)
+
+    def test_open(self):
+        self.assert_next_run(new_york(2023, 6, 30, 10), 0)
+        self.log(new_york(2023, 6, 30, 10))
+        self.assert_next_run(new_york(2023, 6, 30, 10, 3), 120)
+        self.assert_next_run(new_york(2023, 6, 30, 10, 5), 0)
+        # a failed run doesn't count
+        self.log(new_york(2023, 6, 30, 10, 6), status="error")
+        self.assert_next_run(new_york(2023, 6, 30, 10, 7), 0)
+
+    def test_close(self):
+        self.log(new_york(2023, 6, 30, 15, 58))
+        # the close comes before the interval
+        self.assert_next_run(new_york(2023, 6, 30, 15, 59), 60)
+        # once more after the close for the final bars
+        self.assert_next_run(new_york(2023, 6, 30, 16, 1), 0)
+        self.log(new_york(2023, 6, 30, 16, 2))
+        # then at the next open, monday
+        self.assert_next_run(new_york(2023, 6, 30, 17), (2 * 24 + 16.5) * 3600)
+
+    def test_holidays(self):
+        # july 3rd closes at 13:00 and the 4th is a holiday
+        self.log(new_york(2023, 7, 3, 12, 58))
+        self.assert_next_run(new_york(2023, 7, 4, 12), 0)
+        self.log(new_york(2023, 7, 3, 13, 5))
+        self.assert_next_run(new_york(2023, 7, 4, 12), 21.5 * 3600)
+
+    def test_refresh_status(self):
+        calendar = FixedCalendar(new_york(2023, 6, 30, 10, 30))
+        status = refresh_status(self.database, calendar)
+        self.assertEqual((status["last_run"], status["last_success"], status["lag"]), (None, None, None))
+        self.assertTrue(status["market_open"])
+
+        self.log(new_york(2023, 6, 30, 10))
+        self.log(new_york(2023, 6, 30, 10, 20), status="error")
+        status = refresh_status(self.database, calendar)
+        self.assertEqual(status["last_run"]["status"], "error")
+        self.assertEqual(status["last_success"]["finished"], server_time(new_york(2023, 6, 30, 10)))
+        self.assertEqual(status["last_success"]["data_date"], "2023-06-30 00:00:00")
+        self.assertEqual(status["last_success"]["snapshot"], 1)
+        # the lag counts from the last successful run
+        self.assertEqual(status["lag"], 30 * 60)
+
+
+class FlakyProvider(FileProvider):
+    """Fails the first download of every chunk"""
+
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.calls = []
+
+    def download(self, tickers, period, interval, start=None, end=None):
+        self.calls.append(list(tickers))
+        if len(self.calls) <= 2:
+            raise ConnectionError
+        return super().download(tickers, period, interval, start=start, end=end)
+
+
+class ChunkedDownloaderTestCase(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.tickers = [f"T{i}" for i in range(7)]
+        self.data = to_tickers_data({ticker: ohlcv_dataframe(seed=i) for i, ticker in enumerate(self.tickers)})
+        FileProvider(self.directory.name).write(self.data)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_matches_single_download(self):
+        downloader = ChunkedDownloader(FileProvider(self.directory.name), chunk_size=3, concurrency=2)
+        result = downloader.download(self.tickers, "1y", "1d")
+        expected = FileProvider(self.directory.name).download(self.tickers, "1y", "1d")
+        self.assertEqual(sorted(result.index.unique(level=0)), self.tickers)
+        np.testing.assert_array_equal(result.loc[self.tickers].to_numpy(), expected.to_numpy())
+
+    def test_retries_failed_chunks(self):
+        provider = FlakyProvider(self.directory.name)
+        downloader = ChunkedDownloader(provider, chunk_size=4, concurrency=2, backoff=0)
+        result = downloader.download(self.tickers, "1mo", "1d")
+        self.assertEqual(sorted(result.index.unique(level=0)), self.tickers)
+        self.assertEqual(len(provider.calls), 4)
+        self.assertEqual(downloader.failed, [])
+
+    def test_reports_missing_tickers(self):
+        downloader = ChunkedDownloader(FileProvider(self.directory.name), chunk_size=3, retries=1, backoff=0)
+        chunks = []
+        downloader.run(self.tickers + ["MISSING"], "5d", "1d", chunks.append)
+        self.assertEqual(downloader.failed, ["MISSING"])
+        self.assertEqual(sum(len(chunk.index.unique(level=0)) for chunk in chunks), len(self.tickers))
+        self.assertTrue(all(chunk.shape[1] == 5 for chunk in chunks))
+
+
+class YahooProviderTestCase(SimpleTestCase):
+    def test_split(self):
+        bars = ohlcv_dataframe(days=30)
+        # layout of `yfinance.download(..., group_by="ticker")`, a failed ticker comes back without bars
+        history = pandas.concat({"AAA": bars, "BBB": bars * np.nan, "CCC": bars.iloc[5:].reindex(bars.index)}, axis=1)
+        frames = YahooProvider.split(history, ["AAA", "BBB", "CCC", "DDD"])
+        self.assertEqual(list(frames), ["AAA", "CCC"])
+        assert_frame_equal(frames["AAA"], bars)
+        assert_frame_equal(frames["CCC"], bars.iloc[5:])
+        # a single ticker isn't grouped by yfinance
+        assert_frame_equal(YahooProvider.split(bars, ["AAA"])["AAA"], bars)
+        self.assertEqual(YahooProvider.split(DataFrame(), ["AAA"]), {})
+
+
+class FixedCalendar(MarketCalendar):
+    def __init__(self, moment: datetime):
+        super().__init__()
+        object.__setattr__(self, "moment", moment)
+
+    def now(self) -> datetime:
+        return self.moment
+
+
+class CountingProvider(FileProvider):
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.calls = []
+
+    def download(self, tickers, period, interval, start=None, end=None):
+        self.calls.append((sorted(tickers), start, end))
+        return super().download(tickers, period, interval, start=start, end=end)
+
+
+class CachingProviderTestCase(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        sessions = [date(2023, 1, 3)]
+        while sessions[-1] < date(2023, 7, 5):
+            sessions.append(NYSE.next_trading_day(sessions[-1]))
+        self.tickers = ["AAA", "BBB", "CCC"]
+        data = to_tickers_data({ticker: ohlcv_dataframe(len(sessions), seed=i).set_axis(DatetimeIndex(sessions), axis=0)
+                                for i, ticker in enumerate(self.tickers)})
+        self.upstream = CountingProvider(f"{self.directory.name}/bars")
+        self.upstream.write(data.loc[:, data.columns <= Timestamp("2023-06-30")])
+        self.bars = data
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def provider(self, moment: datetime, offline: bool = False) -> CachingProvider:
+        return CachingProvider(self.upstream, f"{self.directory.name}/raw_bars.sqlite", offline=offline,
+                               calendar=FixedCalendar(moment))
+
+    def test_downloads_missing_ranges_only(self):
+        provider = self.provider(new_york(2023, 6, 30, 17))
+        month = provider.download(self.tickers, "1mo", "1d")
+        self.assertEqual(self.upstream.calls, [(self.tickers, date(2023, 5, 31), None)])
+        np.testing.assert_array_equal(month.to_numpy(), self.bars.loc[:, "2023-05-31":"2023-06-30"].to_numpy())
+
+        self.assertTrue(provider.download(self.tickers, "1mo", "1d").equals(month))
+        self.assertEqual(len(self.upstream.calls), 1)
+
+        provider.download(self.tickers, "3mo", "1d")
+        self.assertEqual(self.upstream.calls[-1], (self.tickers, date(2023, 3, 31), date(2023, 5, 31)))
+
+        # next session, july 3rd closes early and the 4th is a holiday
+        self.upstream.write(self.bars)
+        provider = self.provider(new_york(2023, 7, 5, 17))
+        last_days = provider.download(self.tickers, "2d", "1d")
+        self.assertEqual(self.upstream.calls[-1], (self.tickers, date(2023, 7, 1), None))
+        self.assertEqual(list(last_days.columns), [Timestamp("2023-07-03"), Timestamp("2023-07-05")])
+
+    def test_offline(self):
+        self.provider(new_york(2023, 6, 30, 17)).download(self.tickers[:2], "5d", "1d")
+        cached = self.provider(new_york(2023, 7, 5, 17), offline=True).download(self.tickers, "1y", "1d")
+        self.assertEqual(len(self.upstream.calls), 1)
+        self.assertEqual(list(cached.index.unique(level=0)), self.tickers[:2])
+        self.assertEqual(cached.shape[1], 5)
+
+    def test_offline_index_history(self):
+        database = SP500Database()
+        database.connect_existing_database(f"{self.directory.name}/sp500.sqlite")
+        database.create_table_historical()
+        database.do_populate(EnhancedDataframe.populate_panel(self.bars.loc[:, :"2023-06-30"]))
+        provider = self.provider(new_york(2023, 6, 30, 17), offline=True)
+        # the request paths never download the index, nothing is cached yet
+        with self.assertRaises(IndexDataUnavailable):
+            SP500Analysis(database, provider=provider).sefi()
+        self.assertEqual(self.upstream.calls, [])
+
+        self.upstream.write(to_tickers_data({"^GSPC": ohlcv_dataframe(len(self.bars.columns), seed=9).set_axis(
+            self.bars.columns, axis=0)}))
+        self.provider(new_york(2023, 6, 30, 17)).index_history("^GSPC", "2023-01-03", "2023-06-30")
+        sp500 = SP500Analysis(database, provider=provider).sefi()
+        self.assertEqual(len(self.upstream.calls), 1)
+        self.assertIn("SEFI", sp500.columns)
+        database.connection.close()
+
+
+class ColumnarStoreTestCase(TemporaryDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        # BBB starts later, its first dates have no row
+        self.panel = self.build_panel(["AAA", "BBB"], gaps={"BBB": slice(None, 20)})
+        self.database.do_populate(self.panel)
+        self.store = ColumnarStore.export(self.database)
+
+    def test_matches_sqlite(self):
+        dates = self.database.query_all_dates()
+        self.assertEqual(self.store.query_all_dates(), dates)
+        self.assertEqual(self.store.get_date_before_latest_date(), self.database.get_date_before_latest_date())
+        for date_ in (dates[0], dates[-1]):
+            expected = self.database.query_from_date_to_dataframe(date_).drop(columns="tests")
+            assert_frame_equal(self.store.query_from_date_to_dataframe(date_), expected.reset_index(drop=True))
+        expected = self.database.query_ticker_data("BBB").drop(columns="tests")
+        assert_frame_equal(self.store.query_ticker_data("BBB"), expected.reset_index(drop=True))
+        assert_frame_equal(self.store.query_advance_decline(dates[10]), self.database.query_advance_decline(dates[10]))
+        assert_frame_equal(self.store.query_volume_breadth(), self.database.query_volume_breadth())
+        self.assertEqual(self.store.query_breadth_specifics(), self.database.query_breadth_specifics())
+
+    def test_tickers_columns(self):
+        dates = self.database.query_all_dates()
+        for start, end in ((None, None), (dates[5], dates[30])):
+            expected = self.database.query_tickers_columns(["BBB", "AAA"], ["Close", "MA20"], start, end)
+            assert_frame_equal(self.store.query_tickers_columns(["BBB", "AAA"], ["Close", "MA20"], start, end),
+                               expected)
+        charts = plotting_data_entries(self.database, ["BBB", "AAA", "CCC"], start=dates[5], points=40)
+        self.assertEqual(list(charts), ["BBB", "AAA"])
+        self.assertEqual(charts["AAA"]["index"][0], dates[5])
+        self.assertEqual(len(charts["AAA"]["Closes"]), 40)
+        self.assertEqual(plotting_data_entries(self.store, ["BBB", "AAA"], start=dates[5], points=40), charts)
+
+    def test_slices_are_views(self):
+        closes = self.store.column("Close")
+        self.assertIsInstance(closes, np.memmap)
+        self.assertTrue(np.shares_memory(closes[-1], closes))
+        self.assertTrue(np.shares_memory(closes[:, 1], closes))
+
+    def test_open_checks_version(self):
+        self.assertEqual(ColumnarStore.open(self.database).directory, self.store.directory)
+        # same dates and number of rows, other values
+        last = self.panel[self.panel.index == self.panel.index.max()].copy()
+        last['Close'] *= 1.01
+        self.database.upsert_historical(last)
+        self.assertIsNone(ColumnarStore.open(self.database))
+        ColumnarStore.export(self.database)
+        store = ColumnarStore.export(self.database)
+        self.assertEqual(ColumnarStore.open(self.database).directory, store.directory)
+        # older versions are removed, the last two are kept
+        self.assertEqual(len([path for path in store.directory.parent.iterdir() if path.is_dir()]), 2)
+
+    def test_export_since(self):
+        dates = self.database.query_all_dates()
+        since = dates[-3][:10]
+        changed = self.panel[self.panel.index >= since].copy()
+        changed['Close'] *= 1.01
+        new_ticker = changed[changed['Ticker'] == "AAA"].assign(Ticker="AAB")
+        next_day = changed[changed.index == changed.index.max()].copy()
+        next_day.index = next_day.index + pandas.Timedelta(days=1)
+        self.database.upsert_historical(pandas.concat([changed, new_ticker, next_day]))
+
+        store = ColumnarStore.export(self.database, base=self.store, since=since)
+        self.assertEqual(ColumnarStore.open(self.database).directory, store.directory)
+        expected = ColumnarStore.export(self.database, directory=f"{self.directory.name}/full")
+        self.assertEqual(store.meta, expected.meta)
+        np.testing.assert_array_equal(store.dates, expected.dates)
+        np.testing.assert_array_equal(store.tickers, expected.tickers)
+        np.testing.assert_array_equal(store.present, expected.present)
+        for col in ColumnarStore.value_columns:
+            np.testing.assert_array_equal(store.column(col), expected.column(col), err_msg=col)
+
+
+class ChartDataViewTestCase(SimpleTestCase):
+    def get(self, **params):
+        response = get_chart_data(RequestFactory().get("/api/chart-data", {"tickers": "AAPL", **params}))
+        return response.status_code, response.data.get("detail")
+
+    def test_invalid_dates(self):
+        for params in ({"start": "2023-13-01"}, {"start": "yesterday"}, {"end": "2023-02-30"},
+                       {"start": "2023-01-01'; --"}, {"end": ""}):
+            status, detail = self.get(**params)
+            self.assertEqual(status, 400, params)
+            self.assertIn("YYYY-MM-DD", detail)
+        self.assertEqual(self.get(start="2023-02-01", end="2023-01-01"), (400, "start must be before end"))
+        self.assertEqual(self.get(start="2023-01-01", end="2023-01-01"), (400, "start must be before end"))
@@ -13,4 +13,14 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'screener.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# imported once Django is set up
+from base.api.live import LIVE_PATH, live_updates
+
+
+async def application(scope, receive, send):
+    """Django, except for the market data event stream which holds its connections open outside of Django"""
+    if scope["type"] == "http" and scope["path"] == LIVE_PATH:
+        return await live_updates(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -95,6 +95,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.common.CommonMiddleware",
+    "base.api.middleware.ServerTimingMiddleware",
 ]
 
 CORS_ALLOW_ALL_ORIGINS = True